@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# collection_plan.py
+# <Directory of a model's json generated by create_perf_json.py>
+# <Metric or metric group names to compute>
+# --list <List the model's metric groups>
+#
+# OUTPUT: A perf stat command line counting the fewest events that
+#         compute all the metrics, and which metrics share each event.
+#
+# EXAMPLE: python collection_plan.py perf/sapphirerapids Default TopdownL2
+import argparse
+import collections
+from create_perf_json import parse_event
+from dataclasses import dataclass, field
+from pathlib import Path
+from perf_groups import PerfModel, Schedule, perf_event, schedule
+import sys
+from typing import Any, Counter, Dict, List, Set, Tuple, Union
+
+# Event json fields that don't change what an event counts.
+_DESCRIPTIVE_FIELDS = frozenset([
+    'BriefDescription', 'Counter', 'Data_LA', 'Deprecated', 'Errata', 'EventName',
+    'Experimental', 'MetricExpr', 'MetricName', 'PEBS', 'PublicDescription',
+    'RetirementLatencyMax', 'RetirementLatencyMean', 'RetirementLatencyMin',
+    'SampleAfterValue',
+])
+
+# Event json fields set by the terms of an event in a metric.
+_TERM_FIELDS = {
+    'any': 'AnyThread',
+    'cmask': 'CounterMask',
+    'edge': 'EdgeDetect',
+    'event': 'EventCode',
+    'inv': 'Invert',
+    'umask': 'UMask',
+}
+
+# Encodings of the core events perf names.
+_PERF_EVENT_FIELDS = {
+    'cycles': {'EventCode': 0x3c},
+    'instructions': {'EventCode': 0xc0},
+}
+
+
+def _field_value(value: str) -> Union[int, str]:
+    try:
+        return int(value, 0)
+    except ValueError:
+        return value
+
+
+def alias_key(model: PerfModel, event: str) -> Tuple[Any, ...]:
+    """
+    A key shared by events, as written in perf json metrics, that count
+    the same thing. For example, events with the same encoding but
+    different names, events written with and without their PMU, or a
+    perf named event and its model specific event.
+    """
+    pmu, name, terms, modifiers = parse_event(event)
+    json_event = model.events.get(name.upper())
+    if json_event:
+        fields = {k: _field_value(v) for k, v in json_event.items()
+                  if k not in _DESCRIPTIVE_FIELDS}
+    elif name in _PERF_EVENT_FIELDS:
+        fields = dict(_PERF_EVENT_FIELDS[name])
+    else:
+        fields = {'EventName': name}
+    for term, value in terms.items():
+        fields[_TERM_FIELDS.get(term, term)] = _field_value(value)
+    placement = model.placement(event)
+    unit = placement.unit if placement else pmu
+    # Zero values are the same as missing fields.
+    return (unit, tuple(sorted((k, v) for k, v in fields.items() if v != 0)),
+            ''.join(sorted(modifiers)))
+
+
+@dataclass
+class Plan:
+    """The events to count to compute a set of metrics."""
+    metrics: List[str] = field(default_factory=list)
+    # Maps each event counted to the metrics reading it.
+    readers: Dict[str, List[str]] = field(default_factory=dict)
+    # Maps events counted to the equivalent events metrics name in their place.
+    aliases: Dict[str, List[str]] = field(default_factory=dict)
+    # Number of events the metrics read before deduplication.
+    references: int = 0
+    schedule: Schedule = field(default_factory=Schedule)
+
+    def command(self) -> str:
+        return f"perf stat -e '{self.schedule.perf_events()}'"
+
+    def report(self) -> str:
+        groups = len(self.schedule.groups)
+        lines = [f'{len(self.metrics)} metrics read {self.references} events, '
+                 f'{len(self.readers)} once deduplicated, counted in '
+                 f'{groups} group{"" if groups == 1 else "s"}']
+        for event, names in sorted(self.readers.items()):
+            if len(names) > 1:
+                lines.append(f'{perf_event(event)}: {", ".join(names)}')
+        for event, others in sorted(self.aliases.items()):
+            lines.append(f'{perf_event(event)} also counts '
+                         f'{", ".join(perf_event(e) for e in others)}')
+        return '\n'.join(lines)
+
+
+def plan(model: PerfModel, names: List[str]) -> Plan:
+    """
+    Plan counting the fewest events to compute the metrics and metric
+    groups named. Each set of equivalent events is counted once, as the
+    name metrics use most, and shared by all the metrics reading it.
+    """
+    result = Plan()
+    result.metrics = model.select(names)
+    uses: Counter[str] = collections.Counter()
+    for name in result.metrics:
+        uses.update(model.metric_events(name))
+    result.references = sum(uses.values())
+
+    equivalents: Dict[Tuple[Any, ...], Set[str]] = collections.defaultdict(set)
+    for event in uses:
+        equivalents[alias_key(model, event)].add(event)
+    canonical: Dict[str, str] = {}
+    for events in equivalents.values():
+        counted = min(events, key=lambda e: (-uses[e], len(e), e))
+        for event in events:
+            canonical[event] = counted
+        if len(events) > 1:
+            result.aliases[counted] = sorted(events - {counted})
+
+    readers: Dict[str, List[str]] = collections.defaultdict(list)
+    for name in result.metrics:
+        for event in sorted({canonical[e] for e in model.metric_events(name)}):
+            readers[event].append(name)
+    result.readers = dict(readers)
+    result.schedule = schedule(model, result.metrics, canonical)
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Plan the fewest events to compute metrics.')
+    ap.add_argument('modeldir', type=Path,
+                    help='Directory of a model\'s json generated by create_perf_json.py.')
+    ap.add_argument('names', nargs='*', help='Metric or metric group names.')
+    ap.add_argument('--list', action='store_true', help='List the model\'s metric groups.')
+    args = ap.parse_args()
+
+    model = PerfModel(args.modeldir)
+    if args.list:
+        for group, description in sorted(model.metricgroups.items()):
+            print(f'{group}: {description}')
+        return
+    if not args.names:
+        ap.error('No metric or metric group names')
+    result = plan(model, args.names)
+    print(result.command())
+    print(result.report(), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,10 @@
 #
 # create_perf_json.py
 # --outdir <Output directory where files are written - default perf>
+# --jobs/-j <Number of models to generate in parallel - default 1>
+# --force <Regenerate models whose inputs are unchanged since the last run>
+# --cache-dir <Directory caching decoded event json and parsed metrics, like ~/.cache/perfmon - default none>
+# --cache-size <Maximum size of the cache directory in MiB - default 256>
 # --verbose/-v/-vv/-vvv <Print verbosity during generation>
 #
 # ASSUMES: That the script is being run in the scripts folder of the repo.
@@ -16,14 +20,21 @@
 # EXAMPLE: python create_perf_json.py
 import argparse
 import collections
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
 import csv
+import functools
+import hashlib
 from itertools import takewhile
 import json
+import marshal
 import metric
+import os
 from pathlib import Path
 import re
-from typing import cast, DefaultDict, Dict, Optional, Set, TextIO, Tuple
+import sys
+import tempfile
+from typing import Any, DefaultDict, Dict, FrozenSet, Optional, Set, Tuple
 
 _verbose = 0
 def _verboseprintX(level:int, *args, **kwargs):
@@ -34,6 +45,117 @@ _verboseprint = lambda *a, **k: _verboseprintX(1, *a, **k)
 _verboseprint2 = lambda *a, **k: _verboseprintX(2, *a, **k)
 _verboseprint3 = lambda *a, **k: _verboseprintX(3, *a, **k)
 
+@functools.lru_cache(maxsize=None)
+def _file_digest(path: Path) -> str:
+    """SHA-256 of a file's contents, computed once per run."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+class JsonFileLoader:
+    """
+    Loads json input files such as the event json files.
+
+    Decoded files are memoized by path so files shared by models are
+    only decoded once per run. When a cache directory is given the
+    decoded values are also stored there in marshal format, keyed by a
+    hash of the file contents, so later runs skip json decoding. The
+    least recently used entries are evicted once the directory exceeds
+    its size limit. Loaded values are shared and must not be mutated.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None, max_cache_bytes: int = 0):
+        self.cache_dir = cache_dir
+        self.max_cache_bytes = max_cache_bytes
+        self._loaded: Dict[Path, Any] = {}
+
+    def _cache_path(self, digest: str) -> Path:
+        # Marshal's format may change between python versions.
+        python = f'py{sys.version_info[0]}{sys.version_info[1]}'
+        return Path(self.cache_dir, f'{digest}-{python}-m{marshal.version}.marshal')
+
+    def load(self, path: Path) -> Any:
+        """Returns the decoded json of the file at path."""
+        path = Path(path).resolve()
+        if path in self._loaded:
+            return self._loaded[path]
+        with open(path, 'rb') as f:
+            data = f.read()
+        result = None
+        if self.cache_dir:
+            cache_path = self._cache_path(hashlib.sha256(data).hexdigest())
+            try:
+                with open(cache_path, 'rb') as f:
+                    # The cache only holds values written by store below.
+                    result = marshal.load(f)  # nosec B302
+                # Mark the entry as recently used for eviction.
+                os.utime(cache_path)
+                _verboseprint3(f'Loaded {path} from {cache_path}')
+            except (OSError, EOFError, ValueError, TypeError):
+                result = None
+        if result is None:
+            result = json.loads(data)
+            if self.cache_dir:
+                self._store(cache_path, result)
+        self._loaded[path] = result
+        return result
+
+    def _store(self, cache_path: Path, value: Any):
+        """Atomically write value to cache_path then evict to the size limit."""
+        tmp_name = None
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(value, f)
+            os.replace(tmp_name, cache_path)
+        except OSError as e:
+            _verboseprint(f'Warning: Unable to write cache {cache_path}: {e}')
+            # Eviction only removes cache entries, not temporary files.
+            if tmp_name:
+                Path(tmp_name).unlink(missing_ok=True)
+            return
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries beyond max_cache_bytes."""
+        entries = []
+        for entry in self.cache_dir.glob('*.marshal'):
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                # Evicted concurrently by another process.
+                continue
+            entries.append((st.st_mtime, st.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_cache_bytes:
+                break
+            _verboseprint2(f'Evicting {entry} from the cache')
+            entry.unlink(missing_ok=True)
+            total -= size
+
+_json_loader = JsonFileLoader()
+_parse_cache: Optional[metric.ParseCache] = None
+
+def _init_caches(cache_dir: Optional[Path], max_cache_bytes: int):
+    """Cache decoded json and parsed metrics in cache_dir, if given."""
+    global _json_loader, _parse_cache
+    _json_loader = JsonFileLoader(cache_dir, max_cache_bytes)
+    _parse_cache = metric.ParseCache(cache_dir) if cache_dir else None
+    metric.SetParseCache(_parse_cache)
+
+def _init_worker(verbose: int, cache_dir: Optional[Path], max_cache_bytes: int):
+    """Initialize a process pool worker with the parent's settings."""
+    global _verbose
+    _verbose = verbose
+    _init_caches(cache_dir, max_cache_bytes)
+
+def _model_to_perf_json(model: 'Model', modeldir: Path):
+    """Generate a model's perf json in a worker then save the metrics it newly parsed."""
+    model.to_perf_json(modeldir)
+    if _parse_cache:
+        _parse_cache.Save()
+
 # Map from a topic to a list of regular expressions with an associated
 # priority. If an event name matches the regular expression then the
 # topic key is its topic unless a different topic matches with a
@@ -180,12 +302,79 @@ _topics: Dict[str, Set[tuple[str, int]]] = {
 # List of strange aux names that don't start with # in expressions.
 _aux_names = ['Num_CPUs', 'Dependent_Loads_Weight', 'DurationTimeInMilliSeconds']
 
-# Sort the matches with the highest priority first to allow the loop
-# to exit early when a lower priority match to the current is found.
-for topic in _topics.keys():
-    _topics[topic] = sorted(_topics[topic],
-                            key=lambda match: (-match[1], match[0]))
+# Map from a non-CPU PMU (aka Unit) to the topic of its events.
+_unit_to_topic: Dict[str, str] = {
+    'cha': 'Uncore-Cache',
+    'chacms': 'Uncore-Cache',
+    'cbox': 'Uncore-Cache',
+    'cbox_0': 'Uncore-Cache',
+    'ha': 'Uncore-Cache',
+    'hac_cbo': 'Uncore-Cache',
+    'b2cxl': 'Uncore-CXL',
+    'cxlcm': 'Uncore-CXL',
+    'cxldp': 'Uncore-CXL',
+    'arb': 'Uncore-Interconnect',
+    'b2cmi': 'Uncore-Interconnect',
+    'b2hot': 'Uncore-Interconnect',
+    'b2upi': 'Uncore-Interconnect',
+    'hac_arb': 'Uncore-Interconnect',
+    'irp': 'Uncore-Interconnect',
+    'm2m': 'Uncore-Interconnect',
+    'mdf': 'Uncore-Interconnect',
+    'r3qpi': 'Uncore-Interconnect',
+    'qpi': 'Uncore-Interconnect',
+    'santa': 'Uncore-Interconnect',
+    'sbox': 'Uncore-Interconnect',
+    'ubox': 'Uncore-Interconnect',
+    'upi': 'Uncore-Interconnect',
+    'm3upi': 'Uncore-Interconnect',
+    'iio': 'Uncore-IO',
+    'iio_free_running': 'Uncore-IO',
+    'm2pcie': 'Uncore-IO',
+    'r2pcie': 'Uncore-IO',
+    'edc_eclk': 'Uncore-Memory',
+    'edc_uclk': 'Uncore-Memory',
+    'imc': 'Uncore-Memory',
+    'imc_free_running': 'Uncore-Memory',
+    'imc_free_running_0': 'Uncore-Memory',
+    'imc_free_running_1': 'Uncore-Memory',
+    'imc_dclk': 'Uncore-Memory',
+    'imc_uclk': 'Uncore-Memory',
+    'm2hbm': 'Uncore-Memory',
+    'mchbm': 'Uncore-Memory',
+    'clock': 'Uncore-Other',
+    'cncu': 'Uncore-Other',
+    'pcu': 'Uncore-Power',
+}
+
+def _compile_topics() -> list[Tuple[re.Pattern, list[str]]]:
+    """
+    Compile _topics into one regular expression per priority level.
 
+    The levels are ordered highest priority first. Each expression is
+    an alternation with a group per topic, in reverse name order as
+    when priorities are equal the topic with the greatest name
+    wins. The matching group's index into the accompanying list of
+    names gives the topic.
+    """
+    priorities = sorted({p for matches in _topics.values() for _, p in matches},
+                        reverse=True)
+    result = []
+    for priority in priorities:
+        names = []
+        alternatives = []
+        for topic in sorted(_topics.keys(), reverse=True):
+            regexps = sorted(r for r, p in _topics[topic] if p == priority)
+            if regexps:
+                alternatives.append(
+                    f'(?P<t{len(names)}>' + '|'.join(f'(?:{r})' for r in regexps) + ')')
+                names.append(topic)
+        result.append((re.compile('|'.join(alternatives)), names))
+    return result
+
+_topic_classifier = _compile_topics()
+
+@functools.lru_cache(maxsize=None)
 def topic(event_name: str, unit: str) -> str:
     """
     Map an event name to its associated topic.
@@ -194,64 +383,16 @@ def topic(event_name: str, unit: str) -> str:
     @param unit: The PMU responsible for the event or None for CPU events.
     """
     if unit and unit not in ['cpu', 'cpu_atom', 'cpu_core', 'cpu_lowpower']:
-        unit_to_topic = {
-            'cha': 'Uncore-Cache',
-            'chacms': 'Uncore-Cache',
-            'cbox': 'Uncore-Cache',
-            'cbox_0': 'Uncore-Cache',
-            'ha': 'Uncore-Cache',
-            'hac_cbo': 'Uncore-Cache',
-            'b2cxl': 'Uncore-CXL',
-            'cxlcm': 'Uncore-CXL',
-            'cxldp': 'Uncore-CXL',
-            'arb': 'Uncore-Interconnect',
-            'b2cmi': 'Uncore-Interconnect',
-            'b2hot': 'Uncore-Interconnect',
-            'b2upi': 'Uncore-Interconnect',
-            'hac_arb': 'Uncore-Interconnect',
-            'irp': 'Uncore-Interconnect',
-            'm2m': 'Uncore-Interconnect',
-            'mdf': 'Uncore-Interconnect',
-            'r3qpi': 'Uncore-Interconnect',
-            'qpi': 'Uncore-Interconnect',
-            'santa': 'Uncore-Interconnect',
-            'sbox': 'Uncore-Interconnect',
-            'ubox': 'Uncore-Interconnect',
-            'upi': 'Uncore-Interconnect',
-            'm3upi': 'Uncore-Interconnect',
-            'iio': 'Uncore-IO',
-            'iio_free_running': 'Uncore-IO',
-            'm2pcie': 'Uncore-IO',
-            'r2pcie': 'Uncore-IO',
-            'edc_eclk': 'Uncore-Memory',
-            'edc_uclk': 'Uncore-Memory',
-            'imc': 'Uncore-Memory',
-            'imc_free_running': 'Uncore-Memory',
-            'imc_free_running_0': 'Uncore-Memory',
-            'imc_free_running_1': 'Uncore-Memory',
-            'imc_dclk': 'Uncore-Memory',
-            'imc_uclk': 'Uncore-Memory',
-            'm2hbm': 'Uncore-Memory',
-            'mchbm': 'Uncore-Memory',
-            'clock': 'Uncore-Other',
-            'cncu': 'Uncore-Other',
-            'pcu': 'Uncore-Power',
-        }
-        if unit.lower() not in  unit_to_topic:
+        if unit.lower() not in _unit_to_topic:
             raise ValueError(f'Unexpected PMU (aka Unit): {unit}')
-        return unit_to_topic[unit.lower()]
-
-    result = None
-    result_priority = -1
-    for topic in sorted(_topics.keys()):
-        for regexp, priority in _topics[topic]:
-            if re.match(regexp, event_name) and priority >= result_priority:
-                result = topic
-                result_priority = priority
-            if priority < result_priority:
-                break
+        return _unit_to_topic[unit.lower()]
+
+    for regexp, names in _topic_classifier:
+        m = regexp.match(event_name)
+        if m:
+            return names[int(m.lastgroup[1:])]
 
-    return result if result else 'Other'
+    return 'Other'
 
 def freerunning_counter_type_and_index(shortname: str,
                                        pmu: str,
@@ -287,13 +428,277 @@ def freerunning_counter_type_and_index(shortname: str,
     return (type, index)
 
 
+# Bit of fixed counter 0 in a counter bitmask. As in
+# IA32_PERF_GLOBAL_CTRL, generic counter n is bit n and fixed counter
+# n is bit 32 + n, which is how Counter values like "36" and
+# PDISTCounter values like "32" name fixed counters.
+FIXED_COUNTER_SHIFT = 32
+GENERIC_COUNTERS = (1 << FIXED_COUNTER_SHIFT) - 1
+
+@functools.lru_cache(maxsize=None)
+def counter_bitmask(counter: Optional[str]) -> int:
+    """
+    Parse a Counter or PDISTCounter value into a bitmask of counters.
+
+    Values list counters, like "0,1,2,3" or "0-3", or name a fixed
+    counter, like "Fixed counter 1" or "FIXED" for a unit's only fixed
+    counter. Missing and "NA" values have no counters.
+    """
+    if not counter or counter.lower() == 'na':
+        return 0
+    mask = 0
+    for part in counter.split(','):
+        part = part.strip()
+        if part.lower().startswith('fixed'):
+            index = part.split(' ')[-1]
+            mask |= 1 << (FIXED_COUNTER_SHIFT + (int(index) if index.isnumeric() else 0))
+        elif '-' in part:
+            first, last = part.split('-')
+            mask |= ((1 << (int(last) + 1)) - 1) & ~((1 << int(first)) - 1)
+        else:
+            mask |= 1 << int(part)
+    return mask
+
+
+@functools.lru_cache(maxsize=4096)
+def counters_fit(bitmasks: Tuple[int, ...], capacity: int) -> bool:
+    """
+    Whether events, that may use the counters of their bitmasks, can be
+    counted together on a unit with the capacity bitmask of counters.
+    Events with an empty bitmask, like topdown metrics, need no counter.
+    Sorting bitmasks helps the cache as their order doesn't matter.
+    """
+    # Match events to counters with augmenting paths, most constrained first.
+    owner: Dict[int, int] = {}
+
+    def place(event: int, seen: Set[int]) -> bool:
+        available = bitmasks[event] & capacity
+        while available:
+            bit = available & -available
+            available ^= bit
+            if bit in seen:
+                continue
+            seen.add(bit)
+            if bit not in owner or place(owner[bit], seen):
+                owner[bit] = event
+                return True
+        return False
+
+    order = sorted((i for i, m in enumerate(bitmasks) if m),
+                   key=lambda i: bin(bitmasks[i] & capacity).count('1'))
+    return all(place(i, set()) for i in order)
+
+
+def parse_event(event: str) -> Tuple[Optional[str], str, Dict[str, str], str]:
+    """
+    Parse an event, as written in a perf json metric, into its PMU, if
+    any, unescaped name, terms and modifiers. For example,
+    cpu@INST_RETIRED.ANY\\,cmask\\=1@k becomes ('cpu',
+    'INST_RETIRED.ANY', {'cmask': '1'}, 'k') and a raw event like
+    uncore_cha_0@event\\=0x1@ has an empty name.
+    """
+    pmu = None
+    modifiers = ''
+    terms: list[str] = []
+    if '@' in event:
+        first, body, modifiers = event.split('@', 2)
+        terms = body.split('\\,')
+        if first.islower():
+            pmu = first
+            name = '' if '\\=' in terms[0] else terms.pop(0)
+        else:
+            name = first
+    else:
+        name, _, modifiers = event.partition(':')
+    name, _, name_modifiers = name.partition(':')
+    terms_dict = {}
+    for term in terms:
+        key, _, value = term.replace('\\', '').partition('=')
+        terms_dict[key] = value
+    return pmu, name.replace('\\', ''), terms_dict, name_modifiers + modifiers.lstrip(':')
+
+
+def split_event(event: str) -> Tuple[Optional[str], str]:
+    """
+    Split an event, as written in a perf json metric, into its PMU, if
+    any, and its unescaped name without terms or modifiers. For
+    example, cpu@INST_RETIRED.ANY\\,cmask\\=1@ becomes ('cpu',
+    'INST_RETIRED.ANY') and UNC_CHA_TOR_OCCUPANCY.IA_MISS@thresh\\=1@
+    becomes (None, 'UNC_CHA_TOR_OCCUPANCY.IA_MISS').
+    """
+    pmu, name, _, _ = parse_event(event)
+    return pmu, name
+
+
+@dataclass(frozen=True)
+class EventCounters:
+    """The unit, as in counter.json, and counters an event is counted on."""
+    unit: str
+    # Counters the event may use, empty if it needs none.
+    bitmask: int
+    uncore: bool
+
+
+# Counters of core events perf defines that aren't in the event json.
+_perf_core_event_counters = {
+    'cycles': GENERIC_COUNTERS | 1 << (FIXED_COUNTER_SHIFT + 1),
+    'instructions': GENERIC_COUNTERS | 1 << FIXED_COUNTER_SHIFT,
+    'cycles-t': GENERIC_COUNTERS,
+    'cycles-ct': 1 << 2,
+    'tx-start': GENERIC_COUNTERS,
+    'el-start': GENERIC_COUNTERS,
+}
+
+
+class CounterTable:
+    """
+    The counters of a model's units and events, as written to
+    counter.json and event-counters.csv, used to place the events of
+    metrics on counters.
+    """
+
+    def __init__(self):
+        # Maps units to the bitmask of their counters.
+        self.units: Dict[str, int] = {}
+        # Maps upper case event names to their counters on each unit.
+        self.events: DefaultDict[str, list[EventCounters]] = collections.defaultdict(list)
+
+    def add_unit(self, unit: str, num_fixed: int, num_generic: int):
+        self.units[unit] = ((1 << num_generic) - 1) | \
+            ((1 << num_fixed) - 1) << FIXED_COUNTER_SHIFT
+
+    def add_event(self, name: str, unit: str, bitmask: int, uncore: bool):
+        self.events[name.upper()].append(EventCounters(unit, bitmask, uncore))
+
+    def placement(self, event: str, unit: Optional[str] = None) -> Optional[EventCounters]:
+        """
+        Where an event, as written in a perf json metric, is counted. The
+        metric's unit chooses between the core PMUs of hybrid models. None
+        for events, like msr@tsc@ or duration_time, not counted on a unit.
+        """
+        pmu, name = split_event(event)
+        core_unit = next((u for u in [pmu, unit, 'core', 'cpu_core'] if u in self.units), 'core')
+        candidates = self.events.get(name.upper())
+        if candidates:
+            result = next((c for c in candidates if c.unit == (pmu or unit)), candidates[0])
+        elif pmu is None and name in _perf_core_event_counters:
+            result = EventCounters(core_unit, _perf_core_event_counters[name], False)
+        elif pmu is None and name.startswith('topdown-'):
+            # Read from the PERF_METRICS of the slots fixed counter.
+            result = EventCounters(core_unit, 0, False)
+        elif pmu in ['cpu', 'cpu_core', 'cpu_atom']:
+            result = EventCounters(core_unit, GENERIC_COUNTERS, False)
+        elif pmu:
+            pmu_unit = re.sub(r'^uncore_|_\d+$', '', pmu).lower()
+            pmu_unit = next((u for u in self.units if u.lower() == pmu_unit), pmu_unit)
+            result = EventCounters(pmu_unit, GENERIC_COUNTERS, pmu.startswith('uncore_'))
+        else:
+            return None
+        return result if result.unit in self.units else None
+
+    def min_groups(self, placements: list[EventCounters]) -> int:
+        """
+        The number of groups, packed first fit with the most constrained
+        events first, needed to count events on their units' counters.
+        """
+        groups: DefaultDict[str, list[Tuple[int, ...]]] = collections.defaultdict(list)
+        for p in sorted(placements, key=lambda p: (p.unit, bin(p.bitmask).count('1'))):
+            if not p.bitmask:
+                continue
+            unit_groups = groups[p.unit]
+            for i, group in enumerate(unit_groups):
+                merged = tuple(sorted(group + (p.bitmask,)))
+                if counters_fit(merged, self.units[p.unit]):
+                    unit_groups[i] = merged
+                    break
+            else:
+                unit_groups.append((p.bitmask,))
+        return sum(len(g) for g in groups.values())
+
+
+class _EventNames(metric.ExpressionVisitor):
+    """The names, as written in perf json, of the events within an expression."""
+
+    def VisitOperator(self, expr, lhs, rhs):
+        return lhs | rhs
+
+    def VisitSelect(self, expr, true_val, cond, false_val):
+        return true_val | cond | false_val
+
+    def VisitFunction(self, expr, lhs, rhs):
+        return lhs | rhs if rhs is not None else lhs
+
+    def VisitEvent(self, expr):
+        return frozenset([expr.ToPerfJson()])
+
+    def VisitConstant(self, expr):
+        return frozenset()
+
+    def VisitLiteral(self, expr):
+        return frozenset()
+
+
+def metric_events(metrics: list[Dict[str, str]],
+                  parsed: Optional[Dict[Tuple[Optional[str], str], metric.Expression]] = None
+                  ) -> list[FrozenSet[str]]:
+    """
+    The events, as written in perf json, each perf json metric reads
+    including those of the metrics it refers to. References are to
+    metrics of the same Unit. parsed holds already parsed MetricExprs
+    by Unit and lower case MetricName.
+    """
+    by_name = {(m.get('Unit'), m['MetricName'].lower()): m for m in metrics}
+    parsed = parsed or {}
+    resolved: Dict[Tuple[Optional[str], str], FrozenSet[str]] = {}
+
+    def resolve(key: Tuple[Optional[str], str], referencing: FrozenSet[str]) -> FrozenSet[str]:
+        if key[1] in referencing:
+            raise ValueError(f'Metric {key[1]} refers to itself')
+        if key not in resolved:
+            result: Set[str] = set()
+            expr = parsed.get(key) or metric.ParsePerfJson(by_name[key]['MetricExpr'])
+            for event in _EventNames().Visit(expr):
+                for reference in [(key[0], event.lower()), (None, event.lower())]:
+                    if reference in by_name:
+                        result |= resolve(reference, referencing | {key[1]})
+                        break
+                else:
+                    result.add(event)
+            resolved[key] = frozenset(result)
+        return resolved[key]
+
+    return [resolve((m.get('Unit'), m['MetricName'].lower()), frozenset()) for m in metrics]
+
+
+# Json values treated as missing.
+_drop_values = frozenset(['0', '0x0', '0x00', 'na', 'null', 'tbd'])
+# Replacements for the non-ascii characters in event json strings.
+_json_value_translation = str.maketrans({
+    '\xae': '(R)',
+    '\u2122': '(TM)',
+    '\uFEFF': None,
+})
+
 class PerfmonJsonEvent:
     """Representation of an event loaded from a perfmon json file dictionary."""
 
+    # Attributes in the order they are initialized, which is the order
+    # they are printed by __str__.
+    __slots__ = (
+        'experimental', 'event_name', 'any_thread', 'counter_mask', 'data_la',
+        'deprecated', 'edge_detect', 'errata', 'event_code', 'ext_sel',
+        'fc_mask', 'filter', 'filter_value', 'invert', 'msr_index',
+        'msr_value', 'pebs', 'port_mask', 'sample_after_value', 'umask',
+        'unit', 'counter', 'counters_bitmask', 'brief_description',
+        'public_description', 'pdist_bitmask', 'topic',
+    )
+
     @staticmethod
     def fix_name(name: str) -> str:
         if name.startswith('OFFCORE_RESPONSE_0'):
             return name.replace('OFFCORE_RESPONSE_0', 'OFFCORE_RESPONSE')
+        if not name.startswith('OFFCORE_RESPONSE:'):
+            return name
         m = re.match(r'OFFCORE_RESPONSE:request=(.*):response=(.*)', name)
         if m:
             return f'OFFCORE_RESPONSE.{m.group(1)}.{m.group(2)}'
@@ -302,15 +707,16 @@ class PerfmonJsonEvent:
     def __init__(self, shortname: str, unit: str, jd: Dict[str, str], experimental: bool):
         """Constructor passed the dictionary of parsed json values."""
         def get(key: str) -> str:
-            drop_keys = {'0', '0x0', '0x00', 'na', 'null', 'tbd'}
             result = jd.get(key)
             # For the Counter field, value '0' is reasonable
-            if not result or result in drop_keys:
+            if not result or result in _drop_values:
                 return None
-            result = re.sub(r'\xae', '(R)', result.strip())
-            result = re.sub(r'\u2122', '(TM)', result)
-            result = re.sub(r'\uFEFF', '', result)
-            result = re.sub(r'\?\?\?', '?', result)
+            result = result.strip()
+            # Most values are plain ascii without trigraphs.
+            if not result.isascii():
+                result = result.translate(_json_value_translation)
+            if '???' in result:
+                result = result.replace('???', '?')
             return result
 
         self.experimental = experimental
@@ -336,6 +742,9 @@ class PerfmonJsonEvent:
         self.umask = get('UMask')
         self.unit = get('Unit')
         self.counter = jd.get('Counter').strip()
+        # Free running counters can't be programmed with other events.
+        self.counters_bitmask = 0 if jd.get('CounterType') == 'FREERUN' else \
+            counter_bitmask(self.counter)
         # Sanity check certain old perfmon keys or values that could
         # be used in perf json don't exist.
         assert 'Internal' not in jd
@@ -442,10 +851,10 @@ class PerfmonJsonEvent:
         if not self.public_description:
             self.public_description = get('Description')
 
-        if "PDISTCounter" in jd:
-            pdist_counter = jd.get('PDISTCounter').strip()
-            if pdist_counter != 'NA':
-                self.public_description += " Available PDIST counters: " + pdist_counter
+        self.pdist_bitmask = counter_bitmask(jd.get('PDISTCounter', '').strip())
+        if self.pdist_bitmask:
+            self.public_description += " Available PDIST counters: " + \
+                jd['PDISTCounter'].strip()
 
         # The public description is the longer, if it is already
         # contained within or equals the brief description then it is
@@ -467,11 +876,12 @@ class PerfmonJsonEvent:
     def __str__(self) -> str:
         result = ''
         first = True
-        for item in vars(self).items():
-            if item[1]:
+        for slot in PerfmonJsonEvent.__slots__:
+            value = getattr(self, slot)
+            if value:
                 if not first:
                     result += ', '
-                result += f'{item[0]}: {item[1]}'
+                result += f'{slot}: {value}'
             first = False
         return result
 
@@ -520,13 +930,325 @@ class PerfmonJsonEvent:
             add_to_result("Experimental", '1')
         return result
 
-def rewrite_metrics_in_terms_of_others(metrics: list[Dict[str,str]]) -> list[Dict[str,str]]:
+class TmaSpreadsheet:
+    """
+    A TMA metrics CSV file, such as TMA_Metrics-full.csv, parsed once.
+
+    The spreadsheet has a column per TMA CPU. Where a CPU's cell is
+    empty the formula is taken from the first non-empty cell in a
+    fallback chain of older CPUs. The resolved formulas for each row
+    are computed once per chain and shared by all models using it.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        # Map from the column heading to the list index of that column.
+        self.col_heading: Dict[str, int] = {}
+        # A list of topdown levels such as 'Level1'.
+        self.levels: list[str] = []
+        # The rows following the 'Key' row of column headings.
+        self.rows: list[list[str]] = []
+        # Map from a fallback chain of CPU columns to the resolved
+        # formula of every row.
+        self._forms: Dict[Tuple[str, ...], list[str]] = {}
+        with open(path, 'r') as csvfile:
+            self.version4 = csvfile.readline().startswith('TMA,Version,4.7-full')
+            found_key = False
+            for l in csv.reader(csvfile):
+                if found_key:
+                    self.rows.append(l)
+                elif l[0] == 'Key':
+                    found_key = True
+                    for ind, name in enumerate(l):
+                        self.col_heading[name] = ind
+                        if name.startswith('Level'):
+                            self.levels.append(name)
+        _verboseprint3(f'Columns: {self.col_heading}. Levels: {self.levels}')
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def load(path: Path) -> 'TmaSpreadsheet':
+        """Returns the spreadsheet at path, parsing it only on first use."""
+        _verboseprint2(f'Parsing TMA spreadsheet {path}')
+        return TmaSpreadsheet(path)
+
+    def field(self, row: int, x: str) -> str:
+        """Given the name of a column, return the value in that row."""
+        assert x in self.col_heading, f"Expected {x} in {self.col_heading}"
+        return self.rows[row][self.col_heading[x]].strip()
+
+    def forms(self, chain: Tuple[str, ...]) -> list[str]:
+        """
+        The formula of every row taken from the first non-empty column of chain.
+
+        @param chain: TMA CPU column names in fallback order.
+        """
+        if chain not in self._forms:
+            result = []
+            for row in range(len(self.rows)):
+                cell = ''
+                for cpu in chain:
+                    cell = self.field(row, cpu)
+                    if cell:
+                        break
+                result.append(cell)
+            self._forms[chain] = result
+        return self._forms[chain]
+
+
+# Replacements of TMA spreadsheet events, per model, by their perf
+# equivalent.
+_td_event_fixups = [
+    ('PERF_METRICS.BACKEND_BOUND', r'topdown\-be\-bound'),
+    ('PERF_METRICS.BAD_SPECULATION', r'topdown\-bad\-spec'),
+    ('PERF_METRICS.BRANCH_MISPREDICTS', r'topdown\-br\-mispredict'),
+    ('PERF_METRICS.FETCH_LATENCY', r'topdown\-fetch\-lat'),
+    ('PERF_METRICS.FRONTEND_BOUND', r'topdown\-fe\-bound'),
+    ('PERF_METRICS.HEAVY_OPERATIONS', r'topdown\-heavy\-ops'),
+    ('PERF_METRICS.MEMORY_BOUND', r'topdown\-mem\-bound'),
+    ('PERF_METRICS.RETIRING', r'topdown\-retiring'),
+    ('TOPDOWN.SLOTS:perf_metrics', 'TOPDOWN.SLOTS'),
+    ('TOPDOWN.SLOTS:percore', 'TOPDOWN.SLOTS'),
+]
+_hsx_uncore_fixups = [
+    ('UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182:c1',
+     r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
+    ('UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182',
+     r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
+    ('UNC_C_TOR_INSERTS.MISS_OPCODE:opc=0x182',
+     r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
+    ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
+]
+_power_uncore_fixups = [
+    ('UNC_PKG_ENERGY_STATUS', r'power@energy\-pkg@'),
+    ('FREERUN_PKG_ENERGY_STATUS', r'power@energy\-pkg@'),
+    ('FREERUN_DRAM_ENERGY_STATUS', r'power@energy\-ram@'),
+]
+_arch_fixups = {
+    'ADL': _td_event_fixups + [
+        ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
+    ],
+    'ARL': _td_event_fixups + [
+        ('IDQ.MITE_UOPS:c8:i1:eq1',
+         r'cpu_core@IDQ.MITE_UOPS\,cmask\=0x8\,inv\=0x1@'),
+        ('IDQ.DSB_UOPS:c8:i1:eq1',
+         r'cpu_core@IDQ.DSB_UOPS\,cmask\=0x8\,inv\=0x1@'),
+        ('LSD.UOPS:c8:i1:eq1',
+         r'cpu_core@LSD.UOPS\,cmask\=0x8\,inv\=0x1@'),
+    ],
+    'BDW-DE': _hsx_uncore_fixups,
+    'BDX': _hsx_uncore_fixups,
+    'CLX': [
+        ('UNC_M_CLOCKTICKS:one_unit', r'imc_0@event\=0x0@'),
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+    ],
+    'EMR': [
+        ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
+         'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+    ] + _td_event_fixups,
+    'GNR': [
+        ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
+         'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+    ] + _td_event_fixups,
+    'HSX': _hsx_uncore_fixups,
+    'ICL': _td_event_fixups,
+    'ICX': [
+        ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
+         'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+    ] + _td_event_fixups,
+    'IVT': [
+        ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182"',
+         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
+        ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182:c1"',
+         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
+        ('"UNC_C_TOR_INSERTS.MISS_OPCODE/Match=0x182"',
+         r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
+        ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
+    ],
+    'JKT': [
+        ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182"',
+         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
+        ('"UNC_C_TOR_INSERTS.MISS_OPCODE/Match=0x182"',
+         r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
+        ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182:c1"',
+         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
+        ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
+    ],
+    'LNL': _td_event_fixups + [
+        ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
+        ('IDQ.MITE_UOPS:c8:i1:eq1',
+         r'cpu_core@IDQ.MITE_UOPS\,cmask\=0x8\,inv\=0x1@'),
+        ('IDQ.DSB_UOPS:c8:i1:eq1',
+         r'cpu_core@IDQ.DSB_UOPS\,cmask\=0x8\,inv\=0x1@'),
+        ('LSD.UOPS:c8:i1:eq1',
+         r'cpu_core@LSD.UOPS\,cmask\=0x8\,inv\=0x1@'),
+    ],
+    'MTL': _td_event_fixups + [
+        ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
+    ],
+    'RKL': _td_event_fixups + [
+        ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
+    ],
+    'SKL': [
+        ('UNC_ARB_TRK_OCCUPANCY.DATA_READ:c1',
+         r'UNC_ARB_TRK_OCCUPANCY.DATA_READ@cmask\=1@'),
+    ],
+    'SKX': [
+        ('UNC_M_CLOCKTICKS:one_unit', r'imc_0@event\=0x0@'),
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+    ],
+    'SNB' :[
+        ('MEM_LOAD_UOPS_RETIRED.LLC_MISS', 'MEM_LOAD_UOPS_MISC_RETIRED.LLC_MISS'),
+    ],
+    'SPR': [
+        ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
+        ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
+         r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
+        ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
+         'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
+    ] + _td_event_fixups,
+    'TGL': [
+        ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
+    ] + _td_event_fixups,
+}
+
+
+class TmaFormulaFixer:
+    """
+    Rewrites TMA spreadsheet formulas into perf's event syntax.
+
+    The replacements and regular expressions depend on the model and
+    PMU prefix and are compiled once when the fixer is constructed.
+    """
+
+    # A TMA spreadsheet event name, such as INST_RETIRED.ANY.
+    _event_pattern = r'[A-Z0-9_.]+'
+    # Terms already added to an event, such as \,cmask\=1.
+    _term_pattern = r'[a-z0-9\\=,]+'
+    # Simple string cleanups, applied in order. Arithmetic, such as
+    # adding 0, is left to metric.Expression.Simplify.
+    _cleanups = [
+        ('( ', '('),
+        (' )', ')'),
+        (' , ', ', '),
+        ('  ', ' '),
+    ]
+    # A whole event-like token not already within a PMU prefix, with
+    # any following ':' before a modifier letter.
+    _token = re.compile(r'(?<![@A-Za-z0-9_.])([A-Za-z0-9_.]+)(:(?=[A-Za-z]))?')
+
+    def __init__(self, shortname: str, pmu_prefix: str,
+                 events: Dict[str, 'PerfmonJsonEvent']):
+        self.pmu_prefix = pmu_prefix
+        # Upper case names of the core PMU events that on hybrid models
+        # are rewritten into the pmu_prefix@event@ form.
+        self.prefixed_events = frozenset()
+        if pmu_prefix != 'cpu':
+            self.prefixed_events = frozenset(
+                name for name, event in events.items() if event.unit.startswith('cpu'))
+        # Map from a spreadsheet event to its replacement. When an event
+        # appears twice the first replacement is used.
+        self.replacements: Dict[str, str] = {}
+        for j, r in _arch_fixups.get(shortname, []) + _power_uncore_fixups:
+            for i in range(0, len(r)):
+                if r[i] in ['-', '=', ',']:
+                    assert i == 0 or r[i - 1] == '\\', r
+            if pmu_prefix != 'cpu' and r.startswith(r'topdown\-'):
+                r = rf'{pmu_prefix}@{r}@'
+            self.replacements.setdefault(j, r)
+        # Replace all events in a single pass, trying longer events
+        # first as some events are prefixes of others. _PS suffixes are
+        # dropped and :USER and :SUP modifiers shortened.
+        self.replacements_re = re.compile('|'.join(
+            [re.escape(j) for j in sorted(self.replacements, key=len, reverse=True)] +
+            ['_PS', '(?i::USER)', '(?i::SUP)']))
+        event_pattern = TmaFormulaFixer._event_pattern
+        term_pattern = TmaFormulaFixer._term_pattern
+        self.modifiers = [(re.compile(match, re.IGNORECASE), replacement)
+                          for match, replacement in [
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:sup', rf'{pmu_prefix}@\1@k'),
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:user', rf'{pmu_prefix}@\1@u'),
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:c(\d+)', rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:u0x([A-Fa-f0-9]+)',
+             rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:i1', rf'{pmu_prefix}@\1\\,inv@'),
+            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
+             r')@:e1', rf'{pmu_prefix}@\1\\,edge@'),
+            ('(' + event_pattern + rf'):sup',
+             rf'{pmu_prefix}@\1@k'),
+            ('(' + event_pattern + rf'):user',
+             rf'{pmu_prefix}@\1@u'),
+            ('(' + event_pattern + rf'):i1',
+             rf'{pmu_prefix}@\1\\,inv@'),
+            ('(' + event_pattern + rf'):c(\d+)',
+             rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
+            ('(' + event_pattern + rf'):u((0x[a-fA-F0-9]+|\d+))',
+             rf'{pmu_prefix}@\1\\,umask\\=\2@'),
+            ('(' + event_pattern + rf'):e1',
+             rf'{pmu_prefix}@\1\\,edge@'),
+        ]]
+
+    def _replace(self, m: re.Match) -> str:
+        s = m.group(0)
+        if s in self.replacements:
+            return self.replacements[s]
+        if s == '_PS':
+            return ''
+        return ':u' if s.lower() == ':user' else ':k'
+
+    def _prefix_event(self, m: re.Match) -> str:
+        name = m.group(1).upper()
+        if name not in self.prefixed_events:
+            return m.group(0)
+        return f'{self.pmu_prefix}@{name}@'
+
+    def fixup(self, form: str) -> str:
+        """Returns form rewritten with perf events and modifiers."""
+        form = self.replacements_re.sub(self._replace, form)
+        for before, after in TmaFormulaFixer._cleanups:
+            form = form.replace(before, after)
+
+        # All modifiers follow a ':'. Rewrite until no more apply as
+        # events may have more than one.
+        changed = ':' in form
+        while changed:
+            changed = False
+            for match, replacement in self.modifiers:
+                new_form = match.sub(replacement, form)
+                changed = changed or new_form != form
+                form = new_form
+
+        if self.prefixed_events:
+            form = TmaFormulaFixer._token.sub(self._prefix_event, form)
+
+        return form
+
+
+def rewrite_metrics_in_terms_of_others(metrics: list[Dict[str, Any]]) -> list[Dict[str, Any]]:
     parsed: list[Tuple[str, metric.Expression]] = []
     for m in metrics:
         name = m['MetricName']
-        form = m['MetricExpr']
-        parsed.append((name, metric.ParsePerfJson(form)))
-        if name == 'tma_info_core_core_clks' and '#SMT_on' in form:
+        expr = m['MetricExpr']
+        parsed.append((name, expr))
+        if name == 'tma_info_core_core_clks' and '#SMT_on' in expr.ToPerfJson():
             # Add non-EBS form of CORE_CLKS to enable better
             # simplification of Valkyrie metrics.
             form = 'CPU_CLK_UNHALTED.THREAD_ANY / 2 if #SMT_on else CPU_CLK_UNHALTED.THREAD'
@@ -538,9 +1260,53 @@ def rewrite_metrics_in_terms_of_others(metrics: list[Dict[str,str]]) -> list[Dic
             name = m['MetricName']
             if name in updates:
                 _verboseprint2(f'Updated {name} from\n"{m["MetricExpr"]}"\nto\n"{updates[name]}"')
-                m['MetricExpr'] = updates[name].ToPerfJson()
+                m['MetricExpr'] = updates[name]
     return metrics
 
+
+class _EventSubstituter(metric.ExpressionTransformer):
+    """Replaces every event with a given name."""
+    def __init__(self, name: str, replacement: metric.Event):
+        super().__init__()
+        self.name = name
+        self.replacement = replacement
+
+    def VisitEvent(self, expr: metric.Event) -> metric.Expression:
+        return self.replacement if expr.name == self.name else expr
+
+
+def substitute_event(expr: metric.Expression, name: str,
+                     replacement: metric.Event) -> metric.Expression:
+    """Returns expr with every event called name replaced."""
+    return _EventSubstituter(name, replacement).Visit(expr)
+
+
+class _PebsRewriter(metric.ExpressionTransformer):
+    """Replaces PEBS, parsed from $PEBS, with the retire latency of the event it multiplies."""
+    @staticmethod
+    def MakeTpebs(event: str) -> metric.Event:
+        return metric.Event.Verbatim(f'{event}R' if event.endswith('@') else f'{event}:R')
+
+    def Replace(self, expr: metric.Expression) -> Optional[metric.Expression]:
+        # Other operators, selects and functions have their operands
+        # rewritten.
+        if not isinstance(expr, metric.Operator) or expr.operator != '*':
+            return None
+        if not isinstance(expr.lhs, metric.Event):
+            return None
+        lhs_event = expr.lhs
+        if isinstance(expr.rhs, metric.Event):
+            if expr.rhs.name == 'PEBS':
+                return metric.Operator('*', lhs_event, self.MakeTpebs(lhs_event.name))
+            return expr
+        fn = expr.rhs
+        if (isinstance(fn, metric.Function) and fn.fn in ('min', 'max') and
+                isinstance(fn.lhs, metric.Event) and fn.lhs.name == 'PEBS'):
+            return metric.Operator('*', lhs_event,
+                                   metric.Function(fn.fn, self.MakeTpebs(lhs_event.name), fn.rhs))
+        return None
+
+
 class Model:
     """
     Data related to 1 CPU model such as Skylake or Broadwell.
@@ -573,6 +1339,21 @@ class Model:
         return f'{self.shortname} / {self.longname}\n\tmodels={self.models}\n\tfiles:\n\t\t' + \
             '\n\t\t'.join([f'{type} = {path}' for (type, path) in self.files.items()])
 
+    def input_digest(self, scripts: list[Path]) -> str:
+        """
+        Hash of everything the generated json for this model depends upon.
+
+        @param scripts: generator sources whose changes invalidate the output.
+        """
+        h = hashlib.sha256()
+        h.update(f'{self.shortname},{self.longname},{self.version}'.encode())
+        for kind, paths in sorted(self.files.items()):
+            for path in paths if isinstance(paths, list) else [paths]:
+                h.update(f'\n{kind},{path.name},{_file_digest(path)}'.encode())
+        for script in scripts:
+            h.update(f'\n{script.name},{_file_digest(script)}'.encode())
+        return h.hexdigest()
+
     def mapfile_line(self) -> str:
         """
         Generates a line for this model in Linux perf style CSV.
@@ -624,7 +1405,7 @@ class Model:
                 for x in core_cstates:
                     formula = metric.ParsePerfJson(f'cstate_core@c{x}\\-residency@ / TSC')
                     result.append({
-                        'MetricExpr': formula.ToPerfJson(),
+                        'MetricExpr': formula,
                         'MetricGroup': 'Power',
                         'BriefDescription': f'C{x} residency percent per core',
                         'MetricName': f'C{x}_Core_Residency',
@@ -633,7 +1414,7 @@ class Model:
                 for x in pkg_cstates:
                     formula = metric.ParsePerfJson(f'cstate_pkg@c{x}\\-residency@ / TSC')
                     result.append({
-                        'MetricExpr': formula.ToPerfJson(),
+                        'MetricExpr': formula,
                         'MetricGroup': 'Power',
                         'BriefDescription': f'C{x} residency percent per package',
                         'MetricName': f'C{x}_Pkg_Residency',
@@ -699,48 +1480,9 @@ class Model:
 
 
     @staticmethod
-    def extract_pebs_formula(formula: str) -> str:
-        """
-        Convert metric formulas using $PEBS.
-
-        Example:
-            Input:  MEM_INST_RETIRED.STLB_HIT_LOADS*min($PEBS, 7) / tma_info_thread_clks + tma_load_stlb_miss
-            Return: MEM_INST_RETIRED.STLB_HIT_LOADS * min(MEM_INST_RETIRED.STLB_HIT_LOADS:R, 7) / tma_info_thread_clks + tma_load_stlb_miss
-        """
-        py = re.sub(r'\$PEBS', 'PEBS', formula)
-        expr = metric.ParsePerfJson(py)
-
-        def RewritePebsExpr(expr: metric.Expression):
-            def MakeTpebs(event: str) -> str:
-                return f'{event}R' if event.endswith('@') else f'{event}:R'
-            if isinstance(expr, metric.Operator):
-                op = cast(metric.Operator, expr)
-                if op.operator == '*':
-                    if isinstance(op.lhs, metric.Event) and isinstance(op.rhs, metric.Event):
-                        lhs_event = cast(metric.Event, op.lhs)
-                        rhs_event = cast(metric.Event, op.rhs)
-                        if rhs_event.name == 'PEBS':
-                            rhs_event.name = MakeTpebs(lhs_event.name)
-                        return expr
-                    if isinstance(op.lhs, metric.Event) and isinstance(op.rhs, metric.Function):
-                        lhs_event = cast(metric.Event, op.lhs)
-                        fn = cast(metric.Function, op.rhs)
-                        if isinstance(fn.lhs, metric.Event) and (fn.fn == 'min' or fn.fn == 'max'):
-                            rhs_lhs_event = cast(metric.Event, fn.lhs)
-                            if rhs_lhs_event.name == 'PEBS':
-                                rhs_lhs_event.name = MakeTpebs(lhs_event.name)
-                            else:
-                                RewritePebsExpr(op.rhs)
-                            return expr
-                RewritePebsExpr(op.lhs)
-                RewritePebsExpr(op.rhs)
-            if isinstance(expr, metric.Function):
-                fn = cast(metric.Function, expr)
-                RewritePebsExpr(fn.lhs)
-                RewritePebsExpr(fn.rhs)
-            return expr
-            # TODO: possibly rewrite Select and other special operators.
-        return RewritePebsExpr(expr).ToPerfJson()
+    def rewrite_pebs(expr: metric.Expression) -> metric.Expression:
+        """Rewrite PEBS events, parsed from $PEBS, to the retire latency of the event they multiply."""
+        return _PebsRewriter().Visit(expr)
 
 
     def save_form(self, name: str, group: str, form: str, desc: str, locate: str,
@@ -748,7 +1490,7 @@ class Model:
                   issues: list[str], pmu_prefix: str, events: Dict[str, PerfmonJsonEvent],
                   infoname : Dict[str, str], aux : Dict[str, str],
                   issue_to_metrics: Dict[str, Set[str]],
-                  saved_formulas: list[Dict[str, str]]):
+                  saved_formulas: list[Dict[str, Any]]):
 
         missing_events = {
             'ARL': ['L1D.REPLACEMENT', 'UNC_ARB_TRK_REQUESTS.ALL'],
@@ -804,7 +1546,7 @@ class Model:
         if len(dups) > 0:
             assert len(dups) == 1
             m = dups[0]
-            if form != m['MetricExpr']:
+            if form != str(m['MetricExpr']):
                 _verboseprint2(f'duplicate metric {name} forms differ'
                                f'\n\tnew: {form}'
                                f'\n\texisting: {m["MetricExpr"]}')
@@ -840,10 +1582,12 @@ class Model:
 
         try:
             if "$PEBS" in form:
-                form = self.extract_pebs_formula(form)
+                expr = self.rewrite_pebs(metric.ParsePerfJson(form.replace('$PEBS', 'PEBS')))
+            else:
+                expr = metric.ParsePerfJson(form)
             formula = {
                 'MetricName': name,
-                'MetricExpr': metric.ParsePerfJson(form).Simplify().ToPerfJson(),
+                'MetricExpr': expr.Simplify(),
             }
         except SyntaxError as e:
             raise SyntaxError(f'Parsing metric {name} for {self.longname}') from e
@@ -1061,14 +1805,14 @@ class Model:
         if parsed_threshold:
             formula['MetricThreshold'] = parsed_threshold
         elif threshold:
-            formula['MetricThreshold'] = metric.ParsePerfJson(threshold).Simplify().ToPerfJson()
+            formula['MetricThreshold'] = metric.ParsePerfJson(threshold).Simplify()
 
         saved_formulas.append(formula)
 
 
-    def extract_tma_metrics(self, csvfile: TextIO, pmu_prefix: str,
+    def extract_tma_metrics(self, sheet: TmaSpreadsheet, pmu_prefix: str,
                             events: Dict[str, PerfmonJsonEvent],
-                            saved_formulas: list[Dict[str, str]]):
+                            saved_formulas: list[Dict[str, Any]]):
         """Process a TMA metrics spreadsheet generating perf metrics."""
 
         ratio_column4 = {
@@ -1133,7 +1877,7 @@ class Model:
             'LNL-SKT': ['LNL-SKT', 'CMT', 'GRT'],
             'ARL-SKT': ['ARL-SKT', 'LNL-SKT', 'CMT', 'GRT'],
         }
-        if csvfile.readline().startswith('TMA,Version,4.7-full'):
+        if sheet.version4:
             ratio_column = ratio_column4
         tma_cpu = None
         if self.shortname == 'BDW-DE':
@@ -1150,6 +1894,22 @@ class Model:
         if not tma_cpu:
             _verboseprint(f'Missing TMA CPU for {self.shortname}')
             return []
+        col_heading = sheet.col_heading
+        if tma_cpu not in col_heading:
+            if tma_cpu == 'ADL/RPL' and 'GRT' in col_heading:
+                tma_cpu = 'GRT'
+            elif tma_cpu == 'MTL' and 'CMT' in col_heading:
+                tma_cpu = 'CMT'
+            elif self.shortname == 'LNL' and 'LNL-SKT' in col_heading:
+                tma_cpu = 'LNL-SKT'
+            elif self.shortname == 'ARL' and 'ARL-SKT' in col_heading:
+                tma_cpu = 'ARL-SKT'
+        # The formula of each row for this CPU.
+        forms = sheet.forms((tma_cpu, *ratio_column[tma_cpu]))
+        # BDW-DE is a BDW with the server uncore, some formulas come
+        # from the server BDX CPU.
+        bdx_forms = sheet.forms(tuple(ratio_column['BDX'])) \
+            if self.shortname == 'BDW-DE' else None
 
         @dataclass
         class PerfMetric:
@@ -1175,10 +1935,8 @@ class Model:
         nodes : Dict[str, str] = {}
         # Mapping from the TMA CSV metric name to the name used in the perf json.
         tma_metric_names : Dict[str, str] = {}
-        # Map from the column heading to the list index of that column.
-        col_heading : Dict[str, int] = {}
         # A list of topdown levels such as 'Level1'.
-        levels : list[str] = []
+        levels = sheet.levels
         # A list of parents of the current topdown level.
         parents : list[str] = []
         # Map from a parent topdown metric name to its children's names.
@@ -1186,57 +1944,23 @@ class Model:
         # Map from a metric name to the metric threshold expression.
         thresholds: Dict[str, str] = {}
         issue_to_metrics: Dict[str, Set[str]] = collections.defaultdict(set)
-        found_key = False
-        csvf = csv.reader(csvfile)
-        for l in csvf:
-            if l[0] == 'Key':
-                found_key = True
-                for ind, name in enumerate(l):
-                    col_heading[name] = ind
-                    if name.startswith('Level'):
-                        levels.append(name)
-                if tma_cpu not in col_heading:
-                    if tma_cpu == 'ADL/RPL' and 'GRT' in col_heading:
-                        tma_cpu = 'GRT'
-                    elif tma_cpu == 'MTL' and 'CMT' in col_heading:
-                        tma_cpu = 'CMT'
-                    elif self.shortname == 'LNL' and 'LNL-SKT' in col_heading:
-                        tma_cpu = 'LNL-SKT'
-                    elif self.shortname == 'ARL' and 'ARL-SKT' in col_heading:
-                        tma_cpu = 'ARL-SKT'
-                _verboseprint3(f'Columns: {col_heading}. Levels: {levels}')
-            elif not found_key:
-                continue
+        for row, l in enumerate(sheet.rows):
 
             def field(x: str) -> str:
                 """Given the name of a column, return the value in the current line of it."""
-                assert x in col_heading, f"Expected {x} in {col_heading}"
-                return l[col_heading[x]].strip()
+                return sheet.field(row, x)
 
             def find_form() -> Optional[str]:
                 """Find the formula for CPU in the current CSV line."""
-                cell = field(tma_cpu)
-                if not cell:
-                    cpu = tma_cpu
-                    # BDW-DE is a BDW with the server
-                    # uncore. Page_Walks_Utilization must come from
-                    # the server BDX CPU.
-                    if self.shortname == 'BDW-DE' and field('Level1') == 'Page_Walks_Utilization':
-                        cpu = 'BDX'
-                    for j in ratio_column[cpu]:
-                        cell = field(j)
-                        if cell:
-                            break
-                    # UNC_ARB and UNC_CLOCK are BDW uncore PMU events
-                    # not present on BDW-DE, substitute for the BDX
-                    # version.
-                    if (self.shortname == 'BDW-DE' and
-                        ('UNC_ARB' in cell or 'UNC_CLOCK' in cell)):
-                        for j in ratio_column['BDX']:
-                            cell = field(j)
-                            if cell:
-                                break
-
+                cell = forms[row]
+                if bdx_forms and not field(tma_cpu):
+                    # Page_Walks_Utilization must come from the server
+                    # BDX CPU. UNC_ARB and UNC_CLOCK are BDW uncore
+                    # PMU events not present on BDW-DE, substitute for
+                    # the BDX version.
+                    if field('Level1') == 'Page_Walks_Utilization' or \
+                       'UNC_ARB' in cell or 'UNC_CLOCK' in cell:
+                        cell = bdx_forms[row]
                 return cell
 
             def locate_with() -> Optional[str]:
@@ -1412,6 +2136,95 @@ class Model:
                     aux[aux_name] = form
                     _verboseprint3(f'Adding aux {aux_name}: {form}')
 
+        fixer = TmaFormulaFixer(self.shortname, pmu_prefix, events)
+        fixup = fixer.fixup
+
+        def bracket(expr):
+            if any([x in expr for x in ['/', '*', '+', '-', 'if']]):
+                return '(' + expr + ')'
+            return expr
+
+        def resolve_aux(v: str) -> str:
+            if any(v == i for i in ['#core_wide', '#Model', '#SMT_on', '#num_dies',
+                                    '#has_pmem', '#num_cpus_online']):
+                return v
+            if v == 'Num_CPUs':
+                return '#num_cpus_online'
+            if v == '#PMM_App_Direct':
+                return '#has_pmem > 0'
+            if v == '#DurationTimeInSeconds':
+                return 'duration_time'
+            if v == '#EBS_Mode':
+                return '#core_wide < 1'
+            if v == '#NA':
+                return '0'
+            if v[1:] in nodes:
+                child = nodes[v[1:]]
+            else:
+                child = aux[v]
+            child = fixup(child)
+            return bracket(child)
+
+        def resolve_info(v: str, expand_metrics: bool) -> str:
+            if expand_metrics and v in infoname:
+                return bracket(fixup(infoname[v]))
+            if v in infoname:
+                if infoname[v] == '#NA':
+                    # Don't refer to empty metrics.
+                    return '0'
+                if v in tma_metric_names:
+                    return tma_metric_names[v]
+            return v
+
+        def expand_hhq(parent: str) -> str:
+            return f'max({parent}, {" + ".join(sorted(children[parent]))})'
+
+        def expand_hh(parent: str) -> str:
+            return f'({" + ".join(sorted(children[parent]))})'
+
+        def resolve(v: str, expand_metrics: bool) -> str:
+            """The definition of a reference, itself when it is a leaf."""
+            if v.startswith('##?'):
+                return expand_hhq(v[3:])
+            if v.startswith('##'):
+                return expand_hh(v[2:])
+            if v.startswith('#') or v in _aux_names:
+                return resolve_aux(v)
+            return resolve_info(v, expand_metrics)
+
+        # The references between rows, such as aux names, topdown
+        # nodes and info metrics, form a graph. Each reference is
+        # expanded once, after the references in its definition,
+        # with the result memoized for the model.
+        reference_pattern = re.compile(r'#?#?\??([A-Z_a-z0-9.]|\\-)+')
+        expanded: Dict[Tuple[str, bool], str] = {}
+        # References being expanded, used to report cycles.
+        expanding: list[str] = []
+
+        def expand(v: str, expand_metrics: bool) -> str:
+            """Fully expand the reference v."""
+            key = (v, expand_metrics)
+            if key in expanded:
+                return expanded[key]
+            if v in expanding:
+                cycle = ' -> '.join(expanding[expanding.index(v):] + [v])
+                raise ValueError(f'Cyclic TMA metric reference on {self.shortname}: {cycle}')
+            definition = resolve(v, expand_metrics)
+            if definition == v:
+                result = v
+            else:
+                expanding.append(v)
+                result = expand_references(definition, expand_metrics)
+                expanding.pop()
+            expanded[key] = result
+            return result
+
+        def expand_references(form: str, expand_metrics: bool) -> str:
+            return reference_pattern.sub(lambda m: expand(m.group(0), expand_metrics), form)
+
+        def resolve_all(form: str, expand_metrics: bool) -> str:
+            return fixup(expand_references(form, expand_metrics))
+
         for i in info:
             form = i.form
             if form is None or form == '#NA' or form == 'N/A':
@@ -1419,285 +2232,6 @@ class Model:
                 continue
             _verboseprint3(f'{i.name} original formula {form}')
 
-            def resolve_all(form: str, expand_metrics: bool) -> str:
-
-                def fixup(form: str) -> str:
-                    td_event_fixups = [
-                        ('PERF_METRICS.BACKEND_BOUND', r'topdown\-be\-bound'),
-                        ('PERF_METRICS.BAD_SPECULATION', r'topdown\-bad\-spec'),
-                        ('PERF_METRICS.BRANCH_MISPREDICTS', r'topdown\-br\-mispredict'),
-                        ('PERF_METRICS.FETCH_LATENCY', r'topdown\-fetch\-lat'),
-                        ('PERF_METRICS.FRONTEND_BOUND', r'topdown\-fe\-bound'),
-                        ('PERF_METRICS.HEAVY_OPERATIONS', r'topdown\-heavy\-ops'),
-                        ('PERF_METRICS.MEMORY_BOUND', r'topdown\-mem\-bound'),
-                        ('PERF_METRICS.RETIRING', r'topdown\-retiring'),
-                        ('TOPDOWN.SLOTS:perf_metrics', 'TOPDOWN.SLOTS'),
-                        ('TOPDOWN.SLOTS:percore', 'TOPDOWN.SLOTS'),
-                    ]
-                    hsx_uncore_fixups = [
-                        ('UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182:c1',
-                         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
-                        ('UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182',
-                         r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
-                        ('UNC_C_TOR_INSERTS.MISS_OPCODE:opc=0x182',
-                         r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
-                        ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
-                    ]
-                    power_uncore_fixups = [
-                        ('UNC_PKG_ENERGY_STATUS', r'power@energy\-pkg@'),
-                        ('FREERUN_PKG_ENERGY_STATUS', r'power@energy\-pkg@'),
-                        ('FREERUN_DRAM_ENERGY_STATUS', r'power@energy\-ram@'),
-                    ]
-                    arch_fixups = {
-                        'ADL': td_event_fixups + [
-                            ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
-                        ],
-                        'ARL': td_event_fixups + [
-                            ('IDQ.MITE_UOPS:c8:i1:eq1',
-                             r'cpu_core@IDQ.MITE_UOPS\,cmask\=0x8\,inv\=0x1@'),
-                            ('IDQ.DSB_UOPS:c8:i1:eq1',
-                             r'cpu_core@IDQ.DSB_UOPS\,cmask\=0x8\,inv\=0x1@'),
-                            ('LSD.UOPS:c8:i1:eq1',
-                             r'cpu_core@LSD.UOPS\,cmask\=0x8\,inv\=0x1@'),
-                        ],
-                        'BDW-DE': hsx_uncore_fixups,
-                        'BDX': hsx_uncore_fixups,
-                        'CLX': [
-                            ('UNC_M_CLOCKTICKS:one_unit', r'imc_0@event\=0x0@'),
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                        ],
-                        'EMR': [
-                            ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
-                             'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                        ] + td_event_fixups,
-                        'GNR': [
-                            ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
-                             'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                        ] + td_event_fixups,
-                        'HSX': hsx_uncore_fixups,
-                        'ICL': td_event_fixups,
-                        'ICX': [
-                            ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
-                             'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                        ] + td_event_fixups,
-                        'IVT': [
-                            ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182"',
-                             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
-                            ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182:c1"',
-                             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
-                            ('"UNC_C_TOR_INSERTS.MISS_OPCODE/Match=0x182"',
-                             r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
-                            ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
-                        ],
-                        'JKT': [
-                            ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182"',
-                             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
-                            ('"UNC_C_TOR_INSERTS.MISS_OPCODE/Match=0x182"',
-                             r'UNC_C_TOR_INSERTS.MISS_OPCODE@filter_opc\=0x182@'),
-                            ('"UNC_C_TOR_OCCUPANCY.MISS_OPCODE/Match=0x182:c1"',
-                             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@'),
-                            ('UNC_C_CLOCKTICKS:one_unit', r'cbox_0@event\=0x0@'),
-                        ],
-                        'LNL': td_event_fixups + [
-                            ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
-                            ('IDQ.MITE_UOPS:c8:i1:eq1',
-                             r'cpu_core@IDQ.MITE_UOPS\,cmask\=0x8\,inv\=0x1@'),
-                            ('IDQ.DSB_UOPS:c8:i1:eq1',
-                             r'cpu_core@IDQ.DSB_UOPS\,cmask\=0x8\,inv\=0x1@'),
-                            ('LSD.UOPS:c8:i1:eq1',
-                             r'cpu_core@LSD.UOPS\,cmask\=0x8\,inv\=0x1@'),
-                        ],
-                        'MTL': td_event_fixups + [
-                            ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
-                        ],
-                        'RKL': td_event_fixups + [
-                            ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
-                        ],
-                        'SKL': [
-                            ('UNC_ARB_TRK_OCCUPANCY.DATA_READ:c1',
-                             r'UNC_ARB_TRK_OCCUPANCY.DATA_READ@cmask\=1@'),
-                        ],
-                        'SKX': [
-                            ('UNC_M_CLOCKTICKS:one_unit', r'imc_0@event\=0x0@'),
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'cha_0@event\=0x0@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                        ],
-                        'SNB' :[
-                            ('MEM_LOAD_UOPS_RETIRED.LLC_MISS', 'MEM_LOAD_UOPS_MISC_RETIRED.LLC_MISS'),
-                        ],
-                        'SPR': [
-                            ('UNC_CHA_CLOCKTICKS:one_unit', r'uncore_cha_0@event\=0x1@'),
-                            ('UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD:c1',
-                             r'UNC_CHA_TOR_OCCUPANCY.IA_MISS_DRD@thresh\=1@'),
-                            ('OCR.DEMAND_RFO.L3_MISS:ocr_msr_val=0x103b800002',
-                             'OCR.DEMAND_RFO.L3_MISS@offcore_rsp\\=0x103b800002@'),
-                        ] + td_event_fixups,
-                        'TGL': [
-                            ('UNC_ARB_DAT_OCCUPANCY.RD:c1', r'UNC_ARB_DAT_OCCUPANCY.RD@cmask\=1@'),
-                        ] + td_event_fixups,
-                    }
-
-                    fixups = arch_fixups[self.shortname]  if self.shortname in arch_fixups else []
-                    fixups = fixups + power_uncore_fixups
-                    for j, r in fixups:
-                        for i in range(0, len(r)):
-                            if r[i] in ['-', '=', ',']:
-                                assert i == 0 or r[i - 1] == '\\', r
-                        if pmu_prefix != 'cpu' and r.startswith(r'topdown\-'):
-                            r = rf'{pmu_prefix}@{r}@'
-
-                        form = form.replace(j, r)
-
-                    form = form.replace('_PS', '')
-                    form = re.sub(r':USER', ':u', form, flags=re.IGNORECASE)
-                    form = re.sub(r':SUP', ':k', form, flags=re.IGNORECASE)
-                    form = form.replace('(0 + ', '(')
-                    form = form.replace(' + 0)', ')')
-                    form = form.replace('+ 0 +', '+')
-                    form = form.replace(', 0 +', ',')
-                    form = form.replace('else 0 +', 'else')
-                    form = form.replace('( ', '(')
-                    form = form.replace(' )', ')')
-                    form = form.replace(' , ', ', ')
-                    form = form.replace('  ', ' ')
-
-                    changed = True
-                    event_pattern = r'[A-Z0-9_.]+'
-                    term_pattern = r'[a-z0-9\\=,]+'
-                    while changed:
-                        changed = False
-                        for match, replacement in [
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:sup', rf'{pmu_prefix}@\1@k'),
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:user', rf'{pmu_prefix}@\1@u'),
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:c(\d+)', rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:u0x([A-Fa-f0-9]+)',
-                             rf'{pmu_prefix}@\1\\,umask\\=0x\2@'),
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:i1', rf'{pmu_prefix}@\1\\,inv@'),
-                            (rf'{pmu_prefix}@(' + event_pattern + term_pattern +
-                             r')@:e1', rf'{pmu_prefix}@\1\\,edge@'),
-                            ('(' + event_pattern + rf'):sup',
-                             rf'{pmu_prefix}@\1@k'),
-                            ('(' + event_pattern + rf'):user',
-                             rf'{pmu_prefix}@\1@u'),
-                            ('(' + event_pattern + rf'):i1',
-                             rf'{pmu_prefix}@\1\\,inv@'),
-                            ('(' + event_pattern + rf'):c(\d+)',
-                             rf'{pmu_prefix}@\1\\,cmask\\=\2@'),
-                            ('(' + event_pattern + rf'):u((0x[a-fA-F0-9]+|\d+))',
-                             rf'{pmu_prefix}@\1\\,umask\\=\2@'),
-                            ('(' + event_pattern + rf'):e1',
-                             rf'{pmu_prefix}@\1\\,edge@'),
-                        ]:
-                            new_form = re.sub(match, replacement, form,
-                                              flags=re.IGNORECASE)
-                            changed = changed or new_form != form
-                            form = new_form
-
-                    if pmu_prefix != 'cpu':
-                        for name in events:
-                            if events[name].unit.startswith('cpu') and name in form:
-                                form = re.sub(rf'(^|[^@]){name}:([a-zA-Z])',
-                                              rf'\1{pmu_prefix}@{name}@\2',
-                                              form, flags=re.IGNORECASE)
-                                form = re.sub(rf'(^|[^@]){name}([^a-zA-Z0-9_]|$)',
-                                              rf'\1{pmu_prefix}@{name}@\2',
-                                              form, flags=re.IGNORECASE)
-
-                    changed = True
-                    while changed:
-                        changed = False
-                        m = re.search(r'\(([0-9.]+) \* ([A-Za-z_]+)\) - \(([0-9.]+) \* ([A-Za-z_]+)\)', form)
-                        if m and m.group(2) == m.group(4):
-                            changed = True
-                            form = form.replace(m.group(0), f'{(float(m.group(1)) - float(m.group(3))):g} * {m.group(2)}')
-
-                    return form
-
-
-                def bracket(expr):
-                    if any([x in expr for x in ['/', '*', '+', '-', 'if']]):
-                        return '(' + expr + ')'
-                    return expr
-
-                def resolve_aux(v: str) -> str:
-                    if any(v == i for i in ['#core_wide', '#Model', '#SMT_on', '#num_dies',
-                                            '#has_pmem', '#num_cpus_online']):
-                        return v
-                    if v == 'Num_CPUs':
-                        return '#num_cpus_online'
-                    if v == '#PMM_App_Direct':
-                        return '#has_pmem > 0'
-                    if v == '#DurationTimeInSeconds':
-                        return 'duration_time'
-                    if v == '#EBS_Mode':
-                        return '#core_wide < 1'
-                    if v == '#NA':
-                        return '0'
-                    if v[1:] in nodes:
-                        child = nodes[v[1:]]
-                    else:
-                        child = aux[v]
-                    child = fixup(child)
-                    return bracket(child)
-
-                def resolve_info(v: str) -> str:
-                    if expand_metrics and v in infoname:
-                        return bracket(fixup(infoname[v]))
-                    if v in infoname:
-                        form = infoname[v]
-                        if form == '#NA':
-                            # Don't refer to empty metrics.
-                            return '0'
-                        # Check the expanded formula for bad events, which
-                        # would mean we want to drop this metric too.
-                        form = fixup(form)
-                        if v in tma_metric_names:
-                            return tma_metric_names[v]
-                    return v
-
-                def expand_hhq(parent: str) -> str:
-                    return f'max({parent}, {" + ".join(sorted(children[parent]))})'
-
-                def expand_hh(parent: str) -> str:
-                    return f'({" + ".join(sorted(children[parent]))})'
-
-                def resolve(v: str) -> str:
-                    if v.startswith('##?'):
-                        return expand_hhq(v[3:])
-                    if v.startswith('##'):
-                        return expand_hh(v[2:])
-                    if v.startswith('#') or v in _aux_names:
-                        return resolve_aux(v)
-                    return resolve_info(v)
-
-                # Iterate until form stabilizes to handle deeper nesting.
-                changed = True
-                while changed:
-                    orig_form = form
-                    form = re.sub(r'#?#?\??([A-Z_a-z0-9.]|\\-)+',
-                                  lambda m: resolve(m.group(0)), form)
-                    changed = orig_form != form
-
-                form = fixup(form)
-                return form
-
             form = resolve_all(form, expand_metrics=False)
             threshold = None
             if i.threshold:
@@ -1731,31 +2265,29 @@ class Model:
                            issue_to_metrics, saved_formulas)
 
     def extract_extra_metrics(self, pmu_prefix: str, events: Dict[str, PerfmonJsonEvent],
-                              saved_formulas: list[Dict[str, str]]):
+                              saved_formulas: list[Dict[str, Any]]):
         if 'extra metrics' in self.files:
             for file in self.files['extra metrics']:
                 _verboseprint2(f'Extracting metrics from {file}')
-                with open(file, 'r') as extra_json:
-                    for em in json.load(extra_json):
-                        dups = [m for m in saved_formulas if m['MetricName'] == em['MetricName']]
-                        if dups:
-                            _verboseprint3(f'Replacing:\n\t{dups[0]["MetricExpr"]}\nwith:\n\t{em["MetricExpr"]}')
-
-                        desc = em['PublicDescription'] if 'PublicDescription' in em else em['BriefDescription']
-                        if desc[-1:] == '.':
-                            desc = desc[:-1]
-                        self.save_form(em['MetricName'], em['MetricGroup'], em['MetricExpr'],
-                                       desc, None, em.get('ScaleUnit'),
-                                       em.get('MetricThreshold'), [], pmu_prefix, events,
-                                       infoname={}, aux={}, issue_to_metrics={},
-                                       saved_formulas=saved_formulas)
+                for em in _json_loader.load(file):
+                    dups = [m for m in saved_formulas if m['MetricName'] == em['MetricName']]
+                    if dups:
+                        _verboseprint3(f'Replacing:\n\t{dups[0]["MetricExpr"]}\nwith:\n\t{em["MetricExpr"]}')
+
+                    desc = em['PublicDescription'] if 'PublicDescription' in em else em['BriefDescription']
+                    if desc[-1:] == '.':
+                        desc = desc[:-1]
+                    self.save_form(em['MetricName'], em['MetricGroup'], em['MetricExpr'],
+                                   desc, None, em.get('ScaleUnit'),
+                                   em.get('MetricThreshold'), [], pmu_prefix, events,
+                                   infoname={}, aux={}, issue_to_metrics={},
+                                   saved_formulas=saved_formulas)
 
         if any(m['MetricName'] == 'tma_info_system_socket_clks' for m in saved_formulas):
             form = 'tma_info_system_socket_clks / #num_dies / duration_time / 1000000000'
             #form = resolve_all(form, expand_metrics=False)
             if form:
-                formula = metric.ParsePerfJson(form)
-                self.save_form('UNCORE_FREQ', 'SoC', formula.ToPerfJson(),
+                self.save_form('UNCORE_FREQ', 'SoC', form,
                                'Uncore frequency per die [GHZ]', None, None, None, [],
                                pmu_prefix, events, infoname={}, aux={},
                                issue_to_metrics={}, saved_formulas=saved_formulas)
@@ -1767,27 +2299,53 @@ class Model:
         """
 
         for event in pmon_events:
-            if not event.counter or "FREERUN" in event.event_name:
+            if not event.counters_bitmask:
                 continue
-            counters = event.counter.split(',')
-            if "fixed" in counters[0].lower():
-                type = "CountersNumFixed"
-                counters = event.counter.split(' ')
-                if not counters[-1].isnumeric():
-                    counters[0] = '0'
-            else:
+            if event.counters_bitmask & GENERIC_COUNTERS:
                 type = "CountersNumGeneric"
+                v = (event.counters_bitmask & GENERIC_COUNTERS).bit_length()
+            else:
+                type = "CountersNumFixed"
+                v = (event.counters_bitmask >> FIXED_COUNTER_SHIFT).bit_length()
             if not event.unit:
                 unit = event_type
             else:
                 unit = event.unit
-            v = int(counters[-1]) + 1
             if unit in self.unit_counters:
                 self.unit_counters[unit][type] = str(max(int(self.unit_counters[unit][type]), v))
             else:
                 self.unit_counters[unit] = {'Unit':unit, 'CountersNumFixed': '0', 'CountersNumGeneric': '0'}
                 self.unit_counters[unit][type] = v
 
+    @staticmethod
+    def write_metric_costs(path: Path, metrics: list[Dict[str, str]],
+                           parsed: Dict[Tuple[Optional[str], str], metric.Expression],
+                           counter_table: CounterTable):
+        """
+        Write the cost of collecting each perf json metric as a CSV
+        file. The cost is the metric's distinct events, after resolving
+        references to other metrics, the PMUs they are counted on, the
+        fewest groups needed to count them together and whether any
+        are uncore or retire latency (:R) events. parsed holds the
+        expressions of metrics before they were written as perf json.
+        """
+        with open(path, 'w', encoding='ascii', newline='') as costs_csv:
+            writer = csv.writer(costs_csv, lineterminator='\n')
+            writer.writerow(['MetricName', 'Unit', 'Events', 'CounterGroups', 'PMUs',
+                             'Uncore', 'RetireLatency', 'EventNames'])
+            for m, events in zip(metrics, metric_events(metrics, parsed)):
+                placements = {e: counter_table.placement(e, m.get('Unit')) for e in events}
+                pmus = {p.unit if p else (split_event(e)[0] or 'tool')
+                        for e, p in placements.items()}
+                counted = [p for p in placements.values() if p]
+                retire_latency = any(e.endswith(':R') or e.endswith('@R') for e in events)
+                writer.writerow([
+                    m['MetricName'], m.get('Unit', ''), len(events),
+                    counter_table.min_groups(counted), ';'.join(sorted(pmus)),
+                    int(any(p.uncore for p in counted)), int(retire_latency),
+                    ' '.join(sorted(events)),
+                ])
+
     def to_perf_json(self, outdir: Path):
         # Map from a topic to its list of events as dictionaries.
         pmon_topic_events: Dict[str, list[Dict[str, str]]] = \
@@ -1800,6 +2358,9 @@ class Model:
         # representing the perf json event. The dictionary events may
         # be modified by the uncore CSV file.
         dict_events: Dict[str, Dict[str, str]] = {}
+        # The perf json event, counter.json unit and event of each
+        # event written.
+        counter_rows: list[Tuple[Dict[str, str], str, PerfmonJsonEvent]] = []
         for event_type in ['atom', 'core', 'lowpower', 'uncore', 'uncore experimental']:
             if event_type not in self.files:
                 continue
@@ -1809,54 +2370,53 @@ class Model:
                 pmu_prefix = 'cpu'
                 if 'atom' in self.files or 'lowpower' in self.files:
                     pmu_prefix = f'cpu_{event_type}'
-            with open(self.files[event_type], 'r') as event_json:
-                json_data = json.load(event_json)
-                # UNC_IIO_BANDWIDTH_OUT events are broken on Linux pre-SPR so skip if they exist.
-                pmon_events = [PerfmonJsonEvent(self.shortname, pmu_prefix, x,
-                                                'experimental' in event_type)
-                               for x in json_data['Events']
-                               if self.shortname == 'SPR' or
-                               not x["EventName"].startswith("UNC_IIO_BANDWIDTH_OUT.")]
-                unit = None
-                if event_type in ['atom', 'core', 'lowpower']:
-                    # If the platform is a hybrid there will be a combination of atom,
-                    # lowpower (LowPower_Atom), or core files.
-                    if ('atom' in self.files or 'lowpower' in self.files) and 'core' in self.files:
-                        unit = f'cpu_{event_type}'
-                per_pkg = '1' if event_type in ['uncore', 'uncore experimental'] else None
-                duplicates: Set[str] = set()
-                for event in pmon_events:
-                    dict_event = event.to_perf_json()
-                    if not dict_event:
-                        # Event should be dropped.
-                        continue
+            json_data = _json_loader.load(self.files[event_type])
+            # UNC_IIO_BANDWIDTH_OUT events are broken on Linux pre-SPR so skip if they exist.
+            pmon_events = [PerfmonJsonEvent(self.shortname, pmu_prefix, x,
+                                            'experimental' in event_type)
+                           for x in json_data['Events']
+                           if self.shortname == 'SPR' or
+                           not x["EventName"].startswith("UNC_IIO_BANDWIDTH_OUT.")]
+            unit = None
+            if event_type in ['atom', 'core', 'lowpower']:
+                # If the platform is a hybrid there will be a combination of atom,
+                # lowpower (LowPower_Atom), or core files.
+                if ('atom' in self.files or 'lowpower' in self.files) and 'core' in self.files:
+                    unit = f'cpu_{event_type}'
+            per_pkg = '1' if event_type in ['uncore', 'uncore experimental'] else None
+            duplicates: Set[str] = set()
+            for event in pmon_events:
+                dict_event = event.to_perf_json()
+                if not dict_event:
+                    # Event should be dropped.
+                    continue
 
-                    if event.event_name in duplicates:
-                        _verboseprint(f'Warning: Dropping duplicated {event.event_name}'
-                              f' in {self.files[event_type]}\n'
-                              f'Existing: {events[event.event_name]}\n'
-                              f'Duplicate: {event}')
-                        continue
-                    duplicates.add(event.event_name)
-                    if unit and 'Unit' not in dict_event:
-                        dict_event['Unit'] = unit
-                    if per_pkg:
-                        dict_event['PerPkg'] = per_pkg
-                    pmon_topic_events[event.topic].append(dict_event)
-                    dict_events[event.event_name.upper()] = dict_event
-                    events[event.event_name.upper()] = event
-                if 'retire latency' in self.files:
-                    with open(self.files['retire latency'], 'r') as latency_json:
-                        event_and_latencies = json.load(latency_json)['Data']
-                        for lat_event in event_and_latencies.keys():
-                            assert lat_event in dict_events
-                            dict_events[lat_event]['RetirementLatencyMean'] = \
-                                event_and_latencies[lat_event]['MEAN']
-                            dict_events[lat_event]['RetirementLatencyMin'] = \
-                                event_and_latencies[lat_event]['MIN']
-                            dict_events[lat_event]['RetirementLatencyMax'] = \
-                                event_and_latencies[lat_event]['MAX']
-                self.count_counters(event_type, pmon_events)
+                if event.event_name in duplicates:
+                    _verboseprint(f'Warning: Dropping duplicated {event.event_name}'
+                          f' in {self.files[event_type]}\n'
+                          f'Existing: {events[event.event_name]}\n'
+                          f'Duplicate: {event}')
+                    continue
+                duplicates.add(event.event_name)
+                if unit and 'Unit' not in dict_event:
+                    dict_event['Unit'] = unit
+                if per_pkg:
+                    dict_event['PerPkg'] = per_pkg
+                pmon_topic_events[event.topic].append(dict_event)
+                dict_events[event.event_name.upper()] = dict_event
+                events[event.event_name.upper()] = event
+                counter_rows.append((dict_event, event.unit or event_type, event))
+            if 'retire latency' in self.files:
+                event_and_latencies = _json_loader.load(self.files['retire latency'])['Data']
+                for lat_event in event_and_latencies.keys():
+                    assert lat_event in dict_events
+                    dict_events[lat_event]['RetirementLatencyMean'] = \
+                        event_and_latencies[lat_event]['MEAN']
+                    dict_events[lat_event]['RetirementLatencyMin'] = \
+                        event_and_latencies[lat_event]['MIN']
+                    dict_events[lat_event]['RetirementLatencyMax'] = \
+                        event_and_latencies[lat_event]['MAX']
+            self.count_counters(event_type, pmon_events)
 
         if 'uncore csv' in self.files:
             _verboseprint2(f'Rewriting events with {self.files["uncore csv"]}')
@@ -1894,6 +2454,7 @@ class Model:
                         new_event['EventName'] = newname
                         dict_events[newname.upper()] = new_event
                         pmon_topic_events[topic].append(new_event)
+                        counter_rows.append((new_event, events[name].unit, events[name]))
                         if desc:
                             desc += f'. Derived from {name.lower()}'
                         name = newname
@@ -1957,6 +2518,32 @@ class Model:
                           separators=(',', ': '))
                 perf_json.write('\n')
 
+        # Write the counters of each event as bitmasks, see
+        # counter_bitmask. Flags are F for fixed counter only events, P
+        # for events with PDIST counters and R for free running events.
+        with open(Path(outdir, 'event-counters.csv'), 'w', encoding='ascii') as counters_csv:
+            counters_csv.write('EventName,Unit,Counters,PDISTCounters,Flags\n')
+            for dict_event, unit, event in sorted(counter_rows,
+                                                  key=lambda r: (r[1], r[0]['EventName'])):
+                flags = ''
+                if event.counters_bitmask and not event.counters_bitmask & GENERIC_COUNTERS:
+                    flags += 'F'
+                if event.pdist_bitmask:
+                    flags += 'P'
+                if not event.counters_bitmask:
+                    flags += 'R'
+                counters_csv.write(f'{dict_event["EventName"]},{unit},'
+                                   f'{event.counters_bitmask:#x},{event.pdist_bitmask:#x},'
+                                   f'{flags}\n')
+
+        counter_table = CounterTable()
+        for counters in self.unit_counters.values():
+            counter_table.add_unit(counters['Unit'], int(counters['CountersNumFixed']),
+                                   int(counters['CountersNumGeneric']))
+        for dict_event, unit, event in counter_rows:
+            counter_table.add_event(dict_event['EventName'], unit, event.counters_bitmask,
+                                    dict_event.get('PerPkg') == '1')
+
         # Skip hybrid because event grouping does not support it well yet
         if self.shortname not in ['ADL', 'ADLN', 'ARL', 'LNL', 'MTL', 'SRF', 'GRR']:
             # Write units and counters data to counter.json file
@@ -1970,36 +2557,39 @@ class Model:
             if metric_csv_key not in self.files:
                 continue
             pmu_prefix = unit if 'atom' in self.files else 'cpu'
-            with open(self.files[metric_csv_key], 'r') as metric_csv:
-                csv_metrics = []
-                self.extract_tma_metrics(metric_csv, pmu_prefix, events, csv_metrics)
-                if unit == 'cpu_core':
-                    self.extract_extra_metrics(pmu_prefix, events, csv_metrics)
-                csv_metrics = sorted(csv_metrics,
-                                     key=lambda m: (m['Unit'] if 'Unit' in m else 'cpu',
-                                                    m['MetricName'])
-                                     )
-                csv_metrics = rewrite_metrics_in_terms_of_others(csv_metrics)
-                metrics.extend(csv_metrics)
+            csv_metrics = []
+            self.extract_tma_metrics(TmaSpreadsheet.load(self.files[metric_csv_key]),
+                                     pmu_prefix, events, csv_metrics)
+            if unit == 'cpu_core':
+                self.extract_extra_metrics(pmu_prefix, events, csv_metrics)
+            csv_metrics = sorted(csv_metrics,
+                                 key=lambda m: (m['Unit'] if 'Unit' in m else 'cpu',
+                                                m['MetricName'])
+                                 )
+            csv_metrics = rewrite_metrics_in_terms_of_others(csv_metrics)
+            metrics.extend(csv_metrics)
 
         if len(metrics) > 0:
             metrics.extend(self.cstate_json())
 
             for m in metrics:
-                form = m['MetricExpr']
-                if "TSC" in form:
-                    if 'Unit' in m:
-                        unit = m['Unit']
-                        tsc_pmu_suffix = rf"\,cpu={unit}@"
-                    else:
-                        tsc_pmu_suffix = "@"
-                    form = re.sub(r"\bTSC\b", "msr@tsc" + tsc_pmu_suffix, form)
-                    m['MetricExpr'] = form
-
+                tsc = metric.Event('msr@tsc@')
+                if 'Unit' in m:
+                    # The unit's '=' isn't escaped.
+                    tsc = metric.Event.Verbatim(rf"msr@tsc\,cpu={m['Unit']}@")
+                m['MetricExpr'] = substitute_event(m['MetricExpr'], 'TSC', tsc)
+
+            # Serialize the metric expressions and add the already
+            # serialized TSX and SMI metrics.
+            parsed = {(m.get('Unit'), m['MetricName'].lower()): m['MetricExpr'] for m in metrics}
+            for m in metrics:
+                for key in ['MetricExpr', 'MetricThreshold']:
+                    if key in m:
+                        m[key] = m[key].ToPerfJson()
             mg = self.tsx_json()
             if mg:
-                metrics.extend(json.loads(mg.ToPerfJson()))
-            metrics.extend(json.loads(self.smi_json().ToPerfJson()))
+                metrics.extend(x.ToPerfJson() for x in sorted(mg.Flatten()))
+            metrics.extend(x.ToPerfJson() for x in sorted(self.smi_json().Flatten()))
             metrics = sorted(metrics,
                              key=lambda m: (m['Unit'] if 'Unit' in m else 'cpu',
                                             m['MetricName'])
@@ -2009,6 +2599,8 @@ class Model:
                 json.dump(metrics, perf_metric_json, sort_keys=True, indent=4,
                           separators=(',', ': '))
                 perf_metric_json.write('\n')
+            self.write_metric_costs(Path(outdir, 'metric-costs.csv'), metrics, parsed,
+                                    counter_table)
 
         if self.metricgroups:
             with open(Path(outdir, 'metricgroups.json'), 'w', encoding='ascii') as metricgroups_json:
@@ -2155,9 +2747,43 @@ class Mapfile:
     def __str__(self):
         return '\n'.join(str(model) for model in self.archs)
 
-    def to_perf_json(self, outdir: Path):
+    # Name of the file in the output directory recording, per model,
+    # the digest of the inputs used and the files generated from them.
+    MANIFEST = '.manifest.json'
+    MANIFEST_VERSION = 1
+
+    def read_manifest(self, outdir: Path) -> Dict[str, Dict]:
         """
-        Create a perf style mapfile.csv.
+        Read the manifest of a previous run, empty if missing or stale.
+        """
+        manifest_path = Path(outdir, Mapfile.MANIFEST)
+        try:
+            with open(manifest_path, 'r') as manifest_json:
+                manifest = json.load(manifest_json)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('Version') != Mapfile.MANIFEST_VERSION:
+            return {}
+        return manifest.get('Models', {})
+
+    def write_manifest(self, outdir: Path, models: Dict[str, Dict]):
+        manifest_path = Path(outdir, Mapfile.MANIFEST)
+        with open(manifest_path, 'w', encoding='ascii') as manifest_json:
+            json.dump({'Version': Mapfile.MANIFEST_VERSION, 'Models': models},
+                      manifest_json, sort_keys=True, indent=4,
+                      separators=(',', ': '))
+            manifest_json.write('\n')
+
+    def to_perf_json(self, outdir: Path, jobs: int = 1, force: bool = False):
+        """
+        Create a perf style mapfile.csv and the json for every model.
+
+        @param outdir: directory the mapfile and model directories are written to.
+        @param jobs: number of models to generate concurrently, each in
+                     its own process. Models write to distinct
+                     directories so the output matches a serial run.
+        @param force: regenerate models even if the manifest shows their
+                      inputs are unchanged since the output was written.
         """
         output_mapfile_path = Path(outdir, 'mapfile.csv')
         _verboseprint(f'Writing mapfile to {output_mapfile_path}')
@@ -2165,14 +2791,70 @@ class Mapfile:
             for model in self.archs:
                 gen_mapfile.write(model.mapfile_line() + '\n')
 
+        scripts = [Path(__file__).resolve(), Path(metric.__file__).resolve()]
+        manifest = self.read_manifest(outdir)
+        # Models needing generation paired with their input digest.
+        todo: list[Tuple[Model, str]] = []
         for model in self.archs:
             modeldir = Path(outdir, model.longname)
-            _verboseprint(f'Creating event json for {model.shortname} in {modeldir}')
-            modeldir.mkdir(exist_ok=True)
-            try:
-                model.to_perf_json(modeldir)
-            except Exception as e:
-                raise RuntimeError(f'Failure in model \'{model}\'') from e
+            digest = model.input_digest(scripts)
+            entry = manifest.get(model.longname)
+            if not force and entry and entry['Inputs'] == digest and \
+               all(Path(modeldir, x).is_file() for x in entry['Outputs']):
+                _verboseprint(f'Skipping {model.shortname}, inputs unchanged')
+                continue
+            manifest.pop(model.longname, None)
+            todo.append((model, digest))
+
+        def generated(model: Model, digest: str):
+            """Record a successfully generated model in the manifest."""
+            modeldir = Path(outdir, model.longname)
+            manifest[model.longname] = {
+                'Inputs': digest,
+                'Outputs': sorted(x.name for x in modeldir.iterdir() if x.is_file()),
+            }
+
+        # Parse the shared TMA spreadsheets once, before any worker
+        # processes are forked.
+        for model, _ in todo:
+            for key in ['tma metrics', 'e-core tma metrics']:
+                if key in model.files:
+                    TmaSpreadsheet.load(model.files[key])
+
+        try:
+            if jobs <= 1:
+                for model, digest in todo:
+                    modeldir = Path(outdir, model.longname)
+                    _verboseprint(f'Creating event json for {model.shortname} in {modeldir}')
+                    modeldir.mkdir(exist_ok=True)
+                    try:
+                        model.to_perf_json(modeldir)
+                    except Exception as e:
+                        raise RuntimeError(f'Failure in model \'{model}\'') from e
+                    generated(model, digest)
+                return
+
+            with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                     initargs=(_verbose, _json_loader.cache_dir,
+                                               _json_loader.max_cache_bytes)) as executor:
+                futures = []
+                for model, digest in todo:
+                    modeldir = Path(outdir, model.longname)
+                    _verboseprint(f'Creating event json for {model.shortname} in {modeldir}')
+                    modeldir.mkdir(exist_ok=True)
+                    futures.append((model, digest,
+                                    executor.submit(_model_to_perf_json, model, modeldir)))
+                for model, digest, future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        executor.shutdown(cancel_futures=True)
+                        raise RuntimeError(f'Failure in model \'{model}\'') from e
+                    generated(model, digest)
+        finally:
+            self.write_manifest(outdir, manifest)
+            if _parse_cache:
+                _parse_cache.Save()
 
 
 def main():
@@ -2185,6 +2867,22 @@ def main():
                     default=default_outdir,
                     type=Path,
                     help='Directory to write output to.')
+    ap.add_argument('--jobs',
+                    '-j',
+                    default=1,
+                    type=int,
+                    help='Number of models to generate in parallel, 0 for one per CPU.')
+    ap.add_argument('--force',
+                    action='store_true',
+                    help='Regenerate all models ignoring the manifest of unchanged inputs.')
+    ap.add_argument('--cache-dir',
+                    type=Path,
+                    help='Directory caching decoded event json and parsed metrics between '
+                    'runs, like ~/.cache/perfmon. Nothing is cached between runs by default.')
+    ap.add_argument('--cache-size',
+                    default=256,
+                    type=int,
+                    help='Maximum size in MiB of the cache directory, 0 disables the cache.')
     ap.add_argument('--verbose',
                     '-v',
                     action='count',
@@ -2195,13 +2893,16 @@ def main():
 
     global _verbose
     _verbose = args.verbose
+    if args.cache_dir and args.cache_size > 0:
+        _init_caches(args.cache_dir.resolve(), args.cache_size << 20)
 
     outdir = args.outdir.resolve()
     if outdir.exists() and not outdir.is_dir():
         raise IOError(f'Output directory argument {outdir} exists but is not a directory.')
     outdir.mkdir(exist_ok=True)
 
-    Mapfile(basepath).to_perf_json(outdir)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    Mapfile(basepath).to_perf_json(outdir, jobs, args.force)
 
 if __name__ == '__main__':
     main()
@@ -1,34 +1,101 @@
 # Copyright (C) 2022 Google LLC
 # SPDX-License-Identifier: BSD-3-Clause
 """Parse or generate representations of perf metrics."""
+import array
 import ast
+import builtins
+import bisect
 import decimal
+from fractions import Fraction
+import hashlib
 import json
+import marshal
+import math
+import operator
+import os
+from pathlib import Path
 import re
-from typing import Dict, List, Optional, Set, Tuple, Union
+import sys
+import tempfile
+from typing import Any, Callable, Dict, Generator, List, Mapping, Optional, Set, Tuple, Union
+import weakref
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 
 class Expression:
-  """Abstract base class of elements in a metric expression."""
+  """Abstract base class of elements in a metric expression.
+
+  Expressions are immutable and hash-consed, constructing an expression
+  equal to a live one returns that same object. Structurally equal
+  expressions are therefore identical and their hash is computed once.
+  """
+  __slots__ = ('_hash', '__weakref__')
+  # Names of the slots holding the values that identify the expression.
+  _FIELDS: Tuple[str, ...] = ()
+
+  def __setattr__(self, name: str, value: Any):
+    raise AttributeError(f'{type(self).__name__} is immutable')
+
+  def __delattr__(self, name: str):
+    raise AttributeError(f'{type(self).__name__} is immutable')
+
+  def __hash__(self) -> int:
+    return self._hash
+
+  def __reduce__(self):
+    return (_Intern, (type(self), tuple(getattr(self, f) for f in self._FIELDS)))
 
   def ToPerfJson(self) -> str:
     """Returns a perf json file encoded representation."""
-    raise NotImplementedError()
+    return _PerfJsonWriter().Write(self)
 
   def ToPython(self) -> str:
     """Returns a python expr parseable representation."""
-    raise NotImplementedError()
+    return _PythonWriter().Write(self)
 
-  def Simplify(self):
+  def Simplify(self) -> 'Expression':
     """Returns a simplified version of self."""
-    raise NotImplementedError()
+    return _Simplifier().Visit(self)
 
   def Equals(self, other) -> bool:
     """Returns true when two expressions are the same."""
-    raise NotImplementedError()
+    return self is other
 
   def Substitute(self, name: str, expression: 'Expression') -> 'Expression':
-    raise NotImplementedError()
+    """Returns self with expression replaced by an event called name."""
+    return _Substituter(name, expression).Visit(self)
+
+  def Compile(self) -> Callable[[Mapping[str, float]], float]:
+    """Returns a function computing the value of the expression.
+
+    The function takes a mapping from event names, as written in the
+    perf json, and literals, such as '#SMT_on', to their values. Like
+    perf, division by zero gives NaN, d_ratio gives 0 when the divisor
+    is 0 and Select only computes the branch it takes. has_event is 1
+    when the event has a value and source_count is the value of
+    'source_count(<event>)', defaulting to 1.
+    """
+    result = _compiled.get(self)
+    if result is None:
+      result = _Compiler().Compile(self)
+      _compiled[self] = result
+    return result
+
+  def EvaluateArrays(self, values: Mapping[str, Any]) -> Any:
+    """Computes the expression over numpy arrays of samples.
+
+    values maps the names Compile's function reads to arrays, or
+    scalars, of samples. Each element of the result is the value
+    Compile's function computes for the corresponding elements of the
+    inputs. Requires numpy.
+    """
+    if np is None:
+      raise ImportError('EvaluateArrays requires numpy')
+    return _ArrayEvaluator(values).Evaluate(self)
 
   def __str__(self) -> str:
     return self.ToPerfJson()
@@ -88,6 +155,23 @@ class Expression:
     return Operator('%', self, other)
 
 
+# Live expressions keyed by their type and fields.
+_interned: 'weakref.WeakValueDictionary[tuple, Expression]' = weakref.WeakValueDictionary()
+
+
+def _Intern(cls: type, fields: tuple) -> Any:
+  """Returns the expression of type cls with fields, creating it if necessary."""
+  key = (cls, *fields)
+  result = _interned.get(key)
+  if result is None:
+    result = object.__new__(cls)
+    for name, value in zip(cls._FIELDS, fields):
+      object.__setattr__(result, name, value)
+    object.__setattr__(result, '_hash', hash(key))
+    _interned[key] = result
+  return result
+
+
 def _Constify(val: Union[bool, int, float, Expression]) -> Expression:
   """Used to ensure that the nodes in the expression tree are all Expression."""
   if isinstance(val, bool):
@@ -118,12 +202,15 @@ _PRECEDENCE = {
 
 class Operator(Expression):
   """Represents a binary operator in the parse tree."""
+  __slots__ = _FIELDS = ('operator', 'lhs', 'rhs')
+  operator: str
+  lhs: Expression
+  rhs: Expression
 
-  def __init__(self, operator: str, lhs: Union[int, float, Expression],
-               rhs: Union[int, float, Expression]):
-    self.operator = operator
-    self.lhs = _Constify(lhs)
-    self.rhs = _Constify(rhs)
+  def __new__(cls, operator: str, lhs: Union[int, float, Expression],
+              rhs: Union[int, float, Expression]):
+    # pylint: disable=redefined-outer-name
+    return _Intern(cls, (operator, _Constify(lhs), _Constify(rhs)))
 
   def Bracket(self,
               other: Expression,
@@ -148,174 +235,428 @@ class Operator(Expression):
     Returns:
       str: possibly bracketed other_str
     """
+    if self.NeedsBracket(other, rhs):
+      return f'({other_str})'
+    return other_str
+
+  def NeedsBracket(self, other: Expression, rhs: bool = False) -> bool:
+    """Is a bracket necessary around other, see Bracket."""
     if isinstance(other, Operator):
       if _PRECEDENCE.get(self.operator, -1) > _PRECEDENCE.get(
           other.operator, -1):
-        return f'({other_str})'
+        return True
       if rhs and _PRECEDENCE.get(self.operator, -1) == _PRECEDENCE.get(
           other.operator, -1):
-        return f'({other_str})'
-    return other_str
+        return True
+      # Chained comparisons, like 'a < b < c', don't parse.
+      if self.operator in _COMPARISONS and other.operator in _COMPARISONS:
+        return True
+    return False
 
-  def ToPerfJson(self):
-    return (f'{self.Bracket(self.lhs, self.lhs.ToPerfJson())} {self.operator} '
-            f'{self.Bracket(self.rhs, self.rhs.ToPerfJson(), True)}')
 
-  def ToPython(self):
-    return (f'{self.Bracket(self.lhs, self.lhs.ToPython())} {self.operator} '
-            f'{self.Bracket(self.rhs, self.rhs.ToPython(), True)}')
+def _ConstantValue(expr: Expression) -> Optional[Fraction]:
+  """The exact value of a Constant, None for other expressions."""
+  if not isinstance(expr, Constant):
+    return None
+  try:
+    return Fraction(expr.value)
+  except ValueError:
+    return None
 
-  def Simplify(self) -> Expression:
-    lhs = self.lhs.Simplify()
-    rhs = self.rhs.Simplify()
-    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
-      return Constant(ast.literal_eval(str(lhs) + self.operator + str(rhs)))
 
-    if isinstance(self.lhs, Constant):
-      if self.operator in ('+', '|') and lhs.value == '0':
-        return rhs
+def _FractionConstant(value: Fraction) -> 'Constant':
+  # Coefficients are sums and products of decimal constants, so the
+  # division is exact.
+  return Constant(str(decimal.Decimal(value.numerator) / value.denominator))
 
-      if self.operator == '*' and lhs.value == '0':
-        return Constant(0)
 
-      if self.operator == '*' and lhs.value == '1':
-        return rhs
+# Sums and products, as the operator and its inverse, with their identity.
+_SUM = ('+', '-', Fraction(0))
+_PRODUCT = ('*', '/', Fraction(1))
+# The group of each operator of a sum or product.
+_GROUPS = {'+': _SUM, '-': _SUM, '*': _PRODUCT, '/': _PRODUCT}
 
-    if isinstance(rhs, Constant):
-      if self.operator in ('+', '|') and rhs.value == '0':
-        return lhs
 
-      if self.operator == '*' and rhs.value == '0':
-        return Constant(0)
+# Factors and terms keyed by _CanonicalKey, holding the first expression
+# with the key and its exponent or coefficient.
+_Factors = Dict[Any, Tuple[Expression, int]]
+_Terms = Dict[Any, Tuple[Optional[Expression], Fraction]]
 
-      if self.operator == '*' and rhs.value == '1':
-        return lhs
 
-    return Operator(self.operator, lhs, rhs)
+def _IsChain(expr: Expression) -> bool:
+  """Is expr a sum or product."""
+  return isinstance(expr, Operator) and expr.operator in _GROUPS
 
-  def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Operator):
-      return self.operator == other.operator and self.lhs.Equals(
-          other.lhs) and self.rhs.Equals(other.rhs)
-    return False
 
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    if self.Equals(expression):
-      return Event(name)
-    lhs = self.lhs.Substitute(name, expression)
-    rhs = self.rhs.Substitute(name, expression)
-    return Operator(self.operator, lhs, rhs)
+def _ChainOperands(expr: Expression, group: Tuple[str, str, Fraction],
+                   sign: int = 1) -> List[Tuple[Expression, int]]:
+  """The operands of a sum or product, however bracketed, in order.
 
+  Each operand is paired with sign, negated when it is subtracted or
+  divided by. The chain is walked with an explicit stack, so long
+  chains don't exceed python's recursion limit.
+  """
+  result = []
+  stack = [(expr, sign)]
+  while stack:
+    e, s = stack.pop()
+    if isinstance(e, Operator) and e.operator in group[:2]:
+      stack.append((e.rhs, s if e.operator == group[0] else -s))
+      stack.append((e.lhs, s))
+    else:
+      result.append((e, s))
+  return result
 
-class Select(Expression):
-  """Represents a select ternary in the parse tree."""
 
-  def __init__(self, true_val: Union[int, float, Expression],
-               cond: Union[int, float, Expression],
-               false_val: Union[int, float, Expression]):
-    self.true_val = _Constify(true_val)
-    self.cond = _Constify(cond)
-    self.false_val = _Constify(false_val)
+def _CanonicalKey(expr: Expression) -> Any:
+  """A key equal for sums and products differing only in operand order."""
+  if not _IsChain(expr):
+    return expr
+  result = _canonical_keys.get(expr)
+  if result is not None:
+    return result
+  # The keys of sums within products, and products within sums, are
+  # found first, innermost first, rather than recursively.
+  stack = [expr]
+  while stack:
+    e = stack[-1]
+    if e in _canonical_keys:
+      stack.pop()
+      continue
+    group = _GROUPS[e.operator]
+    nested = [o for o, _ in _ChainOperands(e, group)
+              if _IsChain(o) and o not in _canonical_keys]
+    if nested:
+      stack.extend(nested)
+      continue
+    stack.pop()
+    if group is _SUM:
+      terms: _Terms = {}
+      _AddTerms(e, 1, terms)
+      key = ('+', frozenset((k, c) for k, (_, c) in terms.items() if c != 0))
+    else:
+      factors: _Factors = {}
+      constants = [Fraction(1), Fraction(1)]
+      _AddFactors(e, 1, factors, constants)
+      key = ('*', frozenset((k, x) for k, (_, x) in factors.items() if x != 0),
+             constants[0] / constants[1] if constants[1] else None)
+    _canonical_keys[e] = key
+  return _canonical_keys[expr]
 
-  def ToPerfJson(self):
-    true_str = self.true_val.ToPerfJson()
-    cond_str = self.cond.ToPerfJson()
-    false_str = self.false_val.ToPerfJson()
-    return f'({true_str} if {cond_str} else {false_str})'
 
-  def ToPython(self):
-    return (f'Select({self.true_val.ToPython()}, {self.cond.ToPython()}, '
-            f'{self.false_val.ToPython()})')
+def _AddFactors(expr: Expression, exponent: int, factors: _Factors,
+                constants: List[Fraction]) -> None:
+  """Adds the factors of a product.
 
-  def Simplify(self) -> Expression:
-    cond = self.cond.Simplify()
-    true_val = self.true_val.Simplify()
-    false_val = self.false_val.Simplify()
-    if isinstance(cond, Constant):
-      return false_val if cond.value == '0' else true_val
+  Constants multiply constants[0], or constants[1] when dividing, and
+  other factors have their exponent summed in factors.
+  """
+  for factor, sign in _ChainOperands(expr, _PRODUCT, exponent):
+    value = _ConstantValue(factor)
+    if value is not None and (sign > 0 or value != 0):
+      constants[0 if sign > 0 else 1] *= value
+      continue
+    key = _CanonicalKey(factor)
+    first, total = factors.get(key, (factor, 0))
+    factors[key] = (first, total + sign)
+
+
+def _BuildProduct(numerator: Fraction, denominator: Fraction,
+                  factors: _Factors) -> Expression:
+  """Multiplies the factors, constants first and divisors last."""
+  if numerator == 0:
+    return Constant(0)
+  sides: Tuple[List[Expression], List[Expression]] = ([], [])
+  for constant, side in ((numerator, sides[0]), (denominator, sides[1])):
+    if constant != 1:
+      side.append(_FractionConstant(constant))
+  for factor, exponent in factors.values():
+    sides[0 if exponent > 0 else 1].extend([factor] * abs(exponent))
+  products = []
+  for side in sides:
+    product = side[0] if side else Constant(1)
+    for factor in side[1:]:
+      product = Operator('*', product, factor)
+    products.append(product)
+  return Operator('/', *products) if sides[1] else products[0]
+
+
+def _SplitCoefficient(expr: Expression) -> Tuple[Fraction, Optional[Expression]]:
+  """Splits a term of a sum into a constant coefficient and the rest.
+
+  Constants are returned with None as the rest.
+  """
+  value = _ConstantValue(expr)
+  if value is not None:
+    return value, None
+  if not isinstance(expr, Operator) or expr.operator not in ('*', '/'):
+    return Fraction(1), expr
+  # Cached as an empty tuple when there's no coefficient, so that the
+  # cache doesn't hold on to expr.
+  result = _coefficients.get(expr)
+  if result is None:
+    result = ()
+    factors: _Factors = {}
+    constants = [Fraction(1), Fraction(1)]
+    _AddFactors(expr, 1, factors, constants)
+    if constants[0] != 1 and constants[1] == 1 and factors:
+      result = (constants[0], _BuildProduct(Fraction(1), Fraction(1), factors))
+    _coefficients[expr] = result
+  return result or (Fraction(1), expr)
+
+
+def _AddTerms(expr: Expression, sign: int, terms: _Terms) -> int:
+  """Adds the terms of a sum, returning how many there were."""
+  operands = _ChainOperands(expr, _SUM, sign)
+  for operand, s in operands:
+    coefficient, term = _SplitCoefficient(operand)
+    key = None if term is None else _CanonicalKey(term)
+    first, total = terms.get(key, (term, Fraction(0)))
+    terms[key] = (first, total + s * coefficient)
+  return len(operands)
+
+
+def _ScaleTerm(term: Optional[Expression], coefficient: Fraction) -> Expression:
+  """Returns coefficient * term, a term of None being 1."""
+  if term is None:
+    return _FractionConstant(coefficient)
+  factors: _Factors = {}
+  constants = [coefficient, Fraction(1)]
+  _AddFactors(term, 1, factors, constants)
+  return _BuildProduct(constants[0], constants[1], factors)
+
+
+def _Operands(expr: Expression, group: Tuple[str, str, Fraction], sign: int,
+              counts: Dict[Tuple[Any, bool], int]) -> None:
+  """Counts the non-constant operands of a sum or product by their sign."""
+  for operand, s in _ChainOperands(expr, group, sign):
+    if not isinstance(operand, Constant):
+      key = (_CanonicalKey(operand), s > 0)
+      counts[key] = counts.get(key, 0) + 1
+
+
+def _Combine(group: Tuple[str, str, Fraction], operator: str, lhs: Expression,
+             rhs: Expression) -> Expression:
+  """Returns 'lhs operator rhs' dropping identities, such as 'x * 1'."""
+  identity = _FractionConstant(group[2])
+  if rhs is identity:
+    return lhs
+  if operator == group[0]:
+    if lhs is identity:
+      return rhs
+    # '(1 / a) * b' is 'b / a' and '(0 - a) + b' is 'b - a'.
+    if (isinstance(lhs, Operator) and lhs.operator == group[1] and
+        lhs.lhs is identity):
+      return Operator(group[1], rhs, lhs.rhs)
+  return Operator(operator, lhs, rhs)
+
+
+def _Remove(expr: Expression, group: Tuple[str, str, Fraction], sign: int,
+            remove: Dict[Tuple[Any, bool], int]) -> Expression:
+  """Replaces the operands counted in remove by the identity."""
+  # Operators are rebuilt from their operands' results with an explicit
+  # stack, an entry with True marking that the operands are done.
+  results: List[Expression] = []
+  stack: List[Tuple[Expression, int, bool]] = [(expr, sign, False)]
+  while stack:
+    e, s, done = stack.pop()
+    if done:
+      rhs = results.pop()
+      lhs = results.pop()
+      if lhs is e.lhs and rhs is e.rhs:
+        results.append(e)
+      else:
+        results.append(_Combine(group, e.operator, lhs, rhs))
+    elif isinstance(e, Operator) and e.operator in group[:2]:
+      stack.append((e, s, True))
+      stack.append((e.rhs, s if e.operator == group[0] else -s, False))
+      stack.append((e.lhs, s, False))
+    elif isinstance(e, Constant):
+      results.append(e)
+    else:
+      key = (_CanonicalKey(e), s > 0)
+      if remove.get(key):
+        remove[key] -= 1
+        results.append(_FractionConstant(group[2]))
+      else:
+        results.append(e)
+  return results[0]
 
-    if true_val.Equals(false_val):
-      return true_val
 
-    return Select(true_val, cond, false_val)
+def _Cancel(expr: Expression, group: Tuple[str, str, Fraction]) -> Expression:
+  """Cancels operands that are both added and subtracted, or multiplied and divided.
 
-  def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Select):
-      return self.cond.Equals(other.cond) and self.false_val.Equals(
-          other.false_val) and self.true_val.Equals(other.true_val)
-    return False
+  Cancelled operands are removed from where they are, so the rest of the
+  expression, which may be another metric, keeps its structure.
+  """
+  counts: Dict[Tuple[Any, bool], int] = {}
+  _Operands(expr, group, 1, counts)
+  remove = {}
+  for (key, positive), count in counts.items():
+    if positive and (key, False) in counts:
+      remove[(key, True)] = remove[(key, False)] = builtins.min(count, counts[(key, False)])
+  return _Remove(expr, group, 1, remove) if remove else expr
 
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    if self.Equals(expression):
-      return Event(name)
-    true_val = self.true_val.Substitute(name, expression)
-    cond = self.cond.Substitute(name, expression)
-    false_val = self.false_val.Substitute(name, expression)
-    return Select(true_val, cond, false_val)
 
+def _FoldConstants(expr: Expression, group: Tuple[str, str, Fraction]) -> Expression:
+  """Folds the constants in a chain of sums or products, like 'a * 2 / 4 * 6'.
 
-class Function(Expression):
-  """A function in an expression like min, max, d_ratio."""
+  Only the chain, not bracketed operands, is folded. The folded
+  constant replaces the first constant. A product keeps a constant to
+  divide by unless the constant multiplied by is a multiple of it.
+  """
+  chain: List[Tuple[str, Expression]] = []
+  e = expr
+  while isinstance(e, Operator) and e.operator in group[:2]:
+    chain.append((e.operator, e.rhs))
+    e = e.lhs
+  chain.append((group[0], e))
+  if not any(isinstance(operand, Constant) for _, operand in chain):
+    return expr
+  chain.reverse()
+  product = group is _PRODUCT
+  # Folded constants keyed by the operator applying them, for sums '+',
+  # and the position of the first constant folded into each.
+  folded: Dict[str, Fraction] = {}
+  first: Dict[str, int] = {}
+  constants = set()
+  for position, (op, operand) in enumerate(chain):
+    value = _ConstantValue(operand)
+    if value is None or (product and op == '/' and value == 0):
+      continue
+    constants.add(position)
+    if product:
+      key = op
+      folded[key] = folded.get(key, Fraction(1)) * value
+    else:
+      key = '+'
+      folded[key] = folded.get(key, Fraction(0)) + (value if op == '+' else -value)
+    first.setdefault(key, position)
+  if product:
+    if folded.get('*') == 0:
+      return Constant(0)
+    if '/' in folded and (folded.get('*', Fraction(1)) / folded['/']).denominator == 1:
+      folded['*'] = folded.get('*', Fraction(1)) / folded.pop('/')
+      first.setdefault('*', first['/'])
+  folded = {key: value for key, value in folded.items()
+            if value != (1 if product else 0)}
+  if len(constants) <= len(folded):
+    return expr
+  replacements = {first[key]: key for key in folded}
+  result: Optional[Expression] = None
+  for position, (op, operand) in enumerate(chain):
+    if position in constants:
+      if position not in replacements:
+        continue
+      value = folded[replacements[position]]
+      if product:
+        op = replacements[position]
+      elif result is not None:
+        op = '+' if value > 0 else '-'
+        value = abs(value)
+      operand = _FractionConstant(value)
+    if result is None:
+      if op == group[0]:
+        result = operand
+      else:
+        result = Operator(op, _FractionConstant(group[2]), operand)
+    else:
+      result = Operator(op, result, operand)
+  return result if result is not None else _FractionConstant(group[2])
 
-  def __init__(self,
-               fn: str,
-               lhs: Union[int, float, Expression],
-               rhs: Optional[Union[int, float, Expression]] = None):
-    self.fn = fn
-    self.lhs = _Constify(lhs)
-    self.rhs = None if rhs is None else _Constify(rhs)
 
-  def ToPerfJson(self):
-    if self.rhs:
-      return f'{self.fn}({self.lhs.ToPerfJson()}, {self.rhs.ToPerfJson()})'
-    return f'{self.fn}({self.lhs.ToPerfJson()})'
+def _SimplifyProduct(operator: str, lhs: Expression, rhs: Expression) -> Expression:
+  """Cancels factors and folds the constants of a product.
 
-  def ToPython(self):
-    if self.rhs:
-      return f'{self.fn}({self.lhs.ToPython()}, {self.rhs.ToPython()})'
-    return f'{self.fn}({self.lhs.ToPython()})'
+  Dividing and multiplying by the same factor, found however the
+  product is bracketed and ordered, cancels, so 'a * b / (c * b)'
+  becomes 'a / c', and 'a * 2 / 4 * 6' becomes 'a * 3'.
+  """
+  return _FoldConstants(_Cancel(Operator(operator, lhs, rhs), _PRODUCT), _PRODUCT)
 
-  def Simplify(self) -> Expression:
-    lhs = self.lhs.Simplify()
-    rhs = self.rhs.Simplify() if self.rhs else None
-    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
-      if self.fn == 'd_ratio':
-        if rhs.value == '0':
-          return Constant(0)
-        Constant(ast.literal_eval(f'{lhs} / {rhs}'))
-      return Constant(ast.literal_eval(f'{self.fn}({lhs}, {rhs})'))
-
-    return Function(self.fn, lhs, rhs)
-
-  def Equals(self, other: Expression) -> bool:
-    if isinstance(other, Function):
-      result = self.fn == other.fn and self.lhs.Equals(other.lhs)
-      if self.rhs:
-        result = result and self.rhs.Equals(other.rhs)
-      return result
-    return False
 
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    if self.Equals(expression):
-      return Event(name)
-    lhs = self.lhs.Substitute(name, expression)
-    rhs = None
-    if self.rhs:
-      rhs = self.rhs.Substitute(name, expression)
-    return Function(self.fn, lhs, rhs)
+def _CountConstants(expr: Expression) -> int:
+  """The number of constant terms in a sum."""
+  return sum(isinstance(e, Constant) for e, _ in _ChainOperands(expr, _SUM))
+
+
+def _SimplifySum(operator: str, lhs: Expression, rhs: Expression) -> Expression:
+  """Cancels and merges the like terms, and folds the constants, of a sum.
+
+  Adding and subtracting the same term cancels. Other like terms, found
+  however the sum is bracketed and ordered, are merged by flattening
+  the sum into terms with constant coefficients, so 'a - (2 * a - b)'
+  becomes 'b - a'. Merged terms keep the order they first appear in,
+  other than a subtracted term not coming first, and constants last.
+  """
+  expr = _Cancel(Operator(operator, lhs, rhs), _SUM)
+  terms: _Terms = {}
+  count = _AddTerms(expr, 1, terms)
+  constant = terms.pop(None, None)
+  if len(terms) < count - _CountConstants(expr):
+    items = [tc for tc in terms.values() if tc[1] != 0]
+    if constant is not None and constant[1] != 0:
+      items.append(constant)
+    first = next((i for i, (_, c) in enumerate(items) if c > 0), None)
+    expr = Constant(0)
+    if first is not None:
+      term, c = items.pop(first)
+      expr = _ScaleTerm(term, c)
+    for term, c in items:
+      expr = Operator('+' if c > 0 else '-', expr, _ScaleTerm(term, abs(c)))
+  return _FoldConstants(expr, _SUM)
+
+
+class Select(Expression):
+  """Represents a select ternary in the parse tree."""
+  __slots__ = _FIELDS = ('true_val', 'cond', 'false_val')
+  true_val: Expression
+  cond: Expression
+  false_val: Expression
+
+  def __new__(cls, true_val: Union[int, float, Expression],
+              cond: Union[int, float, Expression],
+              false_val: Union[int, float, Expression]):
+    return _Intern(cls, (_Constify(true_val), _Constify(cond),
+                         _Constify(false_val)))
+
+
+class Function(Expression):
+  """A function in an expression like min, max, d_ratio."""
+  __slots__ = _FIELDS = ('fn', 'lhs', 'rhs')
+  fn: str
+  lhs: Expression
+  rhs: Optional[Expression]
+
+  def __new__(cls,
+              fn: str,
+              lhs: Union[int, float, Expression],
+              rhs: Optional[Union[int, float, Expression]] = None):
+    return _Intern(cls, (fn, _Constify(lhs),
+                         None if rhs is None else _Constify(rhs)))
 
 
 def _FixEscapes(s: str) -> str:
-  s = re.sub(r'([^\\]),', r'\1\\,', s)
-  return re.sub(r'([^\\])=', r'\1\\=', s)
+  if ',' in s:
+    s = re.sub(r'([^\\]),', r'\1\\,', s)
+  if '=' in s:
+    s = re.sub(r'([^\\])=', r'\1\\=', s)
+  return s
 
 
 class Event(Expression):
   """An event in an expression."""
+  __slots__ = _FIELDS = ('name', 'legacy_name')
+  name: str
+  legacy_name: str
+
+  def __new__(cls, name: str, legacy_name: str = ''):
+    return _Intern(cls, (_FixEscapes(name), _FixEscapes(legacy_name)))
 
-  def __init__(self, name: str, legacy_name: str = ''):
-    self.name = _FixEscapes(name)
-    self.legacy_name = _FixEscapes(legacy_name)
+  @classmethod
+  def Verbatim(cls, name: str) -> 'Event':
+    """Returns the event called name without escaping ',' and '='."""
+    return _Intern(cls, (name, ''))
 
   def ToPerfJson(self):
     result = re.sub('/', '@', self.name)
@@ -324,26 +665,20 @@ class Event(Expression):
   def ToPython(self):
     return f'Event(r"{self.name}")'
 
-  def Simplify(self) -> Expression:
-    return self
-
-  def Equals(self, other: Expression) -> bool:
-    return isinstance(other, Event) and self.name == other.name
-
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    return self
-
 
 class Constant(Expression):
   """A constant within the expression tree."""
+  __slots__ = _FIELDS = ('value',)
+  value: str
 
-  def __init__(self, value: Union[float, str]):
+  def __new__(cls, value: Union[float, str]):
     ctx = decimal.Context()
     ctx.prec = 20
     dec = ctx.create_decimal(repr(value) if isinstance(value, float) else value)
-    self.value = dec.normalize().to_eng_string()
-    self.value = self.value.replace('+', '')
-    self.value = self.value.replace('E', 'e')
+    value = dec.normalize().to_eng_string()
+    value = value.replace('+', '')
+    value = value.replace('E', 'e')
+    return _Intern(cls, (value,))
 
   def ToPerfJson(self):
     return self.value
@@ -351,21 +686,14 @@ class Constant(Expression):
   def ToPython(self):
     return f'Constant({self.value})'
 
-  def Simplify(self) -> Expression:
-    return self
-
-  def Equals(self, other: Expression) -> bool:
-    return isinstance(other, Constant) and self.value == other.value
-
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    return self
-
 
 class Literal(Expression):
   """A runtime literal within the expression tree."""
+  __slots__ = _FIELDS = ('value',)
+  value: str
 
-  def __init__(self, value: str):
-    self.value = value
+  def __new__(cls, value: str):
+    return _Intern(cls, (value,))
 
   def ToPerfJson(self):
     return self.value
@@ -373,15 +701,6 @@ class Literal(Expression):
   def ToPython(self):
     return f'Literal({self.value})'
 
-  def Simplify(self) -> Expression:
-    return self
-
-  def Equals(self, other: Expression) -> bool:
-    return isinstance(other, Literal) and self.value == other.value
-
-  def Substitute(self, name: str, expression: Expression) -> Expression:
-    return self
-
 
 def min(lhs: Union[int, float, Expression], rhs: Union[int, float,
                                                        Expression]) -> Function:
@@ -416,6 +735,785 @@ def has_event(event: Event) -> Function:
   return Function('has_event', event)
 
 
+# Functions that may be called within a parsed expression.
+_FUNCTIONS = {
+    'min': min,
+    'max': max,
+    'd_ratio': d_ratio,
+    'source_count': source_count,
+    'has_event': has_event,
+}
+
+
+class ExpressionVisitor:
+  """Computes a value for an expression from the values of its operands.
+
+  Expressions are walked with an explicit stack, rather than recursion,
+  so that deeply nested expressions don't exceed python's recursion
+  limit. The value of each distinct subexpression is computed once and
+  reused where it is shared. Passes over expressions subclass this,
+  or ExpressionTransformer, overriding the Visit methods for the nodes
+  they handle. Visiting an unhandled node raises NotImplementedError.
+  """
+
+  def __init__(self):
+    self.results: Dict[Expression, Any] = {}
+
+  def Replace(self, expr: Expression) -> Any:
+    """Returns the value of expr without visiting its operands, or None."""
+    # pylint: disable=unused-argument
+    return None
+
+  def VisitOperator(self, expr: 'Operator', lhs: Any, rhs: Any) -> Any:
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def VisitSelect(self, expr: 'Select', true_val: Any, cond: Any,
+                  false_val: Any) -> Any:
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def VisitFunction(self, expr: 'Function', lhs: Any, rhs: Any) -> Any:
+    """Visits a function, rhs is None for a function of one argument."""
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def VisitEvent(self, expr: 'Event') -> Any:
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def VisitConstant(self, expr: 'Constant') -> Any:
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def VisitLiteral(self, expr: 'Literal') -> Any:
+    raise NotImplementedError(f'{type(self).__name__} of {expr}')
+
+  def Visit(self, expr: Expression) -> Any:
+    """Returns the value of expr, visiting operands before their users."""
+    results = self.results
+    if expr in results:
+      return results[expr]
+    leaves = {Event: self.VisitEvent, Constant: self.VisitConstant,
+              Literal: self.VisitLiteral}
+    replace = None
+    if type(self).Replace is not ExpressionVisitor.Replace:
+      replace = self.Replace
+    # Nodes to visit, a None marks that the operands of the last
+    # pending node have values.
+    stack: List[Optional[Expression]] = [expr]
+    pending: List[Expression] = []
+    push = stack.append
+    pop = stack.pop
+    while stack:
+      node = pop()
+      if node is None:
+        node = pending.pop()
+        cls = type(node)
+        if cls is Operator:
+          results[node] = self.VisitOperator(node, results[node.lhs], results[node.rhs])
+        elif cls is Select:
+          results[node] = self.VisitSelect(node, results[node.true_val],
+                                           results[node.cond], results[node.false_val])
+        else:
+          results[node] = self.VisitFunction(
+              node, results[node.lhs], None if node.rhs is None else results[node.rhs])
+        continue
+      if node in results:
+        continue
+      if replace:
+        value = replace(node)
+        if value is not None:
+          results[node] = value
+          continue
+      cls = type(node)
+      leaf = leaves.get(cls)
+      if leaf:
+        results[node] = leaf(node)
+        continue
+      pending.append(node)
+      push(None)
+      if cls is Operator:
+        push(node.rhs)
+        push(node.lhs)
+      elif cls is Select:
+        push(node.false_val)
+        push(node.cond)
+        push(node.true_val)
+      elif cls is Function:
+        if node.rhs is not None:
+          push(node.rhs)
+        push(node.lhs)
+      else:
+        raise ValueError(f'Unexpected expression {node!r}')
+    return results[expr]
+
+
+class ExpressionTransformer(ExpressionVisitor):
+  """Rewrites an expression a node at a time.
+
+  By default a node is rebuilt from the rewritten operands, or kept
+  when none of them changed.
+  """
+
+  def VisitOperator(self, expr: 'Operator', lhs: Expression,
+                    rhs: Expression) -> Expression:
+    if lhs is expr.lhs and rhs is expr.rhs:
+      return expr
+    return Operator(expr.operator, lhs, rhs)
+
+  def VisitSelect(self, expr: 'Select', true_val: Expression, cond: Expression,
+                  false_val: Expression) -> Expression:
+    if true_val is expr.true_val and cond is expr.cond and false_val is expr.false_val:
+      return expr
+    return Select(true_val, cond, false_val)
+
+  def VisitFunction(self, expr: 'Function', lhs: Expression,
+                    rhs: Optional[Expression]) -> Expression:
+    if lhs is expr.lhs and rhs is expr.rhs:
+      return expr
+    return Function(expr.fn, lhs, rhs)
+
+  def VisitEvent(self, expr: 'Event') -> Expression:
+    return expr
+
+  def VisitConstant(self, expr: 'Constant') -> Expression:
+    return expr
+
+  def VisitLiteral(self, expr: 'Literal') -> Expression:
+    return expr
+
+
+class _ExpressionWriter:
+  """Writes an expression's text a piece at a time.
+
+  Unlike a visitor the text of each operand isn't held, only appended
+  to, so the memory used is proportional to the length of the text
+  even for deeply nested expressions.
+  """
+  # Text before, between and after a Select's operands.
+  SELECT: Tuple[str, str, str, str] = ('(', ' if ', ' else ', ')')
+
+  def Leaf(self, expr: Expression) -> str:
+    raise NotImplementedError()
+
+  def Write(self, expr: Expression) -> str:
+    pieces: List[str] = []
+    # Expressions to write, or text to append.
+    stack: List[Union[Expression, str]] = [expr]
+    while stack:
+      item = stack.pop()
+      if isinstance(item, str):
+        pieces.append(item)
+      elif isinstance(item, Operator):
+        if item.NeedsBracket(item.rhs, True):
+          stack.extend((')', item.rhs, f' {item.operator} ('))
+        else:
+          stack.extend((item.rhs, f' {item.operator} '))
+        if item.NeedsBracket(item.lhs):
+          stack.extend((')', item.lhs, '('))
+        else:
+          stack.append(item.lhs)
+      elif isinstance(item, Select):
+        before, if_, else_, after = self.SELECT
+        stack.extend((after, item.false_val, else_, item.cond, if_, item.true_val, before))
+      elif isinstance(item, Function):
+        if item.rhs is not None:
+          stack.extend((')', item.rhs, ', ', item.lhs, f'{item.fn}('))
+        else:
+          stack.extend((')', item.lhs, f'{item.fn}('))
+      else:
+        pieces.append(self.Leaf(item))
+    return ''.join(pieces)
+
+
+class _PerfJsonWriter(_ExpressionWriter):
+  """Writes an expression in the form used by perf json files."""
+
+  def Leaf(self, expr: Expression) -> str:
+    return expr.ToPerfJson()
+
+
+class _PythonWriter(_ExpressionWriter):
+  """Writes an expression as python that builds it with this module."""
+  SELECT = ('Select(', ', ', ', ', ')')
+
+  def Leaf(self, expr: Expression) -> str:
+    return expr.ToPython()
+
+
+class _Simplifier(ExpressionTransformer):
+  """Cancels like terms and folds constants, see Expression.Simplify.
+
+  A chain of sums or products, like 'a + b - c + d', is simplified
+  once at its root. Simplifying each of its left operands too would
+  flatten the chain below every node, taking time quadratic in its
+  length.
+  """
+
+  def __init__(self):
+    super().__init__()
+    # Sums and products only used as the lhs of the same operation.
+    self.chained: Set[Expression] = set()
+
+  def Visit(self, expr: Expression) -> Expression:
+    chained: Set[Expression] = set()
+    unchained: Set[Expression] = {expr}
+    seen: Set[Expression] = set()
+    stack = [expr]
+    while stack:
+      node = stack.pop()
+      if node in seen:
+        continue
+      seen.add(node)
+      if isinstance(node, Operator):
+        lhs = node.lhs
+        group = _GROUPS.get(node.operator)
+        if (group and isinstance(lhs, Operator) and
+            _GROUPS.get(lhs.operator) is group):
+          chained.add(lhs)
+        else:
+          unchained.add(lhs)
+        unchained.add(node.rhs)
+        stack.extend((lhs, node.rhs))
+      elif isinstance(node, Select):
+        operands = (node.true_val, node.cond, node.false_val)
+        unchained.update(operands)
+        stack.extend(operands)
+      elif isinstance(node, Function):
+        operands = (node.lhs,) if node.rhs is None else (node.lhs, node.rhs)
+        unchained.update(operands)
+        stack.extend(operands)
+    self.chained = chained - unchained
+    return super().Visit(expr)
+
+  def VisitOperator(self, expr: 'Operator', lhs: Expression,
+                    rhs: Expression) -> Expression:
+    if expr in self.chained:
+      return super().VisitOperator(expr, lhs, rhs)
+    if expr.operator in ('+', '-'):
+      return _SimplifySum(expr.operator, lhs, rhs)
+    if expr.operator in ('*', '/'):
+      return _SimplifyProduct(expr.operator, lhs, rhs)
+
+    if isinstance(lhs, Constant) and isinstance(rhs, Constant):
+      fn = _OPERATORS.get(expr.operator) or _COMPARISONS[expr.operator]
+      try:
+        return _Constify(fn(ast.literal_eval(lhs.value), ast.literal_eval(rhs.value)))
+      except (TypeError, ZeroDivisionError):
+        pass
+
+    if expr.operator == '|':
+      if isinstance(lhs, Constant) and lhs.value == '0':
+        return rhs
+      if isinstance(rhs, Constant) and rhs.value == '0':
+        return lhs
+
+    return Operator(expr.operator, lhs, rhs)
+
+  def VisitSelect(self, expr: 'Select', true_val: Expression, cond: Expression,
+                  false_val: Expression) -> Expression:
+    if isinstance(cond, Constant):
+      return false_val if cond.value == '0' else true_val
+
+    if true_val is false_val:
+      return true_val
+
+    return Select(true_val, cond, false_val)
+
+  def VisitFunction(self, expr: 'Function', lhs: Expression,
+                    rhs: Optional[Expression]) -> Expression:
+    lhs_value = _ConstantValue(lhs)
+    rhs_value = None if rhs is None else _ConstantValue(rhs)
+    if lhs_value is not None and rhs_value is not None:
+      if expr.fn == 'd_ratio':
+        return _SimplifyProduct('/', lhs, rhs) if rhs_value else Constant(0)
+      if expr.fn in ('min', 'max'):
+        return _FractionConstant(getattr(builtins, expr.fn)(lhs_value, rhs_value))
+
+    return Function(expr.fn, lhs, rhs)
+
+
+class _Substituter(ExpressionTransformer):
+  """Replaces an expression with an event, see Expression.Substitute."""
+
+  def __init__(self, name: str, expression: Expression):
+    super().__init__()
+    self.name = name
+    self.expression = expression
+
+  def Replace(self, expr: Expression) -> Optional[Expression]:
+    # Events, constants and literals are left as they are.
+    if isinstance(expr, (Event, Constant, Literal)):
+      return None
+    return Event(self.name) if expr is self.expression else None
+
+
+def _RunSteps(steps: Generator[Any, Any, Any]) -> Any:
+  """Runs a computation written as generators rather than recursively.
+
+  A generator yields the generator computing a value it needs, such as
+  an operand's, and is sent that value. Its own value is the one it
+  returns. The generators are run with an explicit stack, so deeply
+  nested expressions don't exceed python's recursion limit.
+  """
+  stack = [steps]
+  value = None
+  while True:
+    try:
+      nested = stack[-1].send(value)
+    except StopIteration as stop:
+      stack.pop()
+      if not stack:
+        return stop.value
+      value = stop.value
+    else:
+      stack.append(nested)
+      value = None
+
+
+class _Compiler:
+  """Generates python computing an expression one node per statement.
+
+  Each node's value is held in a local variable so shared
+  subexpressions are only computed once. Select branches are only
+  computed when taken, so that events guarded by has_event needn't
+  have values.
+  """
+
+  def __init__(self, metrics: Optional[Mapping[str, Expression]] = None):
+    self.lines: List[str] = []
+    self.temps = 0
+    # Metrics, by lower case name, that events may refer to.
+    self.metrics = metrics or {}
+    self.emitting: Set[str] = set()
+
+  def Build(self, source: str, filename: str) -> Callable[[Mapping[str, float]], Any]:
+    namespace = {'nan': math.nan, 'fmod': math.fmod, 'isfinite': math.isfinite}
+    # The source only holds code generated by Emit below.
+    exec(compile(source, filename, 'exec'), namespace)  # nosec
+    return namespace['_metric']
+
+  def Compile(self, expr: Expression) -> Callable[[Mapping[str, float]], float]:
+    result = self.Emit(expr, {}, '  ')
+    source = '\n'.join(['def _metric(v):', *self.lines, f'  return {result}'])
+    return self.Build(source, f'<metric {expr}>')
+
+  def CompileMetrics(self, names: List[str]
+                     ) -> Callable[[Mapping[str, float]], Dict[str, float]]:
+    values: Dict[Expression, str] = {}
+    results = [f'{name!r}: {self.EmitMetric(name, values)}' for name in names]
+    source = '\n'.join(['def _metric(v):', *self.lines,
+                        f'  return {{{", ".join(results)}}}'])
+    return self.Build(source, f'<{len(names)} metrics>')
+
+  def EmitMetric(self, name: str, values: Dict[Expression, str]) -> str:
+    """Emits statements computing the named metric at the outermost level."""
+    lower_name = name.lower()
+    if lower_name in self.emitting:
+      raise ValueError(f'Metric {name} refers to itself')
+    expr = self.metrics[lower_name]
+    if expr in values:
+      return values[expr]
+    self.emitting.add(lower_name)
+    # Compute referenced metrics first, so that they're shared even
+    # when referenced from within a Select branch.
+    references = {e.ToPerfJson().lower() for e in _Events(expr)}
+    for reference in sorted(references.intersection(self.metrics)):
+      self.EmitMetric(reference, values)
+    result = self.Emit(expr, values, '  ')
+    self.emitting.remove(lower_name)
+    return result
+
+  def Emit(self, expr: Expression, values: Dict[Expression, str], indent: str) -> str:
+    """Emits statements computing expr, returning the python for its value."""
+    return _RunSteps(self.EmitSteps(expr, values, indent))
+
+  def EmitSteps(self, expr: Expression, values: Dict[Expression, str],
+                indent: str) -> Generator[Any, Any, str]:
+    """Emit as steps run by _RunSteps, yielding the emitting of operands."""
+    if isinstance(expr, Constant):
+      return repr(float(expr.value))
+    if expr in values:
+      return values[expr]
+    if isinstance(expr, Event) and expr.ToPerfJson().lower() in self.metrics:
+      return (yield self.EmitSteps(self.metrics[expr.ToPerfJson().lower()], values, indent))
+    result = f't{self.temps}'
+    self.temps += 1
+    if isinstance(expr, (Event, Literal)):
+      self.lines.append(f'{indent}{result} = v[{expr.ToPerfJson()!r}]')
+    elif isinstance(expr, Operator):
+      lhs = yield self.EmitSteps(expr.lhs, values, indent)
+      rhs = yield self.EmitSteps(expr.rhs, values, indent)
+      op = expr.operator
+      if op == '/':
+        value = f'{lhs} / {rhs} if {rhs} else nan'
+      elif op == '%':
+        # NaN, rather than failing to convert, for NaN or infinite operands.
+        value = (f'fmod(int({lhs}), int({rhs})) if isfinite({lhs}) and '
+                 f'isfinite({rhs}) and int({rhs}) else nan')
+      elif op in ('<', '>'):
+        value = f'1.0 if {lhs} {op} {rhs} else 0.0'
+      elif op in ('&', '|', '^'):
+        # False for NaN or infinite operands, like a comparison with NaN.
+        value = (f'float(int({lhs}) {op} int({rhs})) if isfinite({lhs}) and '
+                 f'isfinite({rhs}) else 0.0')
+      else:
+        value = f'{lhs} {op} {rhs}'
+      self.lines.append(f'{indent}{result} = {value}')
+    elif isinstance(expr, Select):
+      cond = yield self.EmitSteps(expr.cond, values, indent)
+      self.lines.append(f'{indent}if {cond}:')
+      true_val = yield self.EmitSteps(expr.true_val, dict(values), indent + '  ')
+      self.lines.append(f'{indent}  {result} = {true_val}')
+      self.lines.append(f'{indent}else:')
+      false_val = yield self.EmitSteps(expr.false_val, dict(values), indent + '  ')
+      self.lines.append(f'{indent}  {result} = {false_val}')
+    elif isinstance(expr, Function) and expr.fn in ('has_event', 'source_count'):
+      if not isinstance(expr.lhs, Event):
+        raise ValueError(f'Expected an event argument in {expr}')
+      name = expr.lhs.ToPerfJson()
+      if expr.fn == 'has_event':
+        value = f'1.0 if {name!r} in v else 0.0'
+      else:
+        value = f'v.get({f"source_count({name})"!r}, 1.0)'
+      self.lines.append(f'{indent}{result} = {value}')
+    elif isinstance(expr, Function) and expr.fn in ('min', 'max', 'd_ratio'):
+      lhs = yield self.EmitSteps(expr.lhs, values, indent)
+      rhs = yield self.EmitSteps(expr.rhs, values, indent)
+      if expr.fn == 'd_ratio':
+        value = f'{lhs} / {rhs} if {rhs} else 0.0'
+      else:
+        value = f'{expr.fn}({lhs}, {rhs})'
+      self.lines.append(f'{indent}{result} = {value}')
+    else:
+      raise ValueError(f'Unable to compile {expr}')
+    values[expr] = result
+    return result
+
+
+class _ArrayEvaluator:
+  """Computes expressions over numpy arrays a node at a time.
+
+  The per-node work is done by numpy for all samples at once. Values
+  of shared subexpressions are remembered. A Select only computes
+  both branches when the condition differs between samples.
+  """
+
+  def __init__(self, values: Mapping[str, Any]):
+    self.values = values
+    self.memo: Dict[Expression, Any] = {}
+    shapes = [np.shape(x) for x in values.values()]
+    self.shape = np.broadcast_shapes(*shapes) if shapes else ()
+
+  def Evaluate(self, expr: Expression) -> Any:
+    with np.errstate(all='ignore'):
+      result = self.Visit(expr)
+    return np.broadcast_to(np.asarray(result, dtype=np.float64), self.shape).copy()
+
+  @staticmethod
+  def Divide(lhs: Any, rhs: Any, default: float) -> Any:
+    """lhs / rhs, or default where rhs is zero."""
+    lhs, rhs = np.broadcast_arrays(np.asarray(lhs, dtype=np.float64),
+                                   np.asarray(rhs, dtype=np.float64))
+    return np.divide(lhs, rhs, out=np.full(lhs.shape, default), where=rhs != 0)
+
+  def Visit(self, expr: Expression) -> Any:
+    return _RunSteps(self.VisitSteps(expr))
+
+  def VisitSteps(self, expr: Expression) -> Generator[Any, Any, Any]:
+    """Visit as steps run by _RunSteps, yielding the visiting of operands."""
+    if isinstance(expr, Constant):
+      return float(expr.value)
+    if expr in self.memo:
+      return self.memo[expr]
+    if isinstance(expr, (Event, Literal)):
+      result = np.asarray(self.values[expr.ToPerfJson()], dtype=np.float64)
+    elif isinstance(expr, Operator):
+      lhs = yield self.VisitSteps(expr.lhs)
+      rhs = yield self.VisitSteps(expr.rhs)
+      op = expr.operator
+      if op == '/':
+        result = self.Divide(lhs, rhs, math.nan)
+      elif op == '%':
+        finite = np.isfinite(lhs) & np.isfinite(rhs)
+        rhs = np.trunc(rhs)
+        result = np.where(finite & (rhs != 0), np.fmod(np.trunc(lhs), rhs), math.nan)
+      elif op in ('<', '>'):
+        result = np.where(lhs < rhs if op == '<' else lhs > rhs, 1.0, 0.0)
+      elif op in ('&', '|', '^'):
+        finite = np.isfinite(lhs) & np.isfinite(rhs)
+        ufunc = {'&': np.bitwise_and, '|': np.bitwise_or, '^': np.bitwise_xor}[op]
+        result = np.where(finite, ufunc(np.trunc(np.where(finite, lhs, 0)).astype(np.int64),
+                                        np.trunc(np.where(finite, rhs, 0)).astype(np.int64)),
+                          0.0)
+      else:
+        result = _OPERATORS[op](lhs, rhs)
+    elif isinstance(expr, Select):
+      cond = np.asarray((yield self.VisitSteps(expr.cond))) != 0
+      if cond.all():
+        result = yield self.VisitSteps(expr.true_val)
+      elif not cond.any():
+        result = yield self.VisitSteps(expr.false_val)
+      else:
+        true_val = yield self.VisitSteps(expr.true_val)
+        false_val = yield self.VisitSteps(expr.false_val)
+        result = np.where(cond, true_val, false_val)
+    elif isinstance(expr, Function) and expr.fn in ('has_event', 'source_count'):
+      if not isinstance(expr.lhs, Event):
+        raise ValueError(f'Expected an event argument in {expr}')
+      name = expr.lhs.ToPerfJson()
+      if expr.fn == 'has_event':
+        result = 1.0 if name in self.values else 0.0
+      else:
+        result = np.asarray(self.values.get(f'source_count({name})', 1.0), dtype=np.float64)
+    elif isinstance(expr, Function) and expr.fn in ('min', 'max', 'd_ratio'):
+      lhs = yield self.VisitSteps(expr.lhs)
+      rhs = yield self.VisitSteps(expr.rhs)
+      if expr.fn == 'd_ratio':
+        result = self.Divide(lhs, rhs, 0.0)
+      elif expr.fn == 'min':
+        # Like python's min and max, NaN is only chosen when it is the lhs.
+        result = np.where(rhs < lhs, rhs, lhs)
+      else:
+        result = np.where(rhs > lhs, rhs, lhs)
+    else:
+      raise ValueError(f'Unable to evaluate {expr}')
+    self.memo[expr] = result
+    return result
+
+
+def CompileMetrics(metrics: list[Tuple[str, Expression]]
+                   ) -> Callable[[Mapping[str, float]], Dict[str, float]]:
+  """Returns a function computing every metric of a model at once.
+
+  The metrics are compiled into one function, so that a subexpression
+  shared by several metrics, such as a thread's slots or clocks, is
+  computed once per sample. Like in perf, an event named after a metric
+  refers to that metric's value, so the metrics of a generated
+  <model>-metrics.json may be compiled as they are. The function takes
+  the same values as those from Expression.Compile and returns a
+  mapping from each metric name to its value.
+
+  Args:
+    metrics (list): pairs of metric names and their expressions.
+  Returns:
+    Callable: function computing a dictionary of metric values.
+  """
+  compiler = _Compiler({name.lower(): expr for name, expr in metrics})
+  return compiler.CompileMetrics([name for name, _ in metrics])
+
+
+# Opcodes of a FlatExpression. Binary operators and functions pop two
+# values and push one, in the order of _FLAT_BINARY. The others are
+# followed by an argument word.
+_FLAT_BINARY = ('+', '-', '*', '/', '%', '<', '>', '&', '|', '^', 'min', 'max', 'd_ratio')
+(_FLAT_EVENT, _FLAT_LITERAL, _FLAT_CONSTANT, _FLAT_HAS_EVENT, _FLAT_SOURCE_COUNT,
+ _FLAT_IF, _FLAT_ELSE) = range(len(_FLAT_BINARY), len(_FLAT_BINARY) + 7)
+
+# Functions computing the opcodes in _FLAT_BINARY like Compile.
+_FLAT_FUNCTIONS: Tuple[Callable[[float, float], float], ...] = (
+    operator.add,
+    operator.sub,
+    operator.mul,
+    lambda lhs, rhs: lhs / rhs if rhs else math.nan,
+    lambda lhs, rhs: (math.fmod(int(lhs), int(rhs)) if math.isfinite(lhs) and
+                      math.isfinite(rhs) and int(rhs) else math.nan),
+    lambda lhs, rhs: 1.0 if lhs < rhs else 0.0,
+    lambda lhs, rhs: 1.0 if lhs > rhs else 0.0,
+    lambda lhs, rhs: (float(int(lhs) & int(rhs)) if math.isfinite(lhs) and
+                      math.isfinite(rhs) else 0.0),
+    lambda lhs, rhs: (float(int(lhs) | int(rhs)) if math.isfinite(lhs) and
+                      math.isfinite(rhs) else 0.0),
+    lambda lhs, rhs: (float(int(lhs) ^ int(rhs)) if math.isfinite(lhs) and
+                      math.isfinite(rhs) else 0.0),
+    builtins.min,
+    builtins.max,
+    lambda lhs, rhs: lhs / rhs if rhs else 0.0,
+)
+
+
+class FlatExpression:
+  """An expression encoded as postfix opcodes, compact to hold and evaluate.
+
+  The code is an array of 16-bit words and the operands a table of the
+  interned names of events and literals and values of constants. No
+  expression objects are held. Events, literals and constants push
+  their value, given by the following word's index in the table.
+  Operators and functions pop the values of their operands and push
+  their result, has_event and source_count being followed by their
+  event's index. A Select is encoded with forward jumps, so only the
+  branch taken is computed:
+
+    cond _FLAT_IF <true words + 2> true_val _FLAT_ELSE <false words> false_val
+
+  Shared subexpressions are repeated in the code. Events with a legacy
+  name aren't supported.
+  """
+  __slots__ = ('code', 'operands', '_loads')
+
+  def __init__(self, expr: Expression):
+    code = array.array('H')
+    operands: List[str] = []
+    indices: Dict[Tuple[int, str], int] = {}
+    # Positions of the _FLAT_IF or _FLAT_ELSE whose jump is unknown.
+    jumps: List[int] = []
+
+    def Operand(op: int, text: str) -> None:
+      key = (op, text)
+      if key not in indices:
+        indices[key] = len(operands)
+        operands.append(sys.intern(text))
+      code.extend((op, indices[key]))
+
+    # Expressions to encode, or opcodes to write with -1 marking the
+    # end of a Select.
+    stack: List[Union[Expression, int]] = [expr]
+    try:
+      while stack:
+        item = stack.pop()
+        if isinstance(item, int):
+          if item == _FLAT_IF:
+            jumps.append(len(code))
+            code.extend((_FLAT_IF, 0))
+          elif item == _FLAT_ELSE:
+            pos = jumps.pop()
+            code[pos + 1] = len(code) + 2 - (pos + 2)
+            jumps.append(len(code))
+            code.extend((_FLAT_ELSE, 0))
+          elif item == -1:
+            pos = jumps.pop()
+            code[pos + 1] = len(code) - (pos + 2)
+          else:
+            code.append(item)
+        elif isinstance(item, Event) and not item.legacy_name:
+          Operand(_FLAT_EVENT, item.name)
+        elif isinstance(item, Literal):
+          Operand(_FLAT_LITERAL, item.value)
+        elif isinstance(item, Constant):
+          Operand(_FLAT_CONSTANT, item.value)
+        elif isinstance(item, Operator):
+          stack.extend((_FLAT_BINARY.index(item.operator), item.rhs, item.lhs))
+        elif isinstance(item, Select):
+          stack.extend((-1, item.false_val, _FLAT_ELSE, item.true_val, _FLAT_IF, item.cond))
+        elif isinstance(item, Function) and item.fn in ('has_event', 'source_count'):
+          if not isinstance(item.lhs, Event) or item.lhs.legacy_name:
+            raise ValueError(f'Expected an event argument in {item}')
+          Operand(_FLAT_HAS_EVENT if item.fn == 'has_event' else _FLAT_SOURCE_COUNT,
+                  item.lhs.name)
+        elif isinstance(item, Function) and item.fn in ('min', 'max', 'd_ratio'):
+          stack.extend((_FLAT_BINARY.index(item.fn), item.rhs, item.lhs))
+        else:
+          raise ValueError(f'Unable to flatten {item}')
+    except OverflowError as e:
+      raise ValueError(f'Expression too large to flatten: {expr}') from e
+    self.code = code
+    self.operands = tuple(operands)
+    # The operands as values of constants and names in the values
+    # Evaluate takes, computed when first evaluated.
+    self._loads: Optional[Tuple[Union[float, str], ...]] = None
+
+  def ToExpression(self) -> Expression:
+    """Returns the expression that was flattened."""
+    code = self.code
+    operands = self.operands
+    values: List[Expression] = []
+    # End positions of the false values of Selects being decoded.
+    ends: List[int] = []
+    pc = 0
+    while pc < len(code):
+      op = code[pc]
+      if op < _FLAT_EVENT:
+        pc += 1
+        rhs = values.pop()
+        lhs = values.pop()
+        name = _FLAT_BINARY[op]
+        if name in _FUNCTIONS:
+          values.append(Function(name, lhs, rhs))
+        else:
+          values.append(Operator(name, lhs, rhs))
+      else:
+        arg = code[pc + 1]
+        pc += 2
+        if op == _FLAT_EVENT:
+          values.append(Event.Verbatim(operands[arg]))
+        elif op == _FLAT_LITERAL:
+          values.append(Literal(operands[arg]))
+        elif op == _FLAT_CONSTANT:
+          values.append(_Intern(Constant, (operands[arg],)))
+        elif op == _FLAT_HAS_EVENT:
+          values.append(has_event(Event.Verbatim(operands[arg])))
+        elif op == _FLAT_SOURCE_COUNT:
+          values.append(source_count(Event.Verbatim(operands[arg])))
+        elif op == _FLAT_ELSE:
+          ends.append(pc + arg)
+        # A _FLAT_IF leaves its condition on the stack.
+      while ends and ends[-1] == pc:
+        ends.pop()
+        false_val = values.pop()
+        true_val = values.pop()
+        values.append(Select(true_val, values.pop(), false_val))
+    return values.pop()
+
+  def Loads(self) -> Tuple[Union[float, str], ...]:
+    """The values of constants and, for other operands, the names Evaluate reads."""
+    if self._loads is None:
+      loads: List[Union[float, str]] = list(self.operands)
+      code = self.code
+      pc = 0
+      while pc < len(code):
+        op = code[pc]
+        if op < _FLAT_EVENT:
+          pc += 1
+          continue
+        arg = code[pc + 1]
+        pc += 2
+        if op == _FLAT_CONSTANT:
+          loads[arg] = float(self.operands[arg])
+        elif op in (_FLAT_EVENT, _FLAT_HAS_EVENT, _FLAT_SOURCE_COUNT):
+          # As written by Event.ToPerfJson.
+          loads[arg] = self.operands[arg].replace('/', '@')
+      self._loads = tuple(loads)
+    return self._loads
+
+  def Evaluate(self, values: Mapping[str, float]) -> float:
+    """Computes the expression's value from the values Compile's function takes."""
+    loads = self._loads or self.Loads()
+    functions = _FLAT_FUNCTIONS
+    code = self.code
+    end = len(code)
+    stack: List[float] = []
+    push = stack.append
+    pop = stack.pop
+    pc = 0
+    while pc < end:
+      op = code[pc]
+      if op < _FLAT_EVENT:
+        pc += 1
+        rhs = pop()
+        stack[-1] = functions[op](stack[-1], rhs)
+        continue
+      arg = code[pc + 1]
+      pc += 2
+      if op <= _FLAT_CONSTANT:
+        load = loads[arg]
+        push(load if type(load) is float else values[load])
+      elif op == _FLAT_IF:
+        if not pop():
+          pc += arg
+      elif op == _FLAT_ELSE:
+        pc += arg
+      elif op == _FLAT_HAS_EVENT:
+        push(1.0 if loads[arg] in values else 0.0)
+      else:
+        push(values.get(f'source_count({loads[arg]})', 1.0))
+    return stack[0]
+
+
+# Canonical keys of expressions that have been simplified, and their
+# split into a coefficient and the rest when a term of a sum.
+_canonical_keys: 'weakref.WeakKeyDictionary[Expression, Any]' = weakref.WeakKeyDictionary()
+_coefficients: 'weakref.WeakKeyDictionary[Expression, Tuple]' = weakref.WeakKeyDictionary()
+
+# Compiled expressions.
+_compiled: 'weakref.WeakKeyDictionary[Expression, Callable[[Mapping[str, float]], float]]' = weakref.WeakKeyDictionary()
+
+
 class Metric:
   """An individual metric that will specifiable on the perf command line."""
   groups: Set[str]
@@ -516,28 +1614,169 @@ class MetricGroup:
     return self.ToPerfJson()
 
 
-class _RewriteIfExpToSelect(ast.NodeTransformer):
-  """Transformer to convert if-else nodes to Select expressions."""
+# Tokens of a perf json metric expression. Numbers may have an
+# exponent. Event names start with a letter and continue until an
+# unescaped operator, bracket, comma or space, so names may contain
+# '@', ':', '=' or escapes like '\-'. A '#' before a name makes it a
+# literal.
+_TOKEN = re.compile(r' *(?:'
+                    r'(?P<number>(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)|'
+                    r'(?P<name>#?[a-zA-Z](?:[^-+/* \\(),]|\\.)*)|'
+                    # Workaround Valkyrie perf json metric bug.
+                    r'(?P<bracket>#\( )|'
+                    r'(?P<op><=|>=|[-+*/%&|^<>(),]))')
+
+# Python's operators, giving the same folding of constants and
+# reflection to Expression methods as evaluating the expression as
+# python.
+_OPERATORS = {
+    '|': operator.or_,
+    '^': operator.xor,
+    '&': operator.and_,
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+}
+_COMPARISONS = {
+    '<': operator.lt,
+    '>': operator.gt,
+    '<=': operator.le,
+    '>=': operator.ge,
+}
+# Binding power of binary operators, following _PRECEDENCE so that
+# ToPerfJson's output parses back to the same expression. As in perf,
+# comparisons bind more tightly than the bitwise operators.
+_BINDING_POWER = {
+    '|': 1,
+    '^': 2,
+    '&': 3,
+    '<': 4,
+    '>': 4,
+    '<=': 4,
+    '>=': 4,
+    '+': 5,
+    '-': 5,
+    '*': 6,
+    '/': 6,
+    '%': 6,
+}
+_UNARY_BINDING_POWER = 7
+
+
+class _Parser:
+  """Precedence climbing parser building an Expression from tokens."""
 
-  def visit_IfExp(self, node):
-    # pylint: disable=invalid-name
-    self.generic_visit(node)
-    call = ast.Call(
-        func=ast.Name(id='Select', ctx=ast.Load()),
-        args=[node.body, node.test, node.orelse],
-        keywords=[])
-    ast.copy_location(call, node.test)
-    return call
+  def __init__(self, orig: str):
+    self.tokens: List[Tuple[str, str]] = []
+    pos = 0
+    end = len(orig)
+    while pos < end:
+      m = _TOKEN.match(orig, pos)
+      if not m:
+        if orig[pos:].strip(' '):
+          raise SyntaxError(f'Unexpected character {orig[pos]!r} at {pos}')
+        break
+      kind = m.lastgroup
+      text = m.group(kind)
+      if kind == 'bracket':
+        kind = text = '('
+      elif kind == 'op':
+        kind = text
+      self.tokens.append((kind, text))
+      pos = m.end()
+    self.tokens.append(('end', ''))
+    self.pos = 0
+
+  def Next(self) -> Tuple[str, str]:
+    token = self.tokens[self.pos]
+    self.pos += 1
+    return token
+
+  def Expect(self, kind: str) -> None:
+    token = self.Next()
+    if token[0] != kind:
+      raise SyntaxError(f'Expected {kind!r} but found {token[1]!r}')
+
+  def Parse(self) -> Union[int, float, Expression]:
+    result = self.ParseSelect()
+    self.Expect('end')
+    return result
+
+  def ParseSelect(self) -> Union[int, float, Expression]:
+    """Parses 'true_val if cond else false_val' or a binary expression."""
+    true_val = self.ParseBinary(0)
+    kind, text = self.tokens[self.pos]
+    if kind != 'name' or text != 'if':
+      return true_val
+    self.pos += 1
+    cond = self.ParseBinary(0)
+    kind, text = self.Next()
+    if kind != 'name' or text != 'else':
+      raise SyntaxError(f'Expected \'else\' but found {text!r}')
+    return Select(true_val, cond, self.ParseSelect())
+
+  def ParseBinary(self, min_power: int) -> Union[int, float, Expression]:
+    """Parses operators binding at least as tightly as min_power."""
+    lhs = self.ParseUnary()
+    while True:
+      kind = self.tokens[self.pos][0]
+      power = _BINDING_POWER.get(kind)
+      if power is None or power < min_power:
+        return lhs
+      self.pos += 1
+      if kind in _COMPARISONS:
+        lhs = _COMPARISONS[kind](lhs, self.ParseBinary(power + 1))
+        if self.tokens[self.pos][0] in _COMPARISONS:
+          # Neither python's 'a < b and b < c' nor perf's '(a < b) < c'
+          # is clearly intended.
+          raise SyntaxError(f'Chained comparison {self.tokens[self.pos][1]!r}')
+      else:
+        lhs = _OPERATORS[kind](lhs, self.ParseBinary(power + 1))
+
+  def ParseUnary(self) -> Union[int, float, Expression]:
+    kind = self.tokens[self.pos][0]
+    if kind == '-':
+      self.pos += 1
+      return operator.neg(self.ParseBinary(_UNARY_BINDING_POWER))
+    if kind == '+':
+      self.pos += 1
+      return operator.pos(self.ParseBinary(_UNARY_BINDING_POWER))
+    return self.ParsePrimary()
+
+  def ParsePrimary(self) -> Union[int, float, Expression]:
+    kind, text = self.Next()
+    if kind == 'number':
+      return int(text) if text.isdigit() else float(text)
+    if kind == '(':
+      result = self.ParseSelect()
+      self.Expect(')')
+      return result
+    if kind != 'name':
+      raise SyntaxError(f'Unexpected {text!r}')
+    if text[0] == '#':
+      return Literal(text)
+    if text in _FUNCTIONS:
+      self.Expect('(')
+      args = [self.ParseSelect()]
+      while self.tokens[self.pos][0] == ',':
+        self.pos += 1
+        args.append(self.ParseSelect())
+      self.Expect(')')
+      return _FUNCTIONS[text](*args)
+    if text in ('if', 'else'):
+      raise SyntaxError(f'Unexpected {text!r}')
+    return Event(text)
 
 
 def ParsePerfJson(orig: str) -> Expression:
   """A simple json metric expression decoder.
 
-  Converts a json encoded metric expression by way of python's ast and
-  eval routine. First tokens are mapped to Event calls, then
-  accidentally converted keywords or literals are mapped to their
-  appropriate calls. Python's ast is used to match if-else that can't
-  be handled via operator overloading. Finally the ast is evaluated.
+  Tokenizes the json encoded metric expression and then parses it with
+  perf's operator precedence, building Event, Literal, Function and
+  Select nodes directly. Operators are applied as in python so that
+  operations on constants are folded.
 
   Args:
     orig (str): String to parse.
@@ -545,49 +1784,272 @@ def ParsePerfJson(orig: str) -> Expression:
   Returns:
     Expression: The parsed string.
   """
-  # pylint: disable=eval-used
-  py = orig.strip()
-  py = re.sub(r'([a-zA-Z][^-+/\* \\\(\),]*(?:\\.[^-+/\* \\\(\),]*)*)',
-              r'Event(r"\1")', py)
-  py = re.sub(r'#Event\(r"([^"]*)"\)', r'Literal("#\1")', py)
-  py = re.sub(r'([0-9]+)Event\(r"(e[0-9]+)"\)', r'\1\2', py)
-  # Workaround Valkyrie perf json metric bug.
-  py = py.replace('#( ', '(')
-  keywords = ['if', 'else', 'min', 'max', 'd_ratio', 'source_count', 'has_event']
-  for kw in keywords:
-    py = re.sub(rf'Event\(r"{kw}"\)', kw, py)
-
+  if _parse_cache:
+    result = _parse_cache.Get(orig)
+    if result is not None:
+      return result
   try:
-    parsed = ast.parse(py, mode='eval')
+    result = _Constify(_Parser(orig.strip()).Parse())
   except SyntaxError as e:
     raise SyntaxError(f'Parsing expression:\n{orig}') from e
-  _RewriteIfExpToSelect().visit(parsed)
-  parsed = ast.fix_missing_locations(parsed)
-  return _Constify(eval(compile(parsed, orig, 'eval'))) #nosec B307
+  if _parse_cache:
+    _parse_cache.Put(orig, result)
+  return result
+
+
+# Expression types in the order of their codes in a ParseCache entry.
+_NODE_TYPES = (Operator, Select, Function, Event, Constant, Literal)
+
+
+class _ParseCacheEncoder(ExpressionVisitor):
+  """Flattens an expression into a table of nodes, operands first.
+
+  A node is its type's code followed by its fields, with operands
+  given by their position in the table. Shared subexpressions appear
+  once.
+  """
+
+  def __init__(self):
+    super().__init__()
+    self.nodes: List[tuple] = []
+
+  def Add(self, expr: Expression, fields: tuple) -> int:
+    self.nodes.append((_NODE_TYPES.index(type(expr)), *fields))
+    return len(self.nodes) - 1
+
+  def VisitOperator(self, expr: Operator, lhs: int, rhs: int) -> int:
+    return self.Add(expr, (expr.operator, lhs, rhs))
+
+  def VisitSelect(self, expr: Select, true_val: int, cond: int, false_val: int) -> int:
+    return self.Add(expr, (true_val, cond, false_val))
+
+  def VisitFunction(self, expr: Function, lhs: int, rhs: Optional[int]) -> int:
+    return self.Add(expr, (expr.fn, lhs, rhs))
+
+  def VisitEvent(self, expr: Event) -> int:
+    return self.Add(expr, (expr.name, expr.legacy_name))
+
+  def VisitConstant(self, expr: Constant) -> int:
+    return self.Add(expr, (expr.value,))
+
+  def VisitLiteral(self, expr: Literal) -> int:
+    return self.Add(expr, (expr.value,))
+
+
+class ParseCache:
+  """Parsed metric expressions kept between runs.
+
+  Maps expression text to its parse tree encoded as a table of nodes,
+  operands before their users, that is rebuilt without tokenizing or
+  parsing. When given a directory the entries are loaded from, and
+  saved to, a marshal file there. The file name includes a digest of
+  metric.py, so a changed parser or expression type doesn't reuse old
+  entries, and the python and marshal versions. Beyond max_entries the
+  least recently used entries are dropped when saving. The cache is
+  an optimization, failing to read or write the file is ignored.
+  """
+
+  def __init__(self, cache_dir: Optional[Path] = None, max_entries: int = 1 << 16):
+    self.path = None
+    if cache_dir:
+      with open(__file__, 'rb') as f:
+        version = hashlib.sha256(f.read()).hexdigest()[:16]
+      python = f'py{sys.version_info[0]}{sys.version_info[1]}'
+      self.path = Path(cache_dir, f'parse-{version}-{python}-m{marshal.version}.marshal')
+    self.max_entries = max_entries
+    # Encoded entries, least recently used first.
+    self.entries: Dict[str, tuple] = self.Load()
+    # Expressions decoded from, or added to, entries during this run.
+    self.parsed: Dict[str, Expression] = {}
+    self.dirty = False
+
+  def Load(self) -> Dict[str, tuple]:
+    """Returns the entries in the cache file."""
+    if not self.path:
+      return {}
+    try:
+      with open(self.path, 'rb') as f:
+        # The file only holds values written by Save below.
+        entries = marshal.load(f)  # nosec B302
+      # Mark the file as recently used for eviction from the directory.
+      os.utime(self.path)
+    except (OSError, EOFError, ValueError, TypeError):
+      return {}
+    return entries if isinstance(entries, dict) else {}
+
+  def Get(self, text: str) -> Optional[Expression]:
+    """Returns the expression parsed from text, or None if not cached."""
+    nodes = self.entries.pop(text, None)
+    if nodes is None:
+      return None
+    self.entries[text] = nodes
+    result = self.parsed.get(text)
+    if result is not None:
+      return result
+    built: List[Expression] = []
+    for node in nodes:
+      code = node[0]
+      if code == 0:
+        fields = (node[1], built[node[2]], built[node[3]])
+      elif code == 1:
+        fields = (built[node[1]], built[node[2]], built[node[3]])
+      elif code == 2:
+        fields = (node[1], built[node[2]], None if node[3] is None else built[node[3]])
+      else:
+        fields = node[1:]
+      built.append(_Intern(_NODE_TYPES[code], fields))
+    result = self.parsed[text] = built[-1]
+    return result
+
+  def Put(self, text: str, expr: Expression) -> None:
+    """Records that text parses to expr."""
+    encoder = _ParseCacheEncoder()
+    encoder.Visit(expr)
+    self.entries.pop(text, None)
+    self.entries[text] = tuple(encoder.nodes)
+    self.parsed[text] = expr
+    self.dirty = True
+
+  def Save(self) -> None:
+    """Atomically writes new entries, and those of other processes, to the file."""
+    if not self.path or not self.dirty:
+      return
+    # Entries saved by other processes are older than this process'.
+    entries = {text: nodes for text, nodes in self.Load().items()
+               if text not in self.entries}
+    entries.update(self.entries)
+    for text in list(entries)[:-self.max_entries or None]:
+      del entries[text]
+    tmp_name = None
+    try:
+      self.path.parent.mkdir(parents=True, exist_ok=True)
+      fd, tmp_name = tempfile.mkstemp(dir=self.path.parent, suffix='.tmp')
+      with os.fdopen(fd, 'wb') as f:
+        marshal.dump(entries, f)
+      os.replace(tmp_name, self.path)
+    except OSError:
+      # Nothing else removes an abandoned temporary file.
+      if tmp_name:
+        try:
+          os.unlink(tmp_name)
+        except OSError:
+          pass
+      return
+    self.entries = entries
+    self.dirty = False
+
+
+# The cache consulted by ParsePerfJson, if any.
+_parse_cache: Optional[ParseCache] = None
+
+
+def SetParseCache(cache: Optional[ParseCache]) -> Optional[ParseCache]:
+  """Sets the cache used by ParsePerfJson, returning the previous one."""
+  global _parse_cache
+  previous = _parse_cache
+  _parse_cache = cache
+  return previous
+
+
+def _Subexpressions(expr: Expression) -> Set[Expression]:
+  """Returns expr and the expressions within it that Substitute may replace."""
+  result: Set[Expression] = set()
+  stack = [expr]
+  while stack:
+    e = stack.pop()
+    if e in result:
+      continue
+    if isinstance(e, (Operator, Function)):
+      result.add(e)
+      stack.append(e.lhs)
+      if e.rhs:
+        stack.append(e.rhs)
+    elif isinstance(e, Select):
+      result.add(e)
+      stack.extend((e.true_val, e.cond, e.false_val))
+  return result
+
+
+def _Events(expr: Expression) -> Set['Event']:
+  """Returns the events within expr."""
+  result: Set[Event] = set()
+  seen: Set[Expression] = set()
+  stack = [expr]
+  while stack:
+    e = stack.pop()
+    if e in seen:
+      continue
+    seen.add(e)
+    if isinstance(e, Event):
+      result.add(e)
+    elif isinstance(e, (Operator, Function)):
+      stack.append(e.lhs)
+      if e.rhs:
+        stack.append(e.rhs)
+    elif isinstance(e, Select):
+      stack.extend((e.true_val, e.cond, e.false_val))
+  return result
 
 
 def RewriteMetricsInTermsOfOthers(metrics: list[Tuple[str, Expression]]
                                   )-> Dict[str, Expression]:
   """Shorten metrics by rewriting in terms of others.
 
+  Each metric is repeatedly rewritten until no more substitutions are
+  possible. A rewriting pass substitutes every other metric, in list
+  order, whose current, possibly already rewritten, expression is
+  within the metric's expression. As expressions are hash-consed the
+  metrics are indexed by their expression and a pass only visits the
+  metrics found within the expression being rewritten.
+
   Args:
     metrics (list): pairs of metric names and their expressions.
   Returns:
     Dict: mapping from a metric name to a shortened expression.
   """
   updates: Dict[str, Expression] = dict()
+  lower_names = [name.lower() for name, _ in metrics]
+  positions: Dict[str, List[int]] = {}
+  # Map from a metric's current expression to its positions in metrics.
+  index: Dict[Expression, List[int]] = {}
+  for pos, (name, expression) in enumerate(metrics):
+    positions.setdefault(name, []).append(pos)
+    if not isinstance(expression, (Event, Constant, Literal)):
+      index.setdefault(expression, []).append(pos)
+
+  def Rewrite(expression: Expression, lower_name: str) -> Expression:
+    """Substitute metrics in order, skipping ones not within expression."""
+    last = -1
+    while True:
+      found = None
+      for e in _Subexpressions(expression):
+        for pos in index.get(e, ()):
+          if pos > last and lower_names[pos] != lower_name:
+            if found is None or pos < found:
+              found = pos
+            break
+      if found is None:
+        return expression
+      name, inner_expression = metrics[found]
+      expression = expression.Substitute(name, updates.get(name, inner_expression))
+      last = found
+
   for outer_name, outer_expression in metrics:
     updated = outer_expression
+    lower_name = outer_name.lower()
     while True:
-      for inner_name, inner_expression in metrics:
-        if inner_name.lower() == outer_name.lower():
-          continue
-        if inner_name in updates:
-          inner_expression = updates[inner_name]
-        updated = updated.Substitute(inner_name, inner_expression)
-      if updated.Equals(outer_expression):
+      updated = Rewrite(updated, lower_name)
+      if updated is outer_expression:
         break
-      if outer_name in updates and updated.Equals(updates[outer_name]):
+      if outer_name in updates and updated is updates[outer_name]:
         break
+      for pos in positions[outer_name]:
+        old = updates.get(outer_name, metrics[pos][1])
+        if old in index:
+          index[old].remove(pos)
+          if not index[old]:
+            del index[old]
+        if not isinstance(updated, (Event, Constant, Literal)):
+          bisect.insort(index.setdefault(updated, []), pos)
       updates[outer_name] = updated
   return updates
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# metric_costs.py
+# <Output directory of create_perf_json.py, or one of its model directories>
+# --model <Model directory names to rank, like skylake - default all>
+# --top <Number of metrics to show per model - default all>
+# --cheapest <Show the cheapest metrics first>
+#
+# OUTPUT: Per model, its metrics ranked by the cost of collecting them
+#         from the metric-costs.csv written by create_perf_json.py.
+#
+# EXAMPLE: python metric_costs.py perf --model sapphirerapids --top 20
+import argparse
+import csv
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+def cost(row: Dict[str, str]) -> Tuple[int, int, int, int]:
+    """
+    The cost of a metric's metric-costs.csv row. Counter groups are
+    multiplexed so dominate, then needing uncore or retire latency
+    sampling, then the number of events.
+    """
+    return (int(row['CounterGroups']), int(row['Uncore']), int(row['RetireLatency']),
+            int(row['Events']))
+
+
+def rank(path: Path, top: Optional[int] = None, cheapest: bool = False) -> List[Dict[str, str]]:
+    """The rows of a metric-costs.csv file, most expensive first."""
+    with open(path, 'r', encoding='ascii') as f:
+        rows = list(csv.DictReader(f))
+    rows.sort(key=lambda r: (cost(r), r['MetricName'], r['Unit']), reverse=not cheapest)
+    return rows[:top] if top is not None else rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Rank metrics by the cost of collecting them.')
+    ap.add_argument('outdir', type=Path,
+                    help='Output directory of create_perf_json.py, or one of its model '
+                    'directories.')
+    ap.add_argument('--model', action='append',
+                    help='Model directory names to rank, like skylake. Defaults to all.')
+    ap.add_argument('--top', type=int, help='Number of metrics to show per model.')
+    ap.add_argument('--cheapest', action='store_true', help='Show the cheapest metrics first.')
+    args = ap.parse_args()
+
+    paths = sorted(args.outdir.glob('*/metric-costs.csv'))
+    if Path(args.outdir, 'metric-costs.csv').is_file():
+        paths = [Path(args.outdir, 'metric-costs.csv')]
+    if args.model:
+        paths = [p for p in paths if p.parent.name in args.model]
+    if not paths:
+        raise FileNotFoundError(f'No metric-costs.csv found in {args.outdir}')
+    for path in paths:
+        print(f'{path.parent.name}:')
+        print(f'  {"Groups":>6} {"Events":>6} Flags PMUs')
+        for row in rank(path, args.top, args.cheapest):
+            flags = ('U' if row['Uncore'] == '1' else '') + \
+                ('R' if row['RetireLatency'] == '1' else '')
+            name = f'{row["MetricName"]} ({row["Unit"]})' if row['Unit'] else row['MetricName']
+            print(f'  {row["CounterGroups"]:>6} {row["Events"]:>6} {flags:<5} '
+                  f'{row["PMUs"]} {name}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# perf_groups.py
+# <Directory of a model's json generated by create_perf_json.py>
+# <Metric or metric group names to collect>
+#
+# OUTPUT: A perf stat -e event specification grouping the metrics'
+#         events, and the number of groups each metric needs.
+#
+# EXAMPLE: python perf_groups.py perf/sapphirerapids TopdownL1 tma_L2_group
+import argparse
+import collections
+import create_perf_json
+from create_perf_json import CounterTable, EventCounters, counter_bitmask, counters_fit
+import csv
+from dataclasses import dataclass, field
+import json
+from pathlib import Path
+import sys
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+
+def perf_event(name: str) -> str:
+    """Converts an event name within a metric to perf's command line syntax."""
+    return name.replace('@', '/').replace('\\', '')
+
+
+class PerfModel:
+    """
+    The events, metrics and counters of a model as generated by
+    create_perf_json.py.
+    """
+    def __init__(self, modeldir: Path):
+        # Maps upper case event names to their json.
+        self.events: Dict[str, Dict[str, str]] = {}
+        # Maps lower case metric names to their json.
+        self.metrics: Dict[str, Dict[str, str]] = {}
+        # Maps metric group names to their description.
+        self.metricgroups: Dict[str, str] = {}
+        self.counters = CounterTable()
+        counter_path = Path(modeldir, 'counter.json')
+        if not counter_path.is_file():
+            raise FileNotFoundError(f'No counter.json in {modeldir}, hybrid models are '
+                                    'unsupported')
+        for path in sorted(Path(modeldir).glob('*.json')):
+            with open(path, 'r', encoding='ascii') as f:
+                data = json.load(f)
+            if path.name == 'metricgroups.json':
+                self.metricgroups = data
+            if not isinstance(data, list):
+                continue
+            for item in data:
+                if 'CountersNumGeneric' in item:
+                    self.counters.add_unit(item['Unit'], int(item['CountersNumFixed']),
+                                           int(item['CountersNumGeneric']))
+                elif 'EventName' in item:
+                    self.events.setdefault(item['EventName'].upper(), item)
+                elif 'MetricName' in item:
+                    self.metrics[item['MetricName'].lower()] = item
+        counters_path = Path(modeldir, 'event-counters.csv')
+        if counters_path.is_file():
+            with open(counters_path, 'r', encoding='ascii') as f:
+                for row in csv.DictReader(f):
+                    uncore = self.events.get(row['EventName'].upper(), {}).get('PerPkg') == '1'
+                    self.counters.add_event(row['EventName'], row['Unit'],
+                                            int(row['Counters'], 16), uncore)
+        else:
+            # Generated before event-counters.csv.
+            for name, event in self.events.items():
+                self.counters.add_event(name, event.get('Unit', 'core'),
+                                        counter_bitmask(event.get('Counter')) or
+                                        create_perf_json.GENERIC_COUNTERS,
+                                        event.get('PerPkg') == '1')
+        metrics = list(self.metrics.values())
+        self._metric_events = {m['MetricName'].lower(): events for m, events in
+                               zip(metrics, create_perf_json.metric_events(metrics))}
+
+    @property
+    def units(self) -> Dict[str, int]:
+        """Maps PMU units to the bitmask of their counters."""
+        return self.counters.units
+
+    def select(self, names: List[str]) -> List[str]:
+        """Names of the metrics that are, or are in the groups, named."""
+        groups: Dict[str, List[str]] = collections.defaultdict(list)
+        for m in self.metrics.values():
+            for group in m.get('MetricGroup', '').split(';'):
+                if group:
+                    groups[group.lower()].append(m['MetricName'])
+        result: List[str] = []
+        for name in names:
+            if name.lower() in self.metrics:
+                result.append(self.metrics[name.lower()]['MetricName'])
+            elif name.lower() in groups:
+                result.extend(groups[name.lower()])
+            else:
+                raise ValueError(f'Unknown metric or metric group {name}')
+        return list(dict.fromkeys(result))
+
+    def metric_events(self, name: str) -> FrozenSet[str]:
+        """
+        The events a metric reads, including those of the metrics it
+        refers to.
+        """
+        return self._metric_events[name.lower()]
+
+    def placement(self, event: str) -> Optional[EventCounters]:
+        """
+        The unit and counters of an event, None for events, like
+        msr@tsc@ or duration_time, that don't use a counter in
+        counter.json.
+        """
+        return self.counters.placement(event)
+
+
+@dataclass
+class Schedule:
+    """Groups of events counted together, per PMU unit."""
+    # Pairs of a unit and the events within a group.
+    groups: List[Tuple[str, List[str]]] = field(default_factory=list)
+    # Events not using counters, that needn't be grouped.
+    ungrouped: List[str] = field(default_factory=list)
+    # Number of groups with events of each metric.
+    metric_groups: Dict[str, int] = field(default_factory=dict)
+
+    def perf_events(self) -> str:
+        """The events as perf stat's -e argument."""
+        specs = ['{' + ','.join(perf_event(e) for e in events) + '}'
+                 for _, events in self.groups]
+        return ','.join(specs + [perf_event(e) for e in self.ungrouped])
+
+    def report(self) -> str:
+        lines = []
+        for name, count in self.metric_groups.items():
+            lines.append(f'{name}: {count} group{"" if count == 1 else "s"}')
+        units = collections.Counter(unit for unit, _ in self.groups)
+        for unit, count in units.items():
+            lines.append(f'{unit}: {count} group{"" if count == 1 else "s"}, '
+                         f'each counted {100 / count:.0f}% of the time')
+        return '\n'.join(lines)
+
+
+def schedule(model: PerfModel, metric_names: List[str],
+             aliases: Optional[Dict[str, str]] = None) -> Schedule:
+    """
+    Packs the events of metrics into the fewest perf groups.
+
+    A perf group's events are counted at the same time, so the events
+    of a metric on a unit are kept in one group, unless the metric has
+    a NO_GROUP_EVENTS constraint or needs more counters than the unit
+    has. A group may only hold events of one unit that all have a
+    counter in the unit's counters. Larger sets of events are placed
+    first, each in the first group it fits. aliases maps events to
+    the equivalent event to count in their place.
+    """
+    placements: Dict[str, EventCounters] = {}
+    ungrouped: Set[str] = set()
+    # Sets of events of a unit to keep together, and the metrics needing them.
+    items: Dict[Tuple[str, FrozenSet[str]], List[str]] = collections.defaultdict(list)
+    for name in metric_names:
+        per_unit: Dict[str, Set[str]] = collections.defaultdict(set)
+        for event in model.metric_events(name):
+            if aliases:
+                event = aliases.get(event, event)
+            placement = model.placement(event)
+            if placement is None:
+                ungrouped.add(event)
+                continue
+            placements[event] = placement
+            per_unit[placement.unit].add(event)
+        constraint = model.metrics[name.lower()].get('MetricConstraint', '')
+        for unit, events in per_unit.items():
+            if any(e.startswith('topdown\\-') for e in events) and \
+               'TOPDOWN.SLOTS' in model.events:
+                events.add('TOPDOWN.SLOTS')
+                placements['TOPDOWN.SLOTS'] = model.placement('TOPDOWN.SLOTS')
+            if constraint.startswith('NO_GROUP_EVENTS'):
+                for event in events:
+                    items[(unit, frozenset([event]))].append(name)
+            else:
+                items[(unit, frozenset(events))].append(name)
+
+    groups: List[Tuple[str, Set[str]]] = []
+    # Indices of the groups holding each metric's events.
+    metric_groups: Dict[str, Set[int]] = collections.defaultdict(set)
+
+    def add(unit: str, events: FrozenSet[str]) -> Optional[int]:
+        # Prefer the group already holding most of the events.
+        best = None
+        for i, (group_unit, group) in enumerate(groups):
+            if group_unit != unit or (best is not None and
+                                      len(group & events) <= len(groups[best][1] & events)):
+                continue
+            if counters_fit(tuple(sorted(placements[e].bitmask for e in group | events)),
+                            model.units[unit]):
+                best = i
+        if best is not None:
+            groups[best][1].update(events)
+            return best
+        if counters_fit(tuple(sorted(placements[e].bitmask for e in events)),
+                        model.units[unit]):
+            groups.append((unit, set(events)))
+            return len(groups) - 1
+        return None
+
+    for (unit, events), names in sorted(items.items(),
+                                        key=lambda x: (-len(x[0][1]), x[0][0], sorted(x[0][1]))):
+        placed = add(unit, events)
+        if placed is not None:
+            placed_in = [placed]
+        else:
+            # Too many events for the unit's counters.
+            placed_in = []
+            for event in sorted(events):
+                placed = add(unit, frozenset([event]))
+                if placed is None:
+                    raise ValueError(f'No counter for {event} in {unit}')
+                placed_in.append(placed)
+        for name in names:
+            metric_groups[name].update(placed_in)
+
+    def order(event: str) -> Tuple[int, str]:
+        # perf requires slots to lead a group with topdown events.
+        if event == 'TOPDOWN.SLOTS':
+            return (0, event)
+        return (1 if event.startswith('topdown\\-') else 2, event)
+
+    result = Schedule()
+    result.groups = [(unit, sorted(group, key=order)) for unit, group in groups]
+    result.ungrouped = sorted(ungrouped)
+    result.metric_groups = {name: len(metric_groups[name]) for name in metric_names}
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Group the events of metrics for perf stat.')
+    ap.add_argument('modeldir', type=Path,
+                    help='Directory of a model\'s json generated by create_perf_json.py.')
+    ap.add_argument('names', nargs='+', help='Metric or metric group names.')
+    args = ap.parse_args()
+
+    model = PerfModel(args.modeldir)
+    result = schedule(model, model.select(args.names))
+    print(f"-e '{result.perf_events()}'")
+    print(result.report(), file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+# REQUIREMENT: Install Python3 on your machine
+# USAGE: Run from command line with the following parameters -
+#
+# tma_tree.py
+# <Directory of a model's json generated by create_perf_json.py>
+# <Output of perf stat -j, or a json object of event values - default stdin>
+# --define/-D <Value of a literal like #SMT_on=1>
+# --next <Print the perf stat command line for the metrics to collect next>
+#
+# OUTPUT: Per interval, the TMA tree evaluated top-down. A metric's
+#         children are only computed when its MetricThreshold holds, the
+#         subtrees skipped are reported.
+#
+# EXAMPLE: perf stat -j -I 1000 -e ... 2>&1 | python tma_tree.py perf/sapphirerapids
+import argparse
+import collection_plan
+import collections
+from create_perf_json import metric_events
+from dataclasses import dataclass, field
+import json
+import math
+import metric
+from pathlib import Path
+from perf_groups import PerfModel, perf_event
+import sys
+from typing import Callable, Dict, List, Mapping, Optional, Set, TextIO, Tuple
+
+
+class _Values(dict):
+    """
+    Event values for compiled metrics. Metrics referenced are computed
+    when first read and missing events read as NaN.
+    """
+
+    def __init__(self, tree: 'TmaTree', values: Mapping[str, float]):
+        super().__init__(values)
+        self.tree = tree
+        # Maps lower case names of the metrics computed to their value.
+        self.metrics: Dict[str, float] = {}
+        self.missing: Set[str] = set()
+        self.computing: Set[str] = set()
+
+    def __missing__(self, key: str) -> float:
+        if key.lower() in self.tree.model.metrics:
+            value = self.metric(key)
+        else:
+            self.missing.add(key)
+            value = math.nan
+        self[key] = value
+        return value
+
+    def metric(self, name: str) -> float:
+        lower_name = name.lower()
+        if lower_name not in self.metrics:
+            if lower_name in self.computing:
+                raise ValueError(f'Metric {name} refers to itself')
+            self.computing.add(lower_name)
+            try:
+                self.metrics[lower_name] = self.tree.compiled(lower_name, 'MetricExpr')(self)
+            finally:
+                self.computing.remove(lower_name)
+        return self.metrics[lower_name]
+
+    def threshold(self, name: str) -> bool:
+        """Whether the metric's MetricThreshold holds, metrics without one always do."""
+        compiled = self.tree.compiled(name.lower(), 'MetricThreshold')
+        if compiled is None:
+            return True
+        return compiled(self) == 1.0
+
+
+@dataclass
+class TmaNode:
+    """A metric of the TMA tree that was computed."""
+    name: str
+    # Distance from the tree's root level.
+    depth: int
+    value: float
+    # Whether MetricThreshold holds, so that the children were computed.
+    threshold: bool
+
+
+@dataclass
+class TreeEvaluation:
+    """The TMA tree of one interval evaluated top-down."""
+    # The nodes computed, in depth-first order.
+    nodes: List[TmaNode] = field(default_factory=list)
+    # Maps nodes whose threshold didn't hold to their uncomputed descendants.
+    skipped: Dict[str, List[str]] = field(default_factory=dict)
+    # Number of metrics computed, including those referenced by nodes.
+    computed: int = 0
+    # Events and literals without a value.
+    missing: Set[str] = field(default_factory=set)
+
+    def report(self) -> str:
+        lines = []
+        for node in self.nodes:
+            line = f'{"  " * node.depth}{node.name}: {node.value:.4g}'
+            if node.name in self.skipped:
+                line += f', skipped {len(self.skipped[node.name])} below'
+            elif node.threshold:
+                line += ' <=='
+            lines.append(line)
+        skipped = sum(len(s) for s in self.skipped.values())
+        lines.append(f'{len(self.nodes)} nodes evaluated, {skipped} skipped, '
+                     f'{self.computed} metrics computed')
+        if self.missing:
+            lines.append(f'Missing values for {", ".join(sorted(self.missing))}')
+        return '\n'.join(lines)
+
+
+class TmaTree:
+    """
+    The TMA metrics of a model as a tree. A metric's parent is named
+    by its tma_<parent>_group metric group and the roots are the level 1
+    metrics, not the tma_info_* metrics also in tma_L1_group. A child's
+    MetricThreshold includes its parent's, so a child only matters when
+    its parent's threshold holds.
+    """
+
+    def __init__(self, model: PerfModel):
+        self.model = model
+        # Maps lower case metric names to the names of their children.
+        self.children: Dict[str, List[str]] = collections.defaultdict(list)
+        self.roots: List[str] = []
+        for m in model.metrics.values():
+            groups = m.get('MetricGroup', '').split(';')
+            parents = [g[:-len('_group')] for g in groups
+                       if g.startswith('tma_') and g.endswith('_group') and
+                       g[:-len('_group')].lower() in model.metrics]
+            for parent in parents:
+                self.children[parent.lower()].append(m['MetricName'])
+            if (not parents and 'tma_L1_group' in groups and
+                    ('TopdownL1' in groups or 'MetricThreshold' in m)):
+                self.roots.append(m['MetricName'])
+        self._compiled: Dict[Tuple[str, str], Optional[Callable[[Mapping[str, float]], float]]] = {}
+
+    def compiled(self, lower_name: str, key: str
+                 ) -> Optional[Callable[[Mapping[str, float]], float]]:
+        """The compiled MetricExpr or MetricThreshold of a metric."""
+        if (lower_name, key) not in self._compiled:
+            form = self.model.metrics[lower_name].get(key)
+            self._compiled[(lower_name, key)] = \
+                metric.ParsePerfJson(form).Compile() if form else None
+        return self._compiled[(lower_name, key)]
+
+    def descendants(self, name: str) -> List[str]:
+        result: List[str] = []
+        stack = list(reversed(self.children.get(name.lower(), [])))
+        while stack:
+            child = stack.pop()
+            if child not in result:
+                result.append(child)
+                stack.extend(reversed(self.children.get(child.lower(), [])))
+        return result
+
+    def evaluate(self, values: Mapping[str, float]) -> TreeEvaluation:
+        """
+        Evaluate the tree top-down with values of events, as written in
+        the perf json, and literals. A node's children are only computed
+        when its threshold holds, otherwise its subtree is skipped.
+        """
+        result = TreeEvaluation()
+        inputs = _Values(self, values)
+        visited: Set[str] = set()
+        stack = [(name, 0) for name in reversed(self.roots)]
+        while stack:
+            name, depth = stack.pop()
+            if name.lower() in visited:
+                continue
+            visited.add(name.lower())
+            node = TmaNode(name, depth, inputs.metric(name), inputs.threshold(name))
+            result.nodes.append(node)
+            if node.threshold:
+                stack.extend((child, depth + 1)
+                             for child in reversed(self.children.get(name.lower(), [])))
+            elif self.children.get(name.lower()):
+                result.skipped[name] = self.descendants(name)
+        result.computed = len(inputs.metrics)
+        result.missing = inputs.missing
+        return result
+
+
+def read_values(model: PerfModel, f: TextIO) -> List[Tuple[str, Dict[str, float]]]:
+    """
+    Read event values per interval from the output of perf stat -j, or
+    a json object mapping events to their values. Events named as on
+    perf's command line are renamed as written in the metrics.
+    """
+    perf_names = {perf_event(e): e for events in
+                  metric_events(list(model.metrics.values())) for e in events}
+    text = f.read()
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict) and 'counter-value' not in data:
+            return [('', {perf_names.get(k, k): float(v) for k, v in data.items()})]
+    except json.JSONDecodeError:
+        pass
+    intervals: Dict[str, Dict[str, float]] = collections.defaultdict(dict)
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith('{'):
+            continue
+        item = json.loads(line)
+        try:
+            value = float(item['counter-value'])
+        except (KeyError, ValueError):
+            # perf's <not counted> and <not supported> values.
+            continue
+        event = item.get('event', '')
+        event = perf_names.get(event, event)
+        interval = intervals[str(item.get('interval', ''))]
+        interval[event] = interval.get(event, 0.0) + value
+    return list(intervals.items())
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Evaluate the TMA tree top-down.')
+    ap.add_argument('modeldir', type=Path,
+                    help='Directory of a model\'s json generated by create_perf_json.py.')
+    ap.add_argument('values', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                    help='Output of perf stat -j, or a json object of event values.')
+    ap.add_argument('--define', '-D', action='append', default=[],
+                    help='Value of a literal like #SMT_on=1.')
+    ap.add_argument('--next', action='store_true',
+                    help='Print the perf stat command line counting the events of '
+                    'the metrics evaluated.')
+    args = ap.parse_args()
+
+    model = PerfModel(args.modeldir)
+    tree = TmaTree(model)
+    literals = {}
+    for define in args.define:
+        name, value = define.split('=')
+        literals[name] = float(value)
+    evaluated: Set[str] = set()
+    for interval, values in read_values(model, args.values):
+        result = tree.evaluate({**literals, **values})
+        if interval:
+            print(f'Interval {interval}:')
+        print(result.report())
+        evaluated.update(node.name for node in result.nodes)
+    if args.next:
+        print(collection_plan.plan(model, sorted(evaluated)).command())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+"""Micro-benchmarks for create_perf_json.py.
+
+Run from the command line, optionally naming the benchmarks to run:
+
+  python benchmark_create_perf_json.py [topic] [tma] [parse] [rewrite] [evaluate]
+      [vector] [program] [visitor] [cache] [flat]
+
+Benchmarks without a built in baseline report only the current time,
+run them on an older checkout to compare.
+"""
+
+import gc
+import math
+import multiprocessing
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Optional
+
+# Add create_perf_json.py directory to the path before importing.
+_script_dir = Path(__file__).resolve().parent
+sys.path.append(str(_script_dir.parent))
+_repo_dir = _script_dir.parent.parent
+
+import create_perf_json
+import metric
+from metric_test import (CorpusMetricExpressions, LegacyParsePerfJson,
+                         LegacyRewriteMetricsInTermsOfOthers)
+from test_create_perf_json import corpus_event_names, legacy_topic
+
+
+def report(name: str, baseline: Optional[float], optimized: float):
+    if baseline is None:
+        print(f'{name:40} {"":>12} {optimized * 1000:10.1f}ms')
+        return
+    print(f'{name:40} {baseline * 1000:10.1f}ms {optimized * 1000:10.1f}ms '
+          f'{baseline / optimized:8.1f}x')
+
+
+def benchmark_topic():
+    """Classify every event name in the corpus."""
+    names = corpus_event_names()
+    compiled = create_perf_json.topic.__wrapped__
+
+    def run(fn):
+        return min(timeit.repeat(lambda: [fn(name, None) for name in names],
+                                 number=1, repeat=3))
+
+    legacy = run(lambda name, unit: legacy_topic(name))
+    report(f'topic ({len(names)} names) compiled', legacy, run(compiled))
+    create_perf_json.topic.cache_clear()
+    for name in names:
+        create_perf_json.topic(name, None)
+    report(f'topic ({len(names)} names) memoized', legacy,
+           run(create_perf_json.topic))
+
+
+def tma_inputs(shortnames: Optional[list[str]] = None):
+    """Yields the spreadsheet, PMU prefix and events of every model with TMA metrics."""
+    for model in create_perf_json.Mapfile(_repo_dir).archs:
+        if shortnames and model.shortname not in shortnames:
+            continue
+        events = {}
+        pmu_prefix = 'cpu_core' if 'atom' in model.files else 'cpu'
+        for event_type in ['core', 'atom', 'uncore', 'uncore experimental']:
+            if event_type not in model.files:
+                continue
+            unit = None
+            if event_type in ['core', 'atom']:
+                unit = f'cpu_{event_type}' if 'atom' in model.files else 'cpu'
+            for jd in create_perf_json._json_loader.load(model.files[event_type])['Events']:
+                event = create_perf_json.PerfmonJsonEvent(model.shortname, unit, jd, False)
+                events.setdefault(event.event_name.upper(), event)
+        sheet = create_perf_json.TmaSpreadsheet.load(model.files['tma metrics'])
+        yield model, sheet, pmu_prefix, events
+
+
+def benchmark_tma():
+    """Extract the TMA metrics, resolving and fixing up formulas, of every model."""
+    total = 0.0
+    for model, sheet, pmu_prefix, events in tma_inputs():
+        total += min(timeit.repeat(
+            lambda: model.extract_tma_metrics(sheet, pmu_prefix, events, []),
+            number=1, repeat=3))
+    report('extract_tma_metrics (all models)', None, total)
+
+
+def corpus_and_tma_expressions() -> list[str]:
+    """Every MetricExpr and MetricThreshold in the metric json and TMA metrics."""
+    exprs = CorpusMetricExpressions()
+    for model, sheet, pmu_prefix, events in tma_inputs():
+        metrics = []
+        model.extract_tma_metrics(sheet, pmu_prefix, events, metrics)
+        for m in metrics:
+            exprs.extend(str(m[key]) for key in ['MetricExpr', 'MetricThreshold'] if key in m)
+    return exprs
+
+
+def benchmark_parse():
+    """Parse every MetricExpr and MetricThreshold in the metric json and TMA metrics."""
+    exprs = corpus_and_tma_expressions()
+
+    def run(fn):
+        return min(timeit.repeat(lambda: [fn(expr) for expr in exprs],
+                                 number=1, repeat=3))
+
+    report(f'ParsePerfJson ({len(exprs)} expressions)', run(LegacyParsePerfJson),
+           run(metric.ParsePerfJson))
+
+
+def benchmark_rewrite():
+    """Rewrite the SPR and GNR metrics in terms of each other."""
+    for model, sheet, pmu_prefix, events in tma_inputs(['SPR', 'GNR']):
+        metrics = []
+        model.extract_tma_metrics(sheet, pmu_prefix, events, metrics)
+        model.extract_extra_metrics(pmu_prefix, events, metrics)
+        metrics = sorted(metrics, key=lambda m: m['MetricName'])
+        parsed = [(m['MetricName'], m['MetricExpr']) for m in metrics]
+
+        tracemalloc.start()
+        result = metric.RewriteMetricsInTermsOfOthers(parsed)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert result == LegacyRewriteMetricsInTermsOfOthers(parsed)
+        del result
+        print(f'{model.shortname}: {peak / 1024:.0f}KiB peak, {retained / 1024:.0f}KiB retained')
+        report(f'RewriteMetricsInTermsOfOthers {model.shortname}',
+               min(timeit.repeat(lambda: LegacyRewriteMetricsInTermsOfOthers(parsed),
+                                 number=1, repeat=3)),
+               min(timeit.repeat(lambda: metric.RewriteMetricsInTermsOfOthers(parsed),
+                                 number=1, repeat=3)))
+
+
+def walk_evaluate(expr: metric.Expression, values: dict[str, float]) -> float:
+    """Compute an expression by walking its tree, the alternative to compiling it."""
+    if isinstance(expr, metric.Constant):
+        return float(expr.value)
+    if isinstance(expr, (metric.Event, metric.Literal)):
+        return values[expr.ToPerfJson()]
+    if isinstance(expr, metric.Select):
+        if walk_evaluate(expr.cond, values):
+            return walk_evaluate(expr.true_val, values)
+        return walk_evaluate(expr.false_val, values)
+    if isinstance(expr, metric.Function):
+        if expr.fn == 'has_event':
+            return 1.0 if expr.lhs.ToPerfJson() in values else 0.0
+        if expr.fn == 'source_count':
+            return values.get(f'source_count({expr.lhs.ToPerfJson()})', 1.0)
+        lhs = walk_evaluate(expr.lhs, values)
+        rhs = walk_evaluate(expr.rhs, values)
+        if expr.fn == 'd_ratio':
+            return lhs / rhs if rhs else 0.0
+        return min(lhs, rhs) if expr.fn == 'min' else max(lhs, rhs)
+    lhs = walk_evaluate(expr.lhs, values)
+    rhs = walk_evaluate(expr.rhs, values)
+    op = expr.operator
+    if op == '/':
+        return lhs / rhs if rhs else math.nan
+    if op == '%':
+        return math.fmod(int(lhs), int(rhs)) if int(rhs) else math.nan
+    if op in ('<', '>'):
+        return 1.0 if (lhs < rhs if op == '<' else lhs > rhs) else 0.0
+    if op in ('&', '|', '^'):
+        return float({'&': int.__and__, '|': int.__or__, '^': int.__xor__}[op](int(lhs), int(rhs)))
+    return {'+': lhs + rhs, '-': lhs - rhs, '*': lhs * rhs}[op]
+
+
+def spr_metric_values():
+    """Returns the SPR TMA metric expressions and a distinct value for each input."""
+    model, sheet, pmu_prefix, events = next(tma_inputs(['SPR']))
+    metrics = []
+    model.extract_tma_metrics(sheet, pmu_prefix, events, metrics)
+    exprs = [m['MetricExpr'] for m in metrics]
+    return exprs, leaf_values(exprs)
+
+
+def leaf_values(exprs: list[metric.Expression]) -> dict[str, float]:
+    """Gives each event and literal within exprs a distinct value."""
+    values = {}
+    stack = list(exprs)
+    while stack:
+        expr = stack.pop()
+        if isinstance(expr, (metric.Event, metric.Literal)):
+            values.setdefault(expr.ToPerfJson(), float(len(values) + 1))
+        elif isinstance(expr, metric.Select):
+            stack.extend([expr.true_val, expr.cond, expr.false_val])
+        elif isinstance(expr, (metric.Operator, metric.Function)):
+            stack.extend([expr.lhs, expr.rhs] if expr.rhs else [expr.lhs])
+    return values
+
+
+def benchmark_evaluate():
+    """Compute every SPR metric, as a monitoring agent would for each sample."""
+    exprs, values = spr_metric_values()
+    compiled = [expr.Compile() for expr in exprs]
+    for expr, fn in zip(exprs, compiled):
+        a, b = walk_evaluate(expr, values), fn(values)
+        assert a == b or (math.isnan(a) and math.isnan(b)), expr
+
+    report(f'evaluate ({len(exprs)} SPR metrics)',
+           min(timeit.repeat(lambda: [walk_evaluate(e, values) for e in exprs],
+                             number=10, repeat=3)) / 10,
+           min(timeit.repeat(lambda: [fn(values) for fn in compiled],
+                             number=10, repeat=3)) / 10)
+    report(f'compile ({len(exprs)} SPR metrics)', None,
+           timeit.timeit(lambda: [metric._Compiler().Compile(e) for e in exprs], number=1))
+
+
+def benchmark_vector(samples: int = 10000):
+    """Compute every SPR metric over a batch of samples, compiled vs numpy."""
+    if metric.np is None:
+        print('vector: requires numpy')
+        return
+    np = metric.np
+    exprs, values = spr_metric_values()
+    rng = np.random.default_rng(1)
+    arrays = {name: rng.integers(0, 1000, samples).astype(np.float64)
+              for name in values}
+    rows = [{name: float(a[i]) for name, a in arrays.items()} for i in range(samples)]
+    compiled = [expr.Compile() for expr in exprs]
+    for expr, fn in zip(exprs, compiled):
+        vector = expr.EvaluateArrays(arrays)
+        scalar = np.array([fn(row) for row in rows[:100]])
+        assert np.array_equal(vector[:100], scalar, equal_nan=True), expr
+
+    report(f'evaluate ({len(exprs)} SPR metrics, {samples} samples)',
+           min(timeit.repeat(lambda: [[fn(row) for row in rows] for fn in compiled],
+                             number=1, repeat=3)),
+           min(timeit.repeat(lambda: [e.EvaluateArrays(arrays) for e in exprs],
+                             number=1, repeat=3)))
+
+
+def benchmark_program():
+    """Compute all SPR metrics, as written to the json, in one function."""
+    model, sheet, pmu_prefix, events = next(tma_inputs(['SPR']))
+    metrics = []
+    model.extract_tma_metrics(sheet, pmu_prefix, events, metrics)
+    model.extract_extra_metrics(pmu_prefix, events, metrics)
+    rewritten = create_perf_json.rewrite_metrics_in_terms_of_others([dict(m) for m in metrics])
+    pairs = [(m['MetricName'], m['MetricExpr']) for m in rewritten]
+    by_name = {name.lower(): expr for name, expr in pairs}
+    values = {name: value for name, value in leaf_values([e for _, e in pairs]).items()
+              if name.lower() not in by_name}
+    # Compile each metric separately, with the metrics it refers to inlined.
+    compiled = {name: metric._Compiler(by_name).Compile(expr) for name, expr in pairs}
+    program = metric.CompileMetrics(pairs)
+    results = program(values)
+    for name, fn in compiled.items():
+        a, b = fn(values), results[name]
+        assert a == b or (math.isnan(a) and math.isnan(b)), name
+
+    print(f'SPR: {sum(fn.__code__.co_nlocals for fn in compiled.values())} values computed '
+          f'by separate metrics, {program.__code__.co_nlocals} by the program')
+    report(f'evaluate ({len(pairs)} SPR metrics) program',
+           min(timeit.repeat(lambda: [fn(values) for fn in compiled.values()],
+                             number=10, repeat=3)) / 10,
+           min(timeit.repeat(lambda: program(values), number=10, repeat=3)) / 10)
+
+
+def recursive_perf_json(expr: metric.Expression) -> str:
+    """Write an expression by recursion, as before ExpressionVisitor."""
+    if isinstance(expr, metric.Operator):
+        return (f'{expr.Bracket(expr.lhs, recursive_perf_json(expr.lhs))} {expr.operator} '
+                f'{expr.Bracket(expr.rhs, recursive_perf_json(expr.rhs), True)}')
+    if isinstance(expr, metric.Select):
+        return (f'({recursive_perf_json(expr.true_val)} if {recursive_perf_json(expr.cond)} '
+                f'else {recursive_perf_json(expr.false_val)})')
+    if isinstance(expr, metric.Function):
+        if expr.rhs is not None:
+            return f'{expr.fn}({recursive_perf_json(expr.lhs)}, {recursive_perf_json(expr.rhs)})'
+        return f'{expr.fn}({recursive_perf_json(expr.lhs)})'
+    return expr.ToPerfJson()
+
+
+def recursive_substitute(expr: metric.Expression, name: str,
+                         expression: metric.Expression) -> metric.Expression:
+    """Substitute by recursion, as before ExpressionTransformer."""
+    if isinstance(expr, (metric.Event, metric.Constant, metric.Literal)):
+        return expr
+    if expr is expression:
+        return metric.Event(name)
+    if isinstance(expr, metric.Operator):
+        return metric.Operator(expr.operator, recursive_substitute(expr.lhs, name, expression),
+                               recursive_substitute(expr.rhs, name, expression))
+    if isinstance(expr, metric.Select):
+        return metric.Select(recursive_substitute(expr.true_val, name, expression),
+                             recursive_substitute(expr.cond, name, expression),
+                             recursive_substitute(expr.false_val, name, expression))
+    if isinstance(expr, metric.Function):
+        rhs = None
+        if expr.rhs is not None:
+            rhs = recursive_substitute(expr.rhs, name, expression)
+        return metric.Function(expr.fn, recursive_substitute(expr.lhs, name, expression), rhs)
+    return expr
+
+
+def benchmark_visitor():
+    """Write, simplify and substitute the SPR metrics, recursion vs visitors."""
+    exprs, _ = spr_metric_values()
+    # The most common subexpression of the SPR metrics.
+    fb_hit = metric.ParsePerfJson('MEM_LOAD_RETIRED.FB_HIT / MEM_LOAD_RETIRED.L1_MISS')
+    for expr in exprs:
+        assert recursive_perf_json(expr) == expr.ToPerfJson(), expr
+        substituted = expr.Substitute('fb_hit', fb_hit)
+        assert recursive_substitute(expr, 'fb_hit', fb_hit) is substituted, expr
+
+    def run(fn):
+        return min(timeit.repeat(lambda: [fn(e) for e in exprs], number=10, repeat=3)) / 10
+
+    report(f'ToPerfJson ({len(exprs)} SPR metrics)', run(recursive_perf_json),
+           run(lambda e: e.ToPerfJson()))
+    report(f'Substitute ({len(exprs)} SPR metrics)',
+           run(lambda e: recursive_substitute(e, 'fb_hit', fb_hit)),
+           run(lambda e: e.Substitute('fb_hit', fb_hit)))
+    report(f'Simplify ({len(exprs)} SPR metrics)', None, run(lambda e: e.Simplify()))
+
+    # A threshold chaining its parents' thresholds, as deep as recursion allows.
+    depth = sys.getrecursionlimit() // 2
+    deep = metric.Event('e0') > 0
+    for i in range(1, depth):
+        deep = deep & (metric.Event(f'e{i}') > 0)
+    report(f'ToPerfJson ({depth} deep threshold)',
+           min(timeit.repeat(lambda: recursive_perf_json(deep), number=10, repeat=3)) / 10,
+           min(timeit.repeat(deep.ToPerfJson, number=10, repeat=3)) / 10)
+    report(f'Substitute ({depth} deep threshold)',
+           min(timeit.repeat(lambda: recursive_substitute(deep, 'x', deep.rhs),
+                             number=10, repeat=3)) / 10,
+           min(timeit.repeat(lambda: deep.Substitute('x', deep.rhs), number=10, repeat=3)) / 10)
+
+
+def benchmark_cache():
+    """Parse the metric json and TMA metrics with an empty then a saved ParseCache."""
+    exprs = corpus_and_tma_expressions()
+
+    def run(cache_dir: Optional[Path]) -> float:
+        cache = metric.ParseCache(cache_dir) if cache_dir else None
+        previous = metric.SetParseCache(cache)
+        try:
+            start = timeit.default_timer()
+            for expr in exprs:
+                metric.ParsePerfJson(expr)
+            if cache:
+                cache.Save()
+            return timeit.default_timer() - start
+        finally:
+            metric.SetParseCache(previous)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        uncached = min(run(None) for _ in range(3))
+        report(f'ParsePerfJson ({len(exprs)} expressions) cold', uncached, run(Path(cache_dir)))
+        # Loading the cache file is included in the warm time.
+        start = timeit.default_timer()
+        metric.ParseCache(Path(cache_dir))
+        load = timeit.default_timer() - start
+        report(f'ParsePerfJson ({len(exprs)} expressions) warm', uncached,
+               min(run(Path(cache_dir)) for _ in range(3)) + load)
+        size = sum(f.stat().st_size for f in Path(cache_dir).iterdir())
+        print(f'ParseCache: {size / 1024:.0f}KiB')
+
+
+def flat_memory() -> tuple[int, int, int, int]:
+    """
+    The number of metric json and TMA metric expressions, and the bytes
+    they use as trees, as FlatExpressions and of FlatExpression code.
+    """
+    texts = sorted(set(corpus_and_tma_expressions()))
+    gc.collect()
+    tracemalloc.start()
+    # Hash-consing shares equal expressions, and subexpressions, between trees.
+    exprs = list(dict.fromkeys(metric.ParsePerfJson(text) for text in texts))
+    trees = tracemalloc.get_traced_memory()[0]
+    flats = [metric.FlatExpression(expr) for expr in exprs]
+    del exprs
+    gc.collect()
+    flat = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(flats), trees, flat, sum(len(f.code) * f.code.itemsize for f in flats)
+
+
+def benchmark_flat():
+    """Hold and evaluate the metric json and TMA metrics as FlatExpressions."""
+    # Measured in a new interpreter, as the caches of other benchmarks
+    # would keep the trees alive.
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        count, trees, flat, code = pool.apply(flat_memory)
+    print(f'{count} expressions: {trees / 1024:.0f}KiB as trees, '
+          f'{flat / 1024:.0f}KiB as FlatExpressions, {code / 1024:.0f}KiB of code')
+
+    exprs, values = spr_metric_values()
+    flats = [metric.FlatExpression(expr) for expr in exprs]
+    for expr, flat in zip(exprs, flats):
+        assert flat.ToExpression() is expr
+        a, b = walk_evaluate(expr, values), flat.Evaluate(values)
+        assert a == b or (math.isnan(a) and math.isnan(b)), expr
+
+    def run(fn):
+        return min(timeit.repeat(fn, number=10, repeat=3)) / 10
+
+    walk = run(lambda: [walk_evaluate(e, values) for e in exprs])
+    report(f'evaluate ({len(exprs)} SPR metrics) flat', walk,
+           run(lambda: [f.Evaluate(values) for f in flats]))
+    compiled = [expr.Compile() for expr in exprs]
+    report(f'evaluate ({len(exprs)} SPR metrics) compiled', walk,
+           run(lambda: [fn(values) for fn in compiled]))
+    report(f'FlatExpression ({len(exprs)} SPR metrics)', None,
+           run(lambda: [metric.FlatExpression(e) for e in exprs]))
+    report(f'ToExpression ({len(exprs)} SPR metrics)', None,
+           run(lambda: [f.ToExpression() for f in flats]))
+
+
+_benchmarks = {
+    'topic': benchmark_topic,
+    'tma': benchmark_tma,
+    'parse': benchmark_parse,
+    'rewrite': benchmark_rewrite,
+    'evaluate': benchmark_evaluate,
+    'vector': benchmark_vector,
+    'program': benchmark_program,
+    'visitor': benchmark_visitor,
+    'cache': benchmark_cache,
+    'flat': benchmark_flat,
+}
+
+if __name__ == '__main__':
+    print(f'{"benchmark":40} {"before":>12} {"after":>12} {"speedup":>9}')
+    for name in sys.argv[1:] or _benchmarks.keys():
+        _benchmarks[name]()
@@ -1,21 +1,99 @@
 # Copyright (C) 2022 Google LLC
 # SPDX-License-Identifier: BSD-3-Clause
+import ast
+import glob
+import json
+import math
 import os
+from pathlib import Path
+import re
 import sys
+import tempfile
+from typing import Dict, Tuple
 import unittest
+from unittest import mock
 
 unittest_dir = os.path.dirname(__file__)
 format_converter_dir = os.path.join(unittest_dir, '..')
 sys.path.append(format_converter_dir)
 
 # pylint: disable=g-import-not-at-top
+import metric
 from metric import Constant
 from metric import Event
-from metric import Expression
 from metric import ParsePerfJson
 from metric import RewriteMetricsInTermsOfOthers
 
 
+class _RewriteIfExpToSelect(ast.NodeTransformer):
+  """Transformer to convert if-else nodes to Select expressions."""
+
+  def visit_IfExp(self, node):
+    # pylint: disable=invalid-name
+    self.generic_visit(node)
+    call = ast.Call(
+        func=ast.Name(id='Select', ctx=ast.Load()),
+        args=[node.body, node.test, node.orelse],
+        keywords=[])
+    ast.copy_location(call, node.test)
+    return call
+
+
+def LegacyParsePerfJson(orig: str) -> metric.Expression:
+  """The original ParsePerfJson that rewrites and evaluates as python."""
+  # pylint: disable=eval-used
+  # pylint: disable=protected-access
+  py = orig.strip()
+  py = re.sub(r'([a-zA-Z][^-+/\* \\\(\),]*(?:\\.[^-+/\* \\\(\),]*)*)',
+              r'Event(r"\1")', py)
+  py = re.sub(r'#Event\(r"([^"]*)"\)', r'Literal("#\1")', py)
+  py = re.sub(r'([0-9]+)Event\(r"(e[0-9]+)"\)', r'\1\2', py)
+  # Workaround Valkyrie perf json metric bug.
+  py = py.replace('#( ', '(')
+  keywords = ['if', 'else', 'min', 'max', 'd_ratio', 'source_count', 'has_event']
+  for kw in keywords:
+    py = re.sub(rf'Event\(r"{kw}"\)', kw, py)
+
+  parsed = ast.parse(py, mode='eval')
+  _RewriteIfExpToSelect().visit(parsed)
+  parsed = ast.fix_missing_locations(parsed)
+  return metric._Constify(eval(compile(parsed, orig, 'eval'), vars(metric))) #nosec B307
+
+
+def LegacyRewriteMetricsInTermsOfOthers(metrics: list[Tuple[str, metric.Expression]]
+                                        )-> Dict[str, metric.Expression]:
+  """The original RewriteMetricsInTermsOfOthers substituting every metric in every pass."""
+  updates: Dict[str, metric.Expression] = dict()
+  for outer_name, outer_expression in metrics:
+    updated = outer_expression
+    while True:
+      for inner_name, inner_expression in metrics:
+        if inner_name.lower() == outer_name.lower():
+          continue
+        if inner_name in updates:
+          inner_expression = updates[inner_name]
+        updated = updated.Substitute(inner_name, inner_expression)
+      if updated.Equals(outer_expression):
+        break
+      if outer_name in updates and updated.Equals(updates[outer_name]):
+        break
+      updates[outer_name] = updated
+  return updates
+
+
+def CorpusMetricExpressions() -> list[str]:
+  """The sorted MetricExpr and MetricThreshold values of the repository's metric json."""
+  result = set()
+  for path in glob.glob(os.path.join(unittest_dir, '..', '..', '*', 'metrics',
+                                     'perf', '*.json')):
+    with open(path, 'r') as metric_json:
+      for m in json.load(metric_json):
+        for key in ['MetricExpr', 'MetricThreshold']:
+          if key in m:
+            result.add(m[key])
+  return sorted(result)
+
+
 class TestMetricExpressions(unittest.TestCase):
 
   def test_Operators(self):
@@ -102,6 +180,60 @@ class TestMetricExpressions(unittest.TestCase):
     after = r'(a if b else (c if d else e))'
     self.assertEqual(ParsePerfJson(before).ToPerfJson(), after)
 
+  def test_PerfPrecedence(self):
+    # Comparisons bind more tightly than the bitwise operators, as in
+    # perf, so that generated thresholds parse back unchanged.
+    before = r'a > 0.1 & (b > 0.2 | c < 0.9)'
+    self.assertEqual(ParsePerfJson(before).ToPerfJson(), before)
+    expr = ParsePerfJson(r'a > 0.1 & b > 0.15')
+    self.assertEqual(expr.operator, '&')
+    self.assertTrue(expr.Equals((Event('a') > 0.1) & (Event('b') > 0.15)))
+    # Comparisons of comparisons are bracketed as they don't chain.
+    expr = (Event('a') < Event('b')) > 1
+    self.assertEqual(expr.ToPerfJson(), '(a < b) > 1')
+    self.assertIs(ParsePerfJson(expr.ToPerfJson()), expr)
+
+    for before in CorpusMetricExpressions():
+      with self.subTest(before=before):
+        expr = ParsePerfJson(before)
+        self.assertTrue(ParsePerfJson(expr.ToPerfJson()).Equals(expr))
+
+  def test_ParsePython(self):
+    # Operators follow perf's precedence and constants are folded.
+    before = r'a < b & c'
+    after = r'Event(r"a") < Event(r"b") & Event(r"c")'
+    self.assertEqual(ParsePerfJson(before).ToPython(), after)
+
+    before = r'2 * 3 * a - 1 / 2'
+    after = r'Constant(6) * Event(r"a") - Constant(0.5)'
+    self.assertEqual(ParsePerfJson(before).ToPython(), after)
+
+    before = r'#( a) * -1 + #SMT_on'
+    after = r'Event(r"a") * Constant(-1) + Literal(#SMT_on)'
+    self.assertEqual(ParsePerfJson(before).ToPython(), after)
+
+    before = r'min(a, 1e3) if b else d_ratio(cpu@x\,cmask\=1@, c:R)'
+    after = (r'Select(min(Event(r"a"), Constant(1e3)), Event(r"b"), '
+             r'd_ratio(Event(r"cpu@x\,cmask\=1@"), Event(r"c:R")))')
+    self.assertEqual(ParsePerfJson(before).ToPython(), after)
+
+    # Exponents may be signed.
+    self.assertEqual(ParsePerfJson(r'a * 1e-3').ToPython(),
+                     r'Event(r"a") * Constant(0.001)')
+    self.assertEqual(ParsePerfJson(r'2.5e+2 * a').ToPython(),
+                     r'Constant(250) * Event(r"a")')
+
+    for before in ['a b', 'a +', '(a', 'a if b', 'min(a', 'if', '0x10',
+                   'a < b < c', 'a > 1 >= b']:
+      with self.assertRaises(SyntaxError):
+        ParsePerfJson(before)
+
+  def test_ParseCorpusMatchesLegacy(self):
+    for expr in CorpusMetricExpressions():
+      with self.subTest(expr=expr):
+        self.assertEqual(LegacyParsePerfJson(expr).ToPython(),
+                         ParsePerfJson(expr).ToPython())
+
   def test_ToPython(self):
     # pylint: disable=eval-used
     # Based on an example of a real metric.
@@ -159,13 +291,374 @@ class TestMetricExpressions(unittest.TestCase):
     after = 'a'
     self.assertEqual(ParsePerfJson(before).Simplify().ToPerfJson(), after)
 
+    # Like terms are merged and cancelled, however bracketed and ordered.
+    tests = [
+        ('a - (2 * a - b) + 1 + 2', 'b - a + 3'),
+        ('(2 * a) - (1 * a)', 'a'),
+        ('x + y - x', 'y'),
+        ('a * b * 2 + 3 * b * a', '5 * a * b'),
+        ('0.1 * a + 0.2 * a', '0.3 * a'),
+        ('(a + b) / (b + a)', '1'),
+        ('a * b / (c * b)', 'a / c'),
+        ('x / y / x', '1 / y'),
+        # Constants along a chain fold, keeping a divisor unless it divides.
+        ('a * 2 / 4 * 6', 'a * 3'),
+        ('64 * a / 1e6 / b / 1e3', '64 * a / 1e9 / b'),
+        ('a - 3 - 2', 'a - 5'),
+        ('0 / b * a', '0'),
+        # Sums and products that don't simplify are kept as written.
+        ('1 - (a + b)', '1 - (a + b)'),
+        ('b * a + c', 'b * a + c'),
+        ('100 * (a / b) * (c / (5 * d))', '100 * (a / b) * (c / (5 * d))'),
+    ]
+    for before, after in tests:
+      with self.subTest(expr=before):
+        self.assertEqual(ParsePerfJson(before).Simplify().ToPerfJson(), after)
+
+    # Cancelling keeps the structure of other operands, such as metrics
+    # that RewriteMetricsInTermsOfOthers may substitute.
+    inner = ParsePerfJson('78 * c / d')
+    expr = ParsePerfJson('a / (b + a) * (78 * c / d / a)').Simplify()
+    self.assertEqual(expr.ToPerfJson(), '78 * c / d / (b + a)')
+    self.assertIs(expr.lhs, inner)
+
+  def test_SimplifyChains(self):
+    # A chain of sums or products is simplified once, at its root, not
+    # at every node, which would take time quadratic in its length.
+    calls = []
+    for name in ('_SimplifySum', '_SimplifyProduct'):
+      original = getattr(metric, name)
+      def Count(*args, original=original, name=name):
+        calls.append(name)
+        return original(*args)
+      patcher = mock.patch.object(metric, name, Count)
+      patcher.start()
+      self.addCleanup(patcher.stop)
+    terms = [f'e{i}' for i in range(500)]
+    for op, name in ((' + ', '_SimplifySum'), (' * ', '_SimplifyProduct')):
+      with self.subTest(op=op):
+        calls.clear()
+        before = op.join(terms)
+        self.assertEqual(ParsePerfJson(before).Simplify().ToPerfJson(), before)
+        self.assertEqual(calls, [name])
+    calls.clear()
+    expr = ParsePerfJson(' + '.join(terms) + ' - e0 + 2 * (e1 - e2 + 3)').Simplify()
+    self.assertEqual(expr.ToPerfJson(), ' + '.join(terms[1:]) + ' + 2 * (e1 - e2 + 3)')
+    self.assertEqual(calls, ['_SimplifySum', '_SimplifyProduct', '_SimplifySum'])
+
   def test_RewriteMetricsInTermsOfOthers(self):
-    Expression.__eq__ = lambda e1, e2: e1.Equals(e2)
     before = [('m1', ParsePerfJson('a + b + c + d')),
               ('m2', ParsePerfJson('a + b + c'))]
     after = {'m1': ParsePerfJson('m2 + d')}
     self.assertEqual(RewriteMetricsInTermsOfOthers(before), after)
-    Expression.__eq__ = None
+
+    # Substitutions depend on the metric order and earlier rewrites,
+    # metrics with the same name, ignoring case, aren't substituted.
+    before = [('m1', ParsePerfJson('(a + b) * c + (a + b) / d')),
+              ('m2', ParsePerfJson('(a + b) * c')),
+              ('M1', ParsePerfJson('(a + b) * c / d')),
+              ('m3', ParsePerfJson('a + b')),
+              ('m4', ParsePerfJson('min(a + b, (a + b) * c)')),
+              ('m3', ParsePerfJson('x if #SMT_on else a + b'))]
+    self.assertEqual(RewriteMetricsInTermsOfOthers(before),
+                     LegacyRewriteMetricsInTermsOfOthers(before))
+    self.assertEqual(RewriteMetricsInTermsOfOthers(before)['m1'].ToPerfJson(),
+                     'm2 + m3 / d')
+
+    # Only operators, selects and functions are substituted, not a
+    # metric that is just an event or constant.
+    self.assertIs(Event('X').Substitute('y', Event('X')), Event('X'))
+    expr = ParsePerfJson('X + 2 * #SMT_on')
+    for leaf in (Event('X'), Constant(2), metric.Literal('#SMT_on')):
+      self.assertIs(expr.Substitute('y', leaf), expr)
+    before = [('m1', ParsePerfJson('INST_RETIRED.ANY / CLKS')),
+              ('m2', ParsePerfJson('INST_RETIRED.ANY'))]
+    self.assertEqual(RewriteMetricsInTermsOfOthers(before), {})
+    self.assertEqual(LegacyRewriteMetricsInTermsOfOthers(before), {})
+
+  def test_Compile(self):
+    values = {'a': 6.0, 'b': 3.0, 'zero': 0.0, '#SMT_on': 1.0,
+              'cpu@x\\,cmask\\=1@': 2.0, 'source_count(b)': 4.0}
+    tests = [
+        ('a + b * 2 - a / b', 10.0),
+        ('a % 4 + (a > b) + (a < b) + (a & b) + (a | 1)', 12.0),
+        ('min(a, b) + max(a, b)', 9.0),
+        ('d_ratio(a, zero) + d_ratio(a, b)', 2.0),
+        ('a if #SMT_on else b', 6.0),
+        # Only the branch taken is computed.
+        ('missing if has_event(missing) else cpu@x\\,cmask\\=1@', 2.0),
+        ('has_event(a) + source_count(a) + source_count(b)', 6.0),
+        ('(a + b) * (a + b) / 9', 9.0),
+        ('1e3 * b', 3000.0),
+    ]
+    for before, after in tests:
+      with self.subTest(expr=before):
+        self.assertEqual(ParsePerfJson(before).Compile()(values), after)
+    self.assertTrue(math.isnan(ParsePerfJson('a / zero').Compile()(values)))
+    with self.assertRaises(KeyError):
+      ParsePerfJson('a + missing').Compile()(values)
+    # Compiled functions are reused.
+    expr = ParsePerfJson('a / b')
+    self.assertIs(expr.Compile(), ParsePerfJson('a / b').Compile())
+
+  def test_CompileMetrics(self):
+    metrics = [
+        ('slots', ParsePerfJson('4 * cycles')),
+        ('retiring', ParsePerfJson('uops / Slots')),
+        ('frontend', ParsePerfJson('bubbles / slots')),
+        ('other', ParsePerfJson('1 - retiring - frontend if has_event(bubbles) else retiring')),
+        ('ipc', ParsePerfJson('instructions / cycles')),
+    ]
+    values = {'cycles': 10.0, 'uops': 20.0, 'bubbles': 4.0, 'instructions': 5.0}
+    program = metric.CompileMetrics(metrics)
+    self.assertEqual(program(values), {'slots': 40.0, 'retiring': 0.5, 'frontend': 0.1,
+                                       'other': 0.4, 'ipc': 0.5})
+    # Shared values, like slots, are computed once: 12 temporaries and v.
+    self.assertEqual(program.__code__.co_nlocals, 13)
+    del values['bubbles']
+    with self.assertRaises(KeyError):
+      program(values)
+    values['bubbles'] = 0.0
+    self.assertEqual(program(values)['frontend'], 0.0)
+
+    with self.assertRaises(ValueError):
+      metric.CompileMetrics([('a', ParsePerfJson('b + 1')), ('b', ParsePerfJson('a * 2'))])
+
+  @unittest.skipIf(metric.np is None, 'requires numpy')
+  def test_EvaluateArrays(self):
+    np = metric.np
+    values = {'a': np.array([6.0, 0.0, -7.5, 3.0, 1e9]),
+              'b': np.array([3.0, 2.0, 0.0, 3.0, 0.5]),
+              '#SMT_on': np.array([1.0, 0.0, 1.0, 0.0, 1.0]),
+              'source_count(b)': 4.0}
+    exprs = [
+        'a + b * 2 - a / b',
+        'a % b + (a > b) + (a < b) + (a & 6) + (b | 1) + (a ^ b)',
+        'min(a, b) + max(a, b) + min(a / b, 1) + max(1, a / b)',
+        'd_ratio(a, b) + d_ratio(a, 0)',
+        'a if #SMT_on else b / a',
+        'a if a > 1e10 else b',
+        'missing if has_event(missing) else a',
+        'has_event(a) + source_count(a) + source_count(b)',
+        '(a + b) * (a + b) / 9',
+        '3 * 2',
+    ]
+    for text in exprs:
+      with self.subTest(expr=text):
+        expr = ParsePerfJson(text)
+        result = expr.EvaluateArrays(values)
+        self.assertEqual(result.shape, (5,))
+        fn = expr.Compile()
+        for i, actual in enumerate(result):
+          expected = fn({k: float(np.broadcast_to(v, (5,))[i])
+                         for k, v in values.items()})
+          if math.isnan(expected):
+            self.assertTrue(math.isnan(actual))
+          else:
+            self.assertEqual(actual, expected)
+
+  def test_FlatExpression(self):
+    values = {'a': 6.0, 'b': 0.0, 'c': -7.5, '#SMT_on': 1.0, 'source_count(b)': 4.0}
+    exprs = [
+        'a + b * 2 - a / b + c / a',
+        'a % b + a % c + (a > b) + (a < b) + (a & 6) + (c | 1) + (a ^ b)',
+        'min(a, b) + max(a, c) + d_ratio(a, b) + d_ratio(c, a)',
+        '(a if #SMT_on else b / a) + (b if c > 1 else (a if b else c))',
+        '(missing if has_event(missing) else a) + has_event(a)',
+        'source_count(a) + source_count(b)',
+        '(a + b) * (a + b) / 9',
+        '3',
+    ]
+    for text in exprs:
+      with self.subTest(expr=text):
+        expr = ParsePerfJson(text)
+        flat = metric.FlatExpression(expr)
+        self.assertIs(flat.ToExpression(), expr)
+        expected = expr.Compile()(values)
+        if math.isnan(expected):
+          self.assertTrue(math.isnan(flat.Evaluate(values)))
+        else:
+          self.assertEqual(flat.Evaluate(values), expected)
+
+    for text in CorpusMetricExpressions():
+      expr = ParsePerfJson(text)
+      self.assertIs(metric.FlatExpression(expr).ToExpression(), expr)
+
+    with self.assertRaises(ValueError):
+      metric.FlatExpression(metric.Function('source_count', Event('a') + 1))
+    # The true value of a Select can't be jumped over.
+    big = Event('e0')
+    for i in range(1, 1 << 15):
+      big = big + Event(f'e{i}')
+    with self.assertRaises(ValueError):
+      metric.FlatExpression(metric.Select(big, Event('c'), 0))
+
+  def test_NonFiniteOperands(self):
+    # A NaN, say from dividing by zero, makes % NaN and the bitwise
+    # operators false, rather than failing to convert it to an int.
+    values = {'a': 6.0, 'zero': 0.0, 'big': 1e308}
+    tests = [
+        ('a / zero % 4', math.nan),
+        ('a % (a / zero)', math.nan),
+        ('big * 10 % a', math.nan),
+        ('(a / zero > 1) & (a > 1)', 0.0),
+        ('a / zero & a', 0.0),
+        ('a | a / zero', 0.0),
+        ('big * 10 ^ a', 0.0),
+        ('(a > 1) | (a / zero > 1)', 1.0),
+    ]
+    evaluators = [
+        ('Compile', lambda expr: expr.Compile()(values)),
+        ('FlatExpression', lambda expr: metric.FlatExpression(expr).Evaluate(values)),
+    ]
+    if metric.np is not None:
+      evaluators.append(('EvaluateArrays',
+                         lambda expr: float(expr.EvaluateArrays(values))))
+    for text, expected in tests:
+      for name, evaluate in evaluators:
+        with self.subTest(expr=text, evaluator=name):
+          actual = evaluate(ParsePerfJson(text))
+          if math.isnan(expected):
+            self.assertTrue(math.isnan(actual))
+          else:
+            self.assertEqual(actual, expected)
+
+  def test_HashConsing(self):
+    # Equal expressions are the same object.
+    a = ParsePerfJson('min(a, 2) + (b if #SMT_on else c)')
+    b = ParsePerfJson('min(a, 2.0) + (b if #SMT_on else c)')
+    self.assertIs(a, b)
+    self.assertEqual(hash(a), hash(b))
+    self.assertTrue(a.Equals(b))
+    self.assertIs(Event('x,y'), Event(r'x\,y'))
+    self.assertIsNot(Event('x'), Constant(1))
+
+    # Substitute returns unchanged subtrees.
+    c = ParsePerfJson('(a + b) * c + d / e')
+    d = c.Substitute('m', ParsePerfJson('a + b'))
+    self.assertEqual(d.ToPerfJson(), 'm * c + d / e')
+    self.assertIs(d.rhs, c.rhs)
+    self.assertIs(c.Substitute('m', ParsePerfJson('x')), c)
+
+    with self.assertRaises(AttributeError):
+      c.lhs = Event('x')
+
+  def test_ParseCache(self):
+    texts = ['min(a, 2) + (b if #SMT_on else c)', 'a / (b * c)',
+             'd_ratio(cpu@x\\,y@, source_count(z))', '(a + b) * (a + b)']
+    expected = [ParsePerfJson(t) for t in texts]
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = metric.ParseCache(Path(cache_dir), max_entries=3)
+      previous = metric.SetParseCache(cache)
+      self.addCleanup(metric.SetParseCache, previous)
+      for t, e in zip(texts, expected):
+        self.assertIs(ParsePerfJson(t), e)
+      # Reuse the first text so that the second is least recently used.
+      self.assertIs(ParsePerfJson(texts[0]), expected[0])
+      with self.assertRaises(SyntaxError):
+        ParsePerfJson('a +')
+      cache.Save()
+
+      # A later run rebuilds the expressions from the file.
+      cache = metric.ParseCache(Path(cache_dir), max_entries=3)
+      metric.SetParseCache(cache)
+      self.assertEqual(sorted(cache.entries), sorted(texts[:1] + texts[2:]))
+      for t, e in zip(texts, expected):
+        self.assertIs(cache.Get(t), None if t == texts[1] else e)
+        self.assertIs(ParsePerfJson(t), e)
+
+      # Entries saved concurrently by another process are kept, as the
+      # least recently used.
+      other = metric.ParseCache(Path(cache_dir))
+      other.Put('x + 1', Event('x') + 1)
+      other.Save()
+      cache.max_entries = 5
+      cache.Save()
+      self.assertEqual(list(metric.ParseCache(Path(cache_dir)).entries),
+                       ['x + 1'] + texts)
+
+      # A failed save leaves no temporary file behind.
+      cache.path.unlink()
+      Path(cache.path, 'blocked').mkdir(parents=True)
+      cache.Put('y + 1', Event('y') + 1)
+      cache.Save()
+      self.assertTrue(cache.dirty)
+      self.assertEqual(list(Path(cache_dir).glob('*.tmp')), [])
+
+  def test_Visitor(self):
+    # Expressions deeper than the recursion limit, as a generated
+    # threshold may be, can be written, simplified and substituted.
+    depth = 2 * sys.getrecursionlimit()
+    deep = Event('e0') > 0
+    for i in range(1, depth):
+      deep = deep & (Event(f'e{i}') > 0)
+    text = deep.ToPerfJson()
+    self.assertEqual(text.count('&'), depth - 1)
+    self.assertTrue(text.endswith(f' & e{depth - 1} > 0'))
+    self.assertTrue(deep.ToPython().startswith('Event(r"e0") > Constant(0) & '))
+    self.assertIs(deep.Simplify(), deep)
+    self.assertIs(deep.Substitute('x', deep.lhs), Event('x') & deep.rhs)
+    first = (Event('e0') > 0) & (Event('e1') > 0)
+    self.assertIs(deep.Substitute('x', Event('e0') > 0).Substitute('y', Event('x') & (Event('e1') > 0)),
+                  deep.Substitute('y', first))
+    self.assertIsNot(deep.Substitute('y', first), deep)
+
+    # A new pass is a visitor of the node types it handles.
+    class CountEvents(metric.ExpressionVisitor):
+      def VisitOperator(self, expr, lhs, rhs):
+        return lhs + rhs
+
+      def VisitEvent(self, expr):
+        return 1
+
+      def VisitConstant(self, expr):
+        return 0
+
+    self.assertEqual(CountEvents().Visit(deep), depth)
+    with self.assertRaises(NotImplementedError):
+      CountEvents().Visit(ParsePerfJson('min(a, b)'))
+
+    # Replace skips a node's operands, a transformer keeps unchanged nodes.
+    class DropMin(metric.ExpressionTransformer):
+      def Replace(self, expr):
+        if isinstance(expr, metric.Function) and expr.fn == 'min':
+          return expr.lhs
+        return None
+
+    e = ParsePerfJson('min(a, b) + (c if d else max(e, f))')
+    self.assertEqual(DropMin().Visit(e).ToPerfJson(), 'a + (c if d else max(e, f))')
+    self.assertIs(DropMin().Visit(e).rhs, e.rhs)
+
+    # Functions of constants fold.
+    self.assertEqual(ParsePerfJson('min(3, 2) + max(1, 4) + d_ratio(6, 0)').Simplify().ToPerfJson(), '6')
+    self.assertEqual(ParsePerfJson('d_ratio(6, 3)').Simplify().ToPerfJson(), '2')
+
+  def test_DeepExpressions(self):
+    # Sums and products deeper than the recursion limit simplify, compile
+    # and evaluate.
+    depth = 2 * sys.getrecursionlimit()
+    names = [f'E{i}' for i in range(depth)]
+    values = {name: float(i % 7) for i, name in enumerate(names)}
+    total = sum(values.values())
+    deep = ParsePerfJson(' + '.join(names))
+    simplified = deep.Simplify()
+    self.assertEqual(simplified.ToPerfJson().count('+'), depth - 1)
+    self.assertIs(simplified.Simplify(), simplified)
+    self.assertEqual(deep.Compile()(values), total)
+    self.assertEqual(simplified.Compile()(values), total)
+
+    # Sums of products of sums, and so on.
+    nested = Event(names[0])
+    for i, name in enumerate(names[1:]):
+      nested = nested + Event(name) if i % 2 else nested * Event(name) + 1
+    self.assertIs(nested.Simplify().Simplify(), nested.Simplify())
+    self.assertEqual(nested.Simplify().Compile()(values), nested.Compile()(values))
+
+    if metric.np is not None:
+      arrays = {name: metric.np.full(3, value) for name, value in values.items()}
+      self.assertEqual(list(deep.EvaluateArrays(arrays)), [total] * 3)
+      self.assertEqual(list(nested.EvaluateArrays(arrays)),
+                       [nested.Compile()(values)] * 3)
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,96 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+import json
+import tempfile
+import unittest
+import sys
+from pathlib import Path
+
+# Add collection_plan.py directory to the path before importing.
+_script_dir = Path(__file__).resolve().parent
+sys.path.append(str(_script_dir.parent))
+
+from collection_plan import alias_key, plan
+from perf_groups import PerfModel
+
+
+class TestCollectionPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        events = [
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD', 'UMask': '0x2',
+             'Counter': 'Fixed counter 1', 'SampleAfterValue': '2000003'},
+            {'EventName': 'CPU_CLK_UNHALTED.THREAD_P', 'EventCode': '0x3c',
+             'Counter': '0,1,2,3', 'SampleAfterValue': '2000003'},
+            {'EventName': 'L2_RQSTS.MISS', 'EventCode': '0x24', 'UMask': '0x3f',
+             'Counter': '0,1,2,3', 'SampleAfterValue': '200003'},
+            {'EventName': 'L2_REQUEST.MISS', 'EventCode': '0x24', 'UMask': '0x3f',
+             'Counter': '0,1,2,3', 'SampleAfterValue': '200003', 'Deprecated': '1'},
+            {'EventName': 'L2_RQSTS.REFERENCES', 'EventCode': '0x24', 'UMask': '0xff',
+             'Counter': '0,1,2,3', 'SampleAfterValue': '200003'},
+            {'EventName': 'L2_RQSTS.REFERENCES_CMASK', 'EventCode': '0x24', 'UMask': '0xff',
+             'CounterMask': '1', 'Counter': '0,1,2,3', 'SampleAfterValue': '200003'},
+        ]
+        metrics = [
+            {'MetricName': 'clks', 'MetricExpr': 'CPU_CLK_UNHALTED.THREAD',
+             'MetricGroup': 'Base'},
+            {'MetricName': 'l2_mpki', 'MetricExpr': 'L2_RQSTS.MISS / clks',
+             'MetricGroup': 'Base;Cache'},
+            {'MetricName': 'l2_miss_ratio',
+             'MetricExpr': 'cpu@L2_REQUEST.MISS@ / L2_RQSTS.REFERENCES',
+             'MetricGroup': 'Cache'},
+            {'MetricName': 'l2_busy',
+             'MetricExpr': r'cpu@L2_RQSTS.REFERENCES\,cmask\=1@ / cycles',
+             'MetricGroup': 'Cache'},
+        ]
+        for file, data in [
+                ('cache.json', events), ('test-metrics.json', metrics),
+                ('counter.json', [{'Unit': 'core', 'CountersNumFixed': '3',
+                                   'CountersNumGeneric': '4'}]),
+                ('metricgroups.json', {'Base': 'Base metrics', 'Cache': 'Cache metrics'})]:
+            with open(Path(self.tmp.name, file), 'w', encoding='ascii') as f:
+                json.dump(data, f)
+        self.model = PerfModel(Path(self.tmp.name))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_alias_key(self):
+        key = lambda e: alias_key(self.model, e)
+        self.assertEqual(key('L2_RQSTS.MISS'), key('cpu@L2_REQUEST.MISS@'))
+        self.assertEqual(key('cycles'), key('CPU_CLK_UNHALTED.THREAD_P'))
+        self.assertEqual(key(r'cpu@L2_RQSTS.REFERENCES\,cmask\=1@'),
+                         key('L2_RQSTS.REFERENCES_CMASK'))
+        self.assertNotEqual(key('CPU_CLK_UNHALTED.THREAD'), key('cycles'))
+        self.assertNotEqual(key('L2_RQSTS.MISS'), key('L2_RQSTS.MISS:k'))
+        self.assertNotEqual(key('L2_RQSTS.MISS'), key('L2_RQSTS.MISS:R'))
+
+    def test_plan(self):
+        self.assertEqual(self.model.metricgroups['Cache'], 'Cache metrics')
+        result = plan(self.model, ['Base', 'Cache'])
+        self.assertEqual(result.metrics, ['clks', 'l2_mpki', 'l2_miss_ratio', 'l2_busy'])
+        self.assertEqual(result.references, 7)
+        # L2_REQUEST.MISS is counted as L2_RQSTS.MISS.
+        self.assertEqual(result.aliases, {'L2_RQSTS.MISS': ['cpu@L2_REQUEST.MISS@']})
+        self.assertEqual(result.readers, {
+            'CPU_CLK_UNHALTED.THREAD': ['clks', 'l2_mpki'],
+            'L2_RQSTS.MISS': ['l2_mpki', 'l2_miss_ratio'],
+            'L2_RQSTS.REFERENCES': ['l2_miss_ratio'],
+            r'cpu@L2_RQSTS.REFERENCES\,cmask\=1@': ['l2_busy'],
+            'cycles': ['l2_busy'],
+        })
+        command = result.command()
+        self.assertTrue(command.startswith("perf stat -e '{"))
+        self.assertNotIn('L2_REQUEST.MISS', command)
+        self.assertEqual(command.count('L2_RQSTS.MISS'), 1)
+        self.assertIn('cpu/L2_RQSTS.REFERENCES,cmask=1/', command)
+        report = result.report()
+        self.assertIn('4 metrics read 7 events, 5 once deduplicated', report)
+        self.assertIn('L2_RQSTS.MISS: l2_mpki, l2_miss_ratio', report)
+        self.assertIn('L2_RQSTS.MISS also counts cpu/L2_REQUEST.MISS/', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,222 @@
 # Copyright (C) 2024 Intel Corporation
 # SPDX-License-Identifier: BSD-3-Clause
 
+import csv
+import hashlib
+import json
+import marshal
+import os
+import re
+import shutil
+import tempfile
+import time
 import unittest
 import sys
 from pathlib import Path
+from typing import Dict
 
 # Add create_perf_json.py directory to the path before importing.
 _script_dir = Path(__file__).resolve().parent
 sys.path.append(str(_script_dir.parent))
+_repo_dir = _script_dir.parent.parent
+
+import create_perf_json
+import metric
+from create_perf_json import JsonFileLoader, Mapfile, Model, PerfmonJsonEvent, TmaFormulaFixer, TmaSpreadsheet
+
+
+def legacy_topic(event_name: str) -> str:
+    """The original regular expression scan used to classify CPU events."""
+    result = None
+    result_priority = -1
+    for topic in sorted(create_perf_json._topics.keys()):
+        for regexp, priority in sorted(create_perf_json._topics[topic],
+                                       key=lambda match: (-match[1], match[0])):
+            if re.match(regexp, event_name) and priority >= result_priority:
+                result = topic
+                result_priority = priority
+            if priority < result_priority:
+                break
+    return result if result else 'Other'
+
+
+def corpus_event_names() -> list[str]:
+    """The sorted names of every event in the repository's event json."""
+    names = set()
+    for path in sorted(_repo_dir.glob('*/events/*.json')):
+        with open(path, 'r') as event_json:
+            for event in json.load(event_json).get('Events', []):
+                if 'EventName' in event:
+                    names.add(PerfmonJsonEvent.fix_name(event['EventName'].strip()))
+    return sorted(names)
+
+
+class TestTopic(unittest.TestCase):
+
+    def test_unit_topic(self):
+        self.assertEqual('Uncore-Cache', create_perf_json.topic('UNC_CHA_CLOCKTICKS', 'CHA'))
+        self.assertEqual('Uncore-Memory', create_perf_json.topic('UNC_M_CAS_COUNT.RD', 'imc'))
+        with self.assertRaises(ValueError):
+            create_perf_json.topic('UNC_X', 'not_a_pmu')
+
+    def test_priority(self):
+        tests = [
+            ('L2_RQSTS.MISS', 'Cache'),
+            ('ICACHE_64B.IFTAG_MISS', 'Frontend'),
+            # Pipeline and Frontend both match IDQ at priority 1 and 3.
+            ('IDQ.DSB_UOPS', 'Frontend'),
+            # Cache and Memory both match MEM_ at priority 3.
+            ('MEM_TRANS_RETIRED.LOAD_LATENCY_GT_4', 'Memory'),
+            ('NOT_AN_EVENT', 'Other'),
+        ]
+        for name, expected in tests:
+            with self.subTest(name=name):
+                self.assertEqual(expected, create_perf_json.topic(name, None))
+                self.assertEqual(expected, create_perf_json.topic(name, 'cpu_core'))
+
+    def test_corpus_matches_legacy(self):
+        """Every event in the repository has the same topic as the regular expression scan."""
+        names = corpus_event_names()
+        self.assertGreater(len(names), 1000)
+        for name in names:
+            self.assertEqual(legacy_topic(name), create_perf_json.topic(name, None), name)
+
+
+class TestCounterBitmask(unittest.TestCase):
+
+    def test_counter_bitmask(self):
+        fixed = create_perf_json.FIXED_COUNTER_SHIFT
+        self.assertEqual(create_perf_json.counter_bitmask('0,1,2,3'), 0xf)
+        self.assertEqual(create_perf_json.counter_bitmask('0-7'), 0xff)
+        self.assertEqual(create_perf_json.counter_bitmask('2,3'), 0xc)
+        self.assertEqual(create_perf_json.counter_bitmask('Fixed counter 2'), 1 << (fixed + 2))
+        self.assertEqual(create_perf_json.counter_bitmask('FIXED'), 1 << fixed)
+        self.assertEqual(create_perf_json.counter_bitmask('36'), 1 << (fixed + 4))
+        self.assertEqual(create_perf_json.counter_bitmask('NA'), 0)
+        self.assertEqual(create_perf_json.counter_bitmask(None), 0)
+
+    def test_event_bitmasks(self):
+        event = PerfmonJsonEvent('SPR', 'cpu', {
+            'EventName': 'INST_RETIRED.PREC_DIST', 'EventCode': '0x00', 'UMask': '0x01',
+            'BriefDescription': 'Precise instruction retired',
+            'PublicDescription': 'Precise instruction retired event.', 'Counter': 'Fixed counter 0',
+            'PDISTCounter': '32'}, False)
+        fixed_0 = 1 << create_perf_json.FIXED_COUNTER_SHIFT
+        self.assertEqual(event.counters_bitmask, fixed_0)
+        self.assertEqual(event.pdist_bitmask, fixed_0)
+        self.assertIn('Available PDIST counters: 32', event.public_description)
+
+
+    def test_counters_fit(self):
+        fit = create_perf_json.counters_fit
+        self.assertTrue(fit((0x1, 0x3, 0xf, 0xf), 0xf))
+        self.assertFalse(fit((0x1, 0x1), 0xf))
+        # Placing the first event on counter 0 must be undone for the second.
+        self.assertTrue(fit((0x3, 0x1), 0xf))
+        self.assertFalse(fit((0xf,) * 5, 0xf))
+        # Topdown events need no counter.
+        self.assertTrue(fit((0, 0, 0x1), 0x1))
+
+
+class TestMetricCosts(unittest.TestCase):
+
+    def counter_table(self) -> create_perf_json.CounterTable:
+        table = create_perf_json.CounterTable()
+        table.add_unit('core', 4, 4)
+        table.add_unit('CHA', 0, 4)
+        fixed = 1 << create_perf_json.FIXED_COUNTER_SHIFT
+        table.add_event('INST_RETIRED.ANY', 'core', fixed, False)
+        table.add_event('EVENT.ONLY_0', 'core', 0x1, False)
+        for i in range(6):
+            table.add_event(f'EVENT.ANY{i}', 'core', 0xf, False)
+        table.add_event('UNC_CHA_CLOCKTICKS', 'CHA', 0xf, True)
+        return table
+
+    def test_split_event(self):
+        for event, expected in [
+                ('INST_RETIRED.ANY', (None, 'INST_RETIRED.ANY')),
+                ('INST_RETIRED.ANY_P:k', (None, 'INST_RETIRED.ANY_P')),
+                (r'cpu@INST_RETIRED.ANY\,cmask\=1@', ('cpu', 'INST_RETIRED.ANY')),
+                ('cpu_core@MEM_INST_RETIRED.LOCK_LOADS@R', ('cpu_core', 'MEM_INST_RETIRED.LOCK_LOADS')),
+                (r'UNC_CHA_TOR_OCCUPANCY.IA_MISS@thresh\=1@', (None, 'UNC_CHA_TOR_OCCUPANCY.IA_MISS')),
+                (r'topdown\-retiring', (None, 'topdown-retiring')),
+                ('msr@tsc@', ('msr', 'tsc')),
+        ]:
+            with self.subTest(event=event):
+                self.assertEqual(create_perf_json.split_event(event), expected)
+
+    def test_parse_event(self):
+        parse = create_perf_json.parse_event
+        self.assertEqual(parse(r'cpu@INST_RETIRED.ANY\,cmask\=1\,edge@k'),
+                         ('cpu', 'INST_RETIRED.ANY', {'cmask': '1', 'edge': ''}, 'k'))
+        self.assertEqual(parse(r'uncore_cha_0@event\=0x1\,umask\=0x2@'),
+                         ('uncore_cha_0', '', {'event': '0x1', 'umask': '0x2'}, ''))
+        self.assertEqual(parse('EVENT.A:R'), (None, 'EVENT.A', {}, 'R'))
+
+    def test_placement(self):
+        table = self.counter_table()
+        self.assertEqual(table.placement('EVENT.ONLY_0:u').bitmask, 0x1)
+        self.assertEqual(table.placement('topdown\\-retiring'),
+                         create_perf_json.EventCounters('core', 0, False))
+        self.assertEqual(table.placement('uncore_cha_1@event\\=0x1@'),
+                         create_perf_json.EventCounters('CHA', create_perf_json.GENERIC_COUNTERS,
+                                                        True))
+        self.assertIsNone(table.placement('msr@tsc@'))
+        self.assertIsNone(table.placement('duration_time'))
+        placements = [table.placement(e) for e in
+                      ['EVENT.ONLY_0', 'cpu@EVENT.ONLY_0\\,cmask\\=1@', 'INST_RETIRED.ANY',
+                       'topdown\\-retiring', 'UNC_CHA_CLOCKTICKS']]
+        # Two events need counter 0 and the uncore event its own group.
+        self.assertEqual(table.min_groups(placements), 3)
+        placements = [table.placement(f'EVENT.ANY{i}') for i in range(6)]
+        self.assertEqual(table.min_groups(placements), 2)
+
+    def test_metric_events(self):
+        metrics = [
+            {'MetricName': 'ipc', 'MetricExpr': 'INST_RETIRED.ANY / cycles'},
+            {'MetricName': 'a', 'MetricExpr': 'EVENT.ANY0 * ipc'},
+            {'MetricName': 'ipc', 'MetricExpr': 'cpu_atom@INST_RETIRED.ANY@', 'Unit': 'cpu_atom'},
+            {'MetricName': 'b', 'MetricExpr': 'ipc + a', 'Unit': 'cpu_atom'},
+        ]
+        self.assertEqual(create_perf_json.metric_events(metrics), [
+            {'INST_RETIRED.ANY', 'cycles'},
+            {'EVENT.ANY0', 'INST_RETIRED.ANY', 'cycles'},
+            {'cpu_atom@INST_RETIRED.ANY@'},
+            {'cpu_atom@INST_RETIRED.ANY@', 'EVENT.ANY0', 'INST_RETIRED.ANY', 'cycles'},
+        ])
+        self.assertRaises(ValueError, lambda: create_perf_json.metric_events(
+            [{'MetricName': 'a', 'MetricExpr': 'b'}, {'MetricName': 'b', 'MetricExpr': 'a + 1'}]))
+
+    def test_write_metric_costs(self):
+        metrics = [
+            {'MetricName': 'ipc', 'MetricExpr': 'INST_RETIRED.ANY / cycles'},
+            {'MetricName': 'cha', 'MetricExpr': 'UNC_CHA_CLOCKTICKS / duration_time + ipc'},
+            {'MetricName': 'lat', 'MetricExpr': 'EVENT.ANY0:R * EVENT.ONLY_0'},
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, 'metric-costs.csv')
+            Model.write_metric_costs(path, metrics, {}, self.counter_table())
+            with open(path, 'r', encoding='ascii') as f:
+                rows = list(csv.DictReader(f))
+        self.assertEqual([r['MetricName'] for r in rows], ['ipc', 'cha', 'lat'])
+        self.assertEqual(rows[0]['CounterGroups'], '1')
+        self.assertEqual(rows[0]['PMUs'], 'core')
+        self.assertEqual(rows[1]['Events'], '4')
+        self.assertEqual(rows[1]['CounterGroups'], '2')
+        self.assertEqual(rows[1]['PMUs'], 'CHA;core;tool')
+        self.assertEqual((rows[1]['Uncore'], rows[1]['RetireLatency']), ('1', '0'))
+        self.assertEqual((rows[2]['Uncore'], rows[2]['RetireLatency']), ('0', '1'))
+        self.assertEqual(rows[2]['EventNames'], 'EVENT.ANY0:R EVENT.ONLY_0')
 
-from create_perf_json import Model
 
 class TestModel(unittest.TestCase):
 
-    def test_extract_pebs_formula(self):
+    @staticmethod
+    def rewrite_pebs(formula: str) -> str:
+        expr = metric.ParsePerfJson(formula.replace('$PEBS', 'PEBS'))
+        return Model.rewrite_pebs(expr).ToPerfJson()
+
+    def test_rewrite_pebs(self):
         """Test formulas which use $PEBS but do not include min() or max()."""
         tests = [
             (
@@ -28,9 +231,9 @@ class TestModel(unittest.TestCase):
 
         for input, expected_result in tests:
             with self.subTest(input=input, expected_result=expected_result):
-                self.assertEqual(expected_result, Model.extract_pebs_formula(input))
+                self.assertEqual(expected_result, self.rewrite_pebs(input))
 
-    def test_extract_pebs_formula_with_min_max(self):
+    def test_rewrite_pebs_with_min_max(self):
         """Test formulas which use $PEBS and also min() or max()."""
         tests = [
             (
@@ -48,9 +251,242 @@ class TestModel(unittest.TestCase):
             (
                 '(cpu_core@EVENT.A@*min($PEBS, 24 * test_info) + cpu_core@EVENT.B@*min($PEBS, 24 - test_info) * (1 - (cpu_core@EVENT.C@ / (cpu_core@EVENT.D@ + cpu_core@EVENT.E@)))) * 5',
                 '(cpu_core@EVENT.A@ * min(cpu_core@EVENT.A@R, 24 * test_info) + cpu_core@EVENT.B@ * min(cpu_core@EVENT.B@R, 24 - test_info) * (1 - cpu_core@EVENT.C@ / (cpu_core@EVENT.D@ + cpu_core@EVENT.E@))) * 5',
-            )
+            ),
+            (
+                'EVENT.A*$PEBS if #SMT_on else EVENT.B*min($PEBS, 3)',
+                '(EVENT.A * EVENT.A:R if #SMT_on else EVENT.B * min(EVENT.B:R, 3))',
+            ),
         ]
 
         for input, expected_result in tests:
             with self.subTest(input=input, expected_result=expected_result):
-                self.assertEqual(expected_result, Model.extract_pebs_formula(input))
+                self.assertEqual(expected_result, self.rewrite_pebs(input))
+
+    def test_substitute_event(self):
+        tsc = metric.Event('msr@tsc@')
+        expr = metric.ParsePerfJson('min(TSC, a) / TSC if #SMT_on else TSC_X')
+        self.assertEqual('(min(msr@tsc@, a) / msr@tsc@ if #SMT_on else TSC_X)',
+                         create_perf_json.substitute_event(expr, 'TSC', tsc).ToPerfJson())
+
+
+class TestTmaFormulaFixer(unittest.TestCase):
+
+    def test_fixup(self):
+        tests = [
+            ('SPR', 'cpu', 'PERF_METRICS.RETIRING / TOPDOWN.SLOTS:perf_metrics',
+             r'topdown\-retiring / TOPDOWN.SLOTS'),
+            ('SPR', 'cpu', '(0 + UNC_CHA_CLOCKTICKS:one_unit)',
+             r'(0 + uncore_cha_0@event\=0x1@)'),
+            ('BDX', 'cpu', 'UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182:c1 / '
+             'UNC_C_TOR_OCCUPANCY.MISS_OPCODE:opc=0x182',
+             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182\,thresh\=1@ / '
+             r'UNC_C_TOR_OCCUPANCY.MISS_OPCODE@filter_opc\=0x182@'),
+            ('SKL', 'cpu', 'UOPS_ISSUED.ANY:c4',
+             r'cpu@UOPS_ISSUED.ANY\,cmask\=4@'),
+            ('SKL', 'cpu', 'INST_RETIRED.ANY_PS:i1',
+             r'cpu@INST_RETIRED.ANY\,inv@'),
+            ('MTL', 'cpu_core', 'PERF_METRICS.RETIRING',
+             r'cpu_core@topdown\-retiring@'),
+        ]
+        for shortname, pmu_prefix, form, expected in tests:
+            with self.subTest(form=form):
+                fixer = TmaFormulaFixer(shortname, pmu_prefix, {})
+                self.assertEqual(expected, fixer.fixup(form))
+
+    def test_fixup_simplify(self):
+        # Arithmetic left by fixup is removed when the metric is simplified.
+        tests = [
+            ('SPR', '(0 + UNC_CHA_CLOCKTICKS:one_unit)', r'uncore_cha_0@event\=0x1@'),
+            ('SKL', '(2 * CLKS) - (1 * CLKS)', 'CLKS'),
+            ('SKL', 'A + RESOURCE_STALLS.SB - RESOURCE_STALLS.SB - B', 'A - B'),
+            ('SKL', 'X * Y / Y * 6 / 100', 'X * 6 / 100'),
+        ]
+        for shortname, form, expected in tests:
+            with self.subTest(form=form):
+                fixer = TmaFormulaFixer(shortname, 'cpu', {})
+                self.assertEqual(expected,
+                                 metric.ParsePerfJson(fixer.fixup(form)).Simplify().ToPerfJson())
+
+    def test_hybrid_prefix(self):
+        event = PerfmonJsonEvent('MTL', 'cpu_core', {
+            'EventName': 'INST_RETIRED.ANY',
+            'EventCode': '0xc0',
+            'UMask': '0x0',
+            'Counter': 'Fixed counter 0',
+        }, False)
+        fixer = TmaFormulaFixer('MTL', 'cpu_core', {'INST_RETIRED.ANY': event})
+        self.assertEqual(
+            'cpu_core@INST_RETIRED.ANY@ / (INST_RETIRED.ANY_P + '
+            'cpu_core@INST_RETIRED.ANY@ + cpu_core@INST_RETIRED.ANY@u)',
+            fixer.fixup('INST_RETIRED.ANY / (INST_RETIRED.ANY_P + '
+                        'cpu_core@INST_RETIRED.ANY@ + inst_retired.any:u)'))
+
+
+class TestExtractTmaMetrics(unittest.TestCase):
+
+    def extract(self, rows: list[str]) -> list[dict]:
+        """Extract SKL metrics from a TMA spreadsheet with the given rows."""
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as csvfile:
+            csvfile.write('TMA,Version,5.1-full\n.\n')
+            csvfile.write('Key,Level1,Level2,SKL/KBL,BDW,HSW,IVB,SNB,Locate-with,'
+                          'Metric Description,Threshold,Metric Group\n')
+            csvfile.write('\n'.join(rows) + '\n')
+            csvfile.flush()
+            sheet = TmaSpreadsheet(Path(csvfile.name))
+        model = Model('SKL', 'Skylake', 'v1', set(['GenuineIntel-6-4E']), {})
+        events = {
+            'CPU_CLK_UNHALTED.THREAD': None,
+            'INST_RETIRED.ANY': None,
+        }
+        saved_formulas = []
+        model.extract_tma_metrics(sheet, 'cpu', events, saved_formulas)
+        return saved_formulas
+
+    def test_references(self):
+        metrics = self.extract([
+            'Aux,#Width,,4,,,,,,,,',
+            'Info.Thread,CLKS,,CPU_CLK_UNHALTED.THREAD,,,,,,Clocks,,',
+            'Info.Thread,SLOTS,,#Width * CLKS,,,,,,Slots,,',
+            'Info.Thread,IPC,,INST_RETIRED.ANY / CLKS,,,,,,IPC,,',
+        ])
+        forms = {m['MetricName']: m['MetricExpr'].ToPerfJson() for m in metrics}
+        self.assertEqual('4 * tma_info_thread_clks', forms['tma_info_thread_slots'])
+        self.assertEqual('INST_RETIRED.ANY / tma_info_thread_clks',
+                         forms['tma_info_thread_ipc'])
+
+    def test_cycle(self):
+        with self.assertRaises(ValueError) as context:
+            self.extract([
+                'Aux,#A,,#B + 1,,,,,,,,',
+                'Aux,#B,,#A + 1,,,,,,,,',
+                'Info.Thread,CLKS,,#A,,,,,,Clocks,,',
+            ])
+        self.assertIn('#A -> #B -> #A', str(context.exception))
+
+
+def read_tree(path: Path) -> Dict[str, bytes]:
+    """Maps the files below path, relative to it, to their contents."""
+    return {str(f.relative_to(path)): f.read_bytes()
+            for f in sorted(path.rglob('*')) if f.is_file()}
+
+
+class TestMapfile(unittest.TestCase):
+
+    def setUp(self):
+        """A repository of two small models, Bonnell and Goldmont."""
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = Path(self.tmp.name, 'base')
+        self.base.mkdir()
+        with open(Path(_repo_dir, 'mapfile.csv'), 'r') as f:
+            lines = f.readlines()
+        with open(Path(self.base, 'mapfile.csv'), 'w') as f:
+            f.write(lines[0])
+            f.writelines(l for l in lines
+                         if l.startswith('GenuineIntel-6-1C,') or
+                         l.startswith('GenuineIntel-6-5C,'))
+        for shortname in ['BNL', 'GLM']:
+            shutil.copytree(Path(_repo_dir, shortname, 'events'),
+                            Path(self.base, shortname, 'events'))
+        shutil.copy(Path(_repo_dir, 'TMA_Metrics-full.csv'), self.base)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def generate(self, name: str, **kwargs) -> Path:
+        outdir = Path(self.tmp.name, name)
+        outdir.mkdir(exist_ok=True)
+        # Forget the inputs read, as a new run of the script would.
+        create_perf_json._file_digest.cache_clear()
+        create_perf_json._init_caches(None, 0)
+        Mapfile(self.base).to_perf_json(outdir, **kwargs)
+        return outdir
+
+    def test_jobs(self):
+        serial = read_tree(self.generate('serial'))
+        self.assertIn('goldmont/cache.json', serial)
+        self.assertIn('bonnell/pipeline.json', serial)
+        self.assertEqual(serial, read_tree(self.generate('parallel', jobs=2)))
+
+    def test_manifest(self):
+        outdir = self.generate('out')
+        manifest = json.loads(Path(outdir, Mapfile.MANIFEST).read_text())
+        self.assertEqual(sorted(manifest['Models']), ['bonnell', 'goldmont'])
+        self.assertIn('cache.json', manifest['Models']['goldmont']['Outputs'])
+
+        # Models whose inputs are unchanged aren't regenerated.
+        stale = {Path(outdir, model, 'cache.json'): b'stale' for model in ['bonnell', 'goldmont']}
+        for path, contents in stale.items():
+            path.write_bytes(contents)
+        self.generate('out')
+        self.assertEqual({path: path.read_bytes() for path in stale}, stale)
+
+        # Changing an input regenerates the models using it.
+        fp_arith = Path(self.base, 'GLM', 'events', 'goldmont_fp_arith_inst.json')
+        fp_arith.write_text(fp_arith.read_text() + '\n')
+        self.generate('out')
+        self.assertEqual(Path(outdir, 'bonnell', 'cache.json').read_bytes(), b'stale')
+        self.assertNotEqual(Path(outdir, 'goldmont', 'cache.json').read_bytes(), b'stale')
+
+        # As does removing an output, or forcing regeneration.
+        Path(outdir, 'goldmont', 'cache.json').unlink()
+        self.generate('out')
+        self.assertTrue(Path(outdir, 'goldmont', 'cache.json').is_file())
+        self.generate('out', force=True)
+        self.assertNotEqual(Path(outdir, 'bonnell', 'cache.json').read_bytes(), b'stale')
+
+
+class TestJsonFileLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmp.name, 'cache')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, value) -> Path:
+        path = Path(self.tmp.name, name)
+        path.write_text(json.dumps(value))
+        return path
+
+    def cache_path(self, loader: JsonFileLoader, path: Path) -> Path:
+        return loader._cache_path(hashlib.sha256(path.read_bytes()).hexdigest())
+
+    def test_cache(self):
+        path = self.write('events.json', {'Events': [1, 2]})
+        loader = JsonFileLoader(self.cache_dir, 1 << 20)
+        self.assertEqual(loader.load(path), {'Events': [1, 2]})
+        cache_path = self.cache_path(loader, path)
+        self.assertTrue(cache_path.is_file())
+
+        # A later run reads the cache, rather than the json.
+        with open(cache_path, 'wb') as f:
+            marshal.dump({'Events': ['cached']}, f)
+        self.assertEqual(JsonFileLoader(self.cache_dir, 1 << 20).load(path),
+                         {'Events': ['cached']})
+
+        # Until the file's contents change.
+        self.write('events.json', {'Events': [3]})
+        self.assertEqual(JsonFileLoader(self.cache_dir, 1 << 20).load(path), {'Events': [3]})
+
+        # A failed write leaves no temporary file behind.
+        self.write('events.json', {'Events': [4]})
+        loader = JsonFileLoader(self.cache_dir, 1 << 20)
+        Path(self.cache_path(loader, path), 'blocked').mkdir(parents=True)
+        self.assertEqual(loader.load(path), {'Events': [4]})
+        self.assertEqual(list(self.cache_dir.glob('*.tmp')), [])
+
+    def test_evict(self):
+        paths = [self.write(f'{i}.json', {'Events': [i] * 100}) for i in range(3)]
+        size = len(marshal.dumps({'Events': [0] * 100}))
+        loader = JsonFileLoader(self.cache_dir, 2 * size)
+        cache_paths = []
+        for age, path in zip([20, 10, 0], paths):
+            loader.load(path)
+            cache_paths.append(self.cache_path(loader, path))
+            # Order the entries by when they were last used.
+            t = time.time() - age
+            os.utime(cache_paths[-1], (t, t))
+        self.assertEqual([p.is_file() for p in cache_paths], [False, True, True])
+        self.assertLessEqual(sum(p.stat().st_size for p in self.cache_dir.glob('*.marshal')),
+                             2 * size)
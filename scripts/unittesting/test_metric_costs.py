@@ -0,0 +1,33 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+import tempfile
+import unittest
+import sys
+from pathlib import Path
+
+# Add metric_costs.py directory to the path before importing.
+_script_dir = Path(__file__).resolve().parent
+sys.path.append(str(_script_dir.parent))
+
+from metric_costs import rank
+
+
+class TestMetricCosts(unittest.TestCase):
+
+    def test_rank(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp, 'metric-costs.csv')
+            with open(path, 'w', encoding='ascii') as f:
+                f.write('MetricName,Unit,Events,CounterGroups,PMUs,Uncore,RetireLatency,EventNames\n'
+                        'ipc,,2,1,core,0,0,INST_RETIRED.ANY cycles\n'
+                        'bw,,2,1,iMC;tool,1,0,UNC_M_CAS_COUNT.RD duration_time\n'
+                        'tsc,,1,0,msr,0,0,msr@tsc@\n'
+                        'wide,,9,3,core,0,0,A B C D E F G H I\n')
+            self.assertEqual([r['MetricName'] for r in rank(path)], ['wide', 'bw', 'ipc', 'tsc'])
+            self.assertEqual([r['MetricName'] for r in rank(path, top=2, cheapest=True)],
+                             ['tsc', 'ipc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
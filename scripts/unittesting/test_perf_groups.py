@@ -0,0 +1,111 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+import json
+import tempfile
+import unittest
+import sys
+from pathlib import Path
+
+# Add perf_groups.py directory to the path before importing.
+_script_dir = Path(__file__).resolve().parent
+sys.path.append(str(_script_dir.parent))
+
+from create_perf_json import EventCounters, FIXED_COUNTER_SHIFT, GENERIC_COUNTERS, counters_fit
+from perf_groups import PerfModel, schedule
+
+
+def write_model(modeldir: Path, metrics, generic: int = 4):
+    """Writes a small model, in the layout of create_perf_json.py, to modeldir."""
+    def event(name, counter, unit=None):
+        result = {'EventName': name, 'EventCode': '0x1', 'Counter': counter}
+        if unit:
+            result['Unit'] = unit
+        return result
+
+    pipeline = [
+        event('INST_RETIRED.ANY', 'Fixed counter 0'),
+        event('CPU_CLK_UNHALTED.THREAD', 'Fixed counter 1'),
+        event('TOPDOWN.SLOTS', 'Fixed counter 3'),
+        event('EVENT.ONLY_0', '0'),
+        event('EVENT.LOW', '0,1'),
+    ] + [event(f'EVENT.ANY{i}', f'0-{generic - 1}') for i in range(6)]
+    uncore = [dict(event('UNC_CHA_CLOCKTICKS', '0,1,2,3', 'CHA'), PerPkg='1')]
+    counters = [
+        {'Unit': 'core', 'CountersNumFixed': '4', 'CountersNumGeneric': str(generic)},
+        {'Unit': 'CHA', 'CountersNumFixed': '0', 'CountersNumGeneric': '4'},
+    ]
+    metric_json = [{'MetricName': name, 'MetricExpr': expr, 'MetricGroup': 'Test',
+                    **extra} for name, expr, extra in metrics]
+    for file, data in [('pipeline.json', pipeline), ('uncore-cache.json', uncore),
+                       ('counter.json', counters), ('test-metrics.json', metric_json),
+                       ('metricgroups.json', {'Test': 'Test metrics'})]:
+        with open(Path(modeldir, file), 'w', encoding='ascii') as f:
+            json.dump(data, f)
+
+
+class TestPerfGroups(unittest.TestCase):
+
+    def test_schedule(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_model(tmp, [
+                ('ipc', 'INST_RETIRED.ANY / CPU_CLK_UNHALTED.THREAD', {}),
+                ('low', 'EVENT.ONLY_0 / EVENT.LOW + ipc', {}),
+                ('conflict', 'EVENT.ONLY_0 + cpu@EVENT.ONLY_0\\,cmask\\=1@', {}),
+                ('wide', ' + '.join(f'EVENT.ANY{i}' for i in range(6)), {}),
+                ('spread', 'EVENT.ANY0 + EVENT.ANY1', {'MetricConstraint': 'NO_GROUP_EVENTS'}),
+                ('retiring', 'topdown\\-retiring / (topdown\\-retiring + topdown\\-be\\-bound)', {}),
+                ('cha', 'UNC_CHA_CLOCKTICKS / duration_time', {}),
+            ])
+            model = PerfModel(Path(tmp))
+            self.assertEqual(model.select(['TEST']), ['ipc', 'low', 'conflict', 'wide',
+                                                      'spread', 'retiring', 'cha'])
+            self.assertRaises(ValueError, lambda: model.select(['missing']))
+            self.assertEqual(model.metric_events('low'),
+                             {'EVENT.ONLY_0', 'EVENT.LOW', 'INST_RETIRED.ANY',
+                              'CPU_CLK_UNHALTED.THREAD'})
+            self.assertEqual(model.placement('msr@tsc@'), None)
+            self.assertEqual(model.placement('uncore_cha_3@event\\=0x1@'),
+                             EventCounters('CHA', GENERIC_COUNTERS, True))
+
+            result = schedule(model, model.select(['Test']))
+            for unit, events in result.groups:
+                masks = tuple(model.placement(e).bitmask for e in events)
+                self.assertTrue(counters_fit(masks, model.units[unit]))
+            self.assertEqual(result.metric_groups['ipc'], 1)
+            self.assertEqual(result.metric_groups['low'], 1)
+            # Both events need counter 0.
+            self.assertEqual(result.metric_groups['conflict'], 2)
+            # More events than the 4 generic counters.
+            self.assertEqual(result.metric_groups['wide'], 2)
+            self.assertEqual(result.metric_groups['cha'], 1)
+            self.assertEqual(result.ungrouped, ['duration_time'])
+            spec = result.perf_events()
+            self.assertIn('{TOPDOWN.SLOTS,topdown-be-bound,topdown-retiring', spec)
+            self.assertIn('{UNC_CHA_CLOCKTICKS}', spec)
+            self.assertIn('cpu/EVENT.ONLY_0,cmask=1/', spec)
+            self.assertTrue(spec.endswith(',duration_time'))
+            self.assertEqual([unit for unit, _ in result.groups].count('CHA'), 1)
+            # 9 distinct events on 4 generic counters need at least 3 groups.
+            self.assertEqual([unit for unit, _ in result.groups].count('core'), 3)
+
+    def test_event_counters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            write_model(tmp, [])
+            model = PerfModel(Path(tmp))
+            self.assertEqual(model.placement('EVENT.LOW'), EventCounters('core', 0x3, False))
+            self.assertEqual(model.placement('cpu@INST_RETIRED.ANY@'),
+                             EventCounters('core', 1 << FIXED_COUNTER_SHIFT, False))
+            with open(Path(tmp, 'event-counters.csv'), 'w', encoding='ascii') as f:
+                f.write('EventName,Unit,Counters,PDISTCounters,Flags\n'
+                        'EVENT.LOW,core,0x2,0x0,\n')
+            model = PerfModel(Path(tmp))
+            self.assertEqual(model.placement('EVENT.LOW:u'), EventCounters('core', 0x2, False))
+
+    def test_missing_counters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertRaises(FileNotFoundError, lambda: PerfModel(Path(tmp)))
+
+
+if __name__ == '__main__':
+    unittest.main()
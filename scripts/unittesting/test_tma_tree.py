@@ -0,0 +1,118 @@
+# Copyright (C) 2024 Intel Corporation
+# SPDX-License-Identifier: BSD-3-Clause
+
+import io
+import json
+import math
+import tempfile
+import unittest
+import sys
+from pathlib import Path
+
+# Add tma_tree.py directory to the path before importing.
+_script_dir = Path(__file__).resolve().parent
+sys.path.append(str(_script_dir.parent))
+
+from perf_groups import PerfModel
+from test_perf_groups import write_model
+from tma_tree import TmaTree, _Values, read_values
+
+
+class TestTmaTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        write_model(self.tmp.name, [
+            ('tma_info_clks', 'CPU_CLK_UNHALTED.THREAD', {'MetricGroup': 'Info;tma_L1_group'}),
+            ('tma_frontend_bound', 'EVENT.ANY0 / tma_info_clks',
+             {'MetricGroup': 'TopdownL1;tma_L1_group',
+              'MetricThreshold': 'tma_frontend_bound > 0.15'}),
+            ('tma_backend_bound', 'EVENT.ANY1 / tma_info_clks',
+             {'MetricGroup': 'TopdownL1;tma_L1_group',
+              'MetricThreshold': 'tma_backend_bound > 0.2'}),
+            ('tma_fetch_latency', 'EVENT.ANY2 / tma_info_clks',
+             {'MetricGroup': 'TopdownL2;tma_L2_group;tma_frontend_bound_group',
+              'MetricThreshold': 'tma_fetch_latency > 0.1 & tma_frontend_bound > 0.15'}),
+            ('tma_icache_misses', 'EVENT.ANY3 / tma_info_clks',
+             {'MetricGroup': 'TopdownL3;tma_L3_group;tma_fetch_latency_group',
+              'MetricThreshold': 'tma_icache_misses > 0.05 & (tma_fetch_latency > 0.1 & '
+              'tma_frontend_bound > 0.15)'}),
+            ('tma_memory_bound', 'EVENT.ANY4 / tma_info_clks',
+             {'MetricGroup': 'TopdownL2;tma_L2_group;tma_backend_bound_group',
+              'MetricThreshold': 'tma_memory_bound > 0.2 & tma_backend_bound > 0.2'}),
+            ('tma_dram_bound', 'EVENT.ANY5 / tma_info_clks',
+             {'MetricGroup': 'TopdownL3;tma_L3_group;tma_memory_bound_group',
+              'MetricThreshold': 'tma_dram_bound > 0.1 & (tma_memory_bound > 0.2 & '
+              'tma_backend_bound > 0.2)'}),
+        ])
+        self.model = PerfModel(Path(self.tmp.name))
+        self.tree = TmaTree(self.model)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_tree(self):
+        self.assertEqual(self.tree.roots, ['tma_frontend_bound', 'tma_backend_bound'])
+        self.assertEqual(self.tree.children['tma_frontend_bound'], ['tma_fetch_latency'])
+        self.assertEqual(self.tree.descendants('tma_backend_bound'),
+                         ['tma_memory_bound', 'tma_dram_bound'])
+
+    def test_evaluate(self):
+        result = self.tree.evaluate({
+            'CPU_CLK_UNHALTED.THREAD': 100, 'EVENT.ANY0': 30, 'EVENT.ANY1': 10,
+            'EVENT.ANY2': 20, 'EVENT.ANY3': 1,
+        })
+        self.assertEqual([(n.name, n.depth, n.threshold) for n in result.nodes], [
+            ('tma_frontend_bound', 0, True),
+            ('tma_fetch_latency', 1, True),
+            ('tma_icache_misses', 2, False),
+            ('tma_backend_bound', 0, False),
+        ])
+        self.assertAlmostEqual(result.nodes[1].value, 0.2)
+        self.assertEqual(result.skipped, {
+            'tma_backend_bound': ['tma_memory_bound', 'tma_dram_bound'],
+        })
+        # The 4 nodes and the tma_info_clks they reference.
+        self.assertEqual(result.computed, 5)
+        self.assertEqual(result.missing, set())
+        report = result.report()
+        self.assertIn('  tma_fetch_latency: 0.2 <==', report)
+        self.assertIn('tma_backend_bound: 0.1, skipped 2 below', report)
+
+    def test_missing(self):
+        result = self.tree.evaluate({'CPU_CLK_UNHALTED.THREAD': 100, 'EVENT.ANY1': 50})
+        self.assertTrue(math.isnan(result.nodes[0].value))
+        self.assertFalse(result.nodes[0].threshold)
+        self.assertEqual([n.name for n in result.nodes],
+                         ['tma_frontend_bound', 'tma_backend_bound', 'tma_memory_bound'])
+        self.assertEqual(result.missing, {'EVENT.ANY0', 'EVENT.ANY4'})
+
+    def test_error(self):
+        def fail(values):
+            raise KeyError('EVENT.ANY0')
+
+        inputs = _Values(self.tree, {'CPU_CLK_UNHALTED.THREAD': 100, 'EVENT.ANY0': 30})
+        self.tree._compiled[('tma_frontend_bound', 'MetricExpr')] = fail
+        with self.assertRaises(KeyError):
+            inputs.metric('tma_frontend_bound')
+        # A failed metric isn't left as being computed.
+        self.assertEqual(inputs.computing, set())
+        del self.tree._compiled[('tma_frontend_bound', 'MetricExpr')]
+        self.assertAlmostEqual(inputs.metric('tma_frontend_bound'), 0.3)
+
+    def test_read_values(self):
+        stat = '\n'.join(json.dumps(line) for line in [
+            {'interval': 1.0, 'counter-value': '100', 'event': 'CPU_CLK_UNHALTED.THREAD'},
+            {'interval': 1.0, 'counter-value': '<not counted>', 'event': 'EVENT.ANY0'},
+            {'interval': 2.0, 'counter-value': '200', 'event': 'CPU_CLK_UNHALTED.THREAD'},
+        ])
+        self.assertEqual(read_values(self.model, io.StringIO(stat)), [
+            ('1.0', {'CPU_CLK_UNHALTED.THREAD': 100.0}),
+            ('2.0', {'CPU_CLK_UNHALTED.THREAD': 200.0}),
+        ])
+        self.assertEqual(read_values(self.model, io.StringIO('{"EVENT.ANY0": 3}')),
+                         [('', {'EVENT.ANY0': 3.0})])
+
+
+if __name__ == '__main__':
+    unittest.main()